@@ -0,0 +1,270 @@
+"""Admission control of the connections.
+
+Thread pool mode: accepted connections wait in a bounded queue for one of a fixed
+nb of worker threads. When the queue is full the connection is not admitted: it
+gets an immediate 503 with Retry-After instead of waiting behind everybody else,
+so the latency of the admitted connections stays bounded under bursts.
+
+All modes: a `ConnectionLimiter` caps the connections open at once from a single
+IP, so that a few clients holding many connections open can not take all the
+threads or workers. The prefork workers share theirs (`SharedConnectionLimiter`).
+"""
+
+import collections
+import multiprocessing
+import queue
+import socket
+import threading
+import time
+import zlib
+from typing import Callable
+
+from app.http import HttpResponse, HttpStatus, HttpVersion
+from app.metrics import METRICS
+
+# nb of most recent queue wait times used for the percentiles
+WAIT_SAMPLES = 1024
+
+# counters per worker of the shared connection limiter, IPs are hashed into them
+SHARED_SLOTS = 4096
+
+
+def service_unavailable(retry_after: int) -> bytes:
+    res = HttpResponse.empty(status=HttpStatus.ServiceUnavailable503)
+    res.headers["Retry-After"] = str(retry_after)
+    res.set_keep_alive(False, HttpVersion.V1_1)
+    return res.to_bytes()
+
+
+def reject(conn: socket.socket, rejection: bytes):
+    """Answers without reading the request so that it costs the accept loop
+    next to nothing. What the client already sent is discarded first: closing
+    with unread data would reset the connection and lose the response"""
+    with conn:
+        try:
+            conn.setblocking(False)
+            while conn.recv(65536):
+                pass
+        except BlockingIOError:
+            pass
+        except OSError:
+            return
+        try:
+            conn.send(rejection)
+            conn.shutdown(socket.SHUT_WR)
+        except OSError:
+            pass
+
+
+def peer_ip(peername) -> str:
+    """IP of a socket address, empty for the sockets that have none (AF_UNIX)"""
+    return peername[0] if isinstance(peername, tuple) else ""
+
+
+class ConnectionLimiter:
+    """Counts the open connections of each IP: `acquire` refuses one beyond
+    `max_per_ip` (0: no limit), `release` must follow every successful `acquire`"""
+
+    def __init__(self, max_per_ip: int):
+        self.max_per_ip = max_per_ip
+        self.lock = threading.Lock()
+        self.counts: dict[str, int] = {}
+
+    def acquire(self, ip: str) -> bool:
+        if not self.max_per_ip:
+            return True
+        with self.lock:
+            count = self.counts.get(ip, 0)
+            if count >= self.max_per_ip:
+                return False
+            self.counts[ip] = count + 1
+        return True
+
+    def release(self, ip: str):
+        if not self.max_per_ip:
+            return
+        with self.lock:
+            count = self.counts.pop(ip) - 1
+            if count:
+                self.counts[ip] = count
+
+
+class SharedConnectionLimiter(ConnectionLimiter):
+    """Same limit for all the workers of the prefork mode, counted in shared memory.
+    Each worker counts its connections in a row of its own, by hash of the IP: IPs
+    with the same hash share their limit. The row of a worker that died is
+    cleared by `use_row` before its replacement is forked"""
+
+    def __init__(self, max_per_ip: int, nb_workers: int, nb_slots: int = SHARED_SLOTS):
+        super().__init__(max_per_ip)
+        self.nb_workers = nb_workers
+        self.nb_slots = nb_slots
+        self.shared = multiprocessing.Array("i", nb_workers * nb_slots)
+        self.row = 0
+
+    def use_row(self, row: int):
+        """Called in the supervisor before forking the worker of that row"""
+        with self.shared.get_lock():
+            counts = self.shared.get_obj()
+            for i in range(row * self.nb_slots, (row + 1) * self.nb_slots):
+                counts[i] = 0
+        self.row = row
+
+    def acquire(self, ip: str) -> bool:
+        if not self.max_per_ip:
+            return True
+        slot = zlib.crc32(ip.encode()) % self.nb_slots
+        with self.shared.get_lock():
+            counts = self.shared.get_obj()
+            total = sum(
+                counts[row * self.nb_slots + slot] for row in range(self.nb_workers)
+            )
+            if total >= self.max_per_ip:
+                return False
+            counts[self.row * self.nb_slots + slot] += 1
+        return True
+
+    def release(self, ip: str):
+        if not self.max_per_ip:
+            return
+        slot = zlib.crc32(ip.encode()) % self.nb_slots
+        with self.shared.get_lock():
+            self.shared.get_obj()[self.row * self.nb_slots + slot] -= 1
+
+
+class AdmissionStats:
+    """Admissions, rejections and queue waits of a pool. Also recorded in `METRICS`
+    for /metrics, as the `queue` stage and the `http_connections_total` counter"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.admitted = 0
+        self.rejected = 0
+        self.max_depth = 0
+        self.started = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.recent_waits: collections.deque[float] = collections.deque(
+            maxlen=WAIT_SAMPLES
+        )
+
+    def on_admit(self, depth: int):
+        with self.lock:
+            self.admitted += 1
+            self.max_depth = max(self.max_depth, depth)
+        METRICS.count_connection("admitted")
+
+    def on_reject(self):
+        with self.lock:
+            self.rejected += 1
+        METRICS.count_connection("rejected")
+
+    def on_start(self, wait: float):
+        with self.lock:
+            self.started += 1
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+            self.recent_waits.append(wait)
+        METRICS.observe("queue", wait)
+
+    def wait_percentile(self, p: float) -> float:
+        with self.lock:
+            waits = sorted(self.recent_waits)
+        if not waits:
+            return 0.0
+        return waits[min(int(p * len(waits)), len(waits) - 1)]
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            snapshot = {
+                "admitted": self.admitted,
+                "rejected": self.rejected,
+                "max_queue_depth": self.max_depth,
+                "mean_wait": self.total_wait / self.started if self.started else 0.0,
+                "max_wait": self.max_wait,
+            }
+        snapshot["p50_wait"] = self.wait_percentile(0.5)
+        snapshot["p99_wait"] = self.wait_percentile(0.99)
+        return snapshot
+
+
+class BoundedThreadPool:
+    """`nb_threads` workers calling `handler(conn)` on the connections taken from a
+    queue of at most `max_pending` connections (0: no limit), and of at most
+    what `limiter` allows per IP.
+
+    What is bounded is the nb of admitted connections not finished yet, rather than
+    the queue itself: a connection is not turned away just because the idle
+    threads did not pick the previous ones yet"""
+
+    def __init__(
+        self,
+        handler: Callable[[socket.socket], None],
+        nb_threads: int,
+        max_pending: int,
+        retry_after: int = 1,
+        limiter: ConnectionLimiter | None = None,
+    ):
+        self.handler = handler
+        self.limiter = limiter or ConnectionLimiter(0)
+        self.pending: queue.Queue[tuple[socket.socket, str, float] | None] = (
+            queue.Queue()
+        )
+        self.slots = (
+            threading.BoundedSemaphore(nb_threads + max_pending)
+            if max_pending
+            else None
+        )
+        self.rejection = service_unavailable(retry_after)
+        self.stats = AdmissionStats()
+        self.threads = [
+            threading.Thread(target=self.work, name=f"pool-{i}")
+            for i in range(nb_threads)
+        ]
+        for thread in self.threads:
+            thread.start()
+        METRICS.gauge("http_pool_queue_depth", lambda: self.queue_depth)
+
+    @property
+    def queue_depth(self) -> int:
+        return self.pending.qsize()
+
+    def submit(self, conn: socket.socket, ip: str = "") -> bool:
+        """Returns False if the connection was rejected because the queue is full
+        or its IP has too many connections already"""
+        if not self.limiter.acquire(ip):
+            self.stats.on_reject()
+            reject(conn, self.rejection)
+            return False
+        if self.slots is not None and not self.slots.acquire(blocking=False):
+            self.limiter.release(ip)
+            self.stats.on_reject()
+            reject(conn, self.rejection)
+            return False
+        self.pending.put((conn, ip, time.monotonic()))
+        self.stats.on_admit(self.pending.qsize())
+        return True
+
+    def work(self):
+        while True:
+            item = self.pending.get()
+            if item is None:
+                return
+            conn, ip, admitted_at = item
+            self.stats.on_start(time.monotonic() - admitted_at)
+            try:
+                self.handler(conn)
+            except Exception as e:
+                print(f"Error while handling a connection: {e!r}")
+            finally:
+                if self.slots is not None:
+                    self.slots.release()
+                self.limiter.release(ip)
+
+    def shutdown(self):
+        """Waits for the queued connections to be handled"""
+        METRICS.gauge("http_pool_queue_depth", None)
+        for _ in self.threads:
+            self.pending.put(None)
+        for thread in self.threads:
+            thread.join()
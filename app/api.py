@@ -1,84 +1,431 @@
-from app.http import HttpMethod, HttpRequest, HttpResponse, HttpStatus
+from app.compression import (
+    cached_sidecar,
+    compress_file,
+    compress_file_stream,
+    negotiate_encoding,
+)
+from app.conditional import is_not_modified
+from app.config import ServerConfig
+from app.file_cache import FILE_CACHE
+from app.framing import (
+    HeadersTooLarge,
+    InvalidRequest,
+    RequestLineTooLong,
+    RequestTimeout,
+    RequestTooLarge,
+)
+from app.ranges import if_range_matches, parse_range
+from app.http import (
+    HttpMethod,
+    HttpRequest,
+    HttpResponse,
+    HttpStatus,
+    HttpVersion,
+    StreamBody,
+)
+from app.metrics import CONTENT_TYPE, METRICS, UNMATCHED
+from app.offload import offload_chunks, run_blocking
+from app.profiling import PROFILER
+from app.response_cache import RESPONSE_CACHE
+from app.routing import Handler, MethodNotAllowed, RouteNotFound, Router
+from typing import Any, Callable
+import functools
 import pathlib
 
+# responses to the uploads whose file can not be created, by error class
+UPLOAD_FAILURES = {
+    FileNotFoundError: HttpStatus.NotFound404,
+    FileExistsError: HttpStatus.Conflict409,
+    IsADirectoryError: HttpStatus.Conflict409,
+    NotADirectoryError: HttpStatus.Conflict409,
+    PermissionError: HttpStatus.Forbidden403,
+    OSError: HttpStatus.InternalServerError500,
+}
 
-def handle_req(req: HttpRequest, directory: str | None) -> HttpResponse:
-    match req.method:
-        case HttpMethod.GET:
-            return handle_get_req(req, directory)
-        case HttpMethod.POST:
-            return handle_post_req(req, directory)
-        case _:
-            return HttpResponse.empty(status=HttpStatus.NotFound404)
 
+def upload_failure(error: OSError) -> HttpResponse:
+    """Response to an upload whose file can not be created: missing parent
+    directory, existing file, permissions..."""
+    status = next(
+        UPLOAD_FAILURES[cls] for cls in type(error).__mro__ if cls in UPLOAD_FAILURES
+    )
+    if status == HttpStatus.InternalServerError500:
+        print(f"Error while creating an uploaded file: {error!r}")
+    return HttpResponse.empty(status=status)
 
-def handle_get_req(req: HttpRequest, directory: str | None) -> HttpResponse:
-    accepted_encodings = req.headers.get("Accept-Encoding", "").split(", ")
 
-    if "gzip" in accepted_encodings:
-        content_encoding = "gzip"
-    else:
-        content_encoding = None
-
-    match req.urlpath.path:
-        case "":
-            res = HttpResponse.empty(status=HttpStatus.Ok200)
-
-        case "user-agent":
-            user_agent = req.headers.get("User-Agent", "")
-            res = HttpResponse.text_content(
-                status=HttpStatus.Ok200,
-                content=user_agent,
-                content_encoding=content_encoding,
-            )
+class FileUpload:
+    """Writes the body of a POST /files/ request to disk while it is received, so
+    that the upload never needs to fit in memory"""
 
-        case x if x.startswith("echo/"):
-            res = HttpResponse.text_content(
-                status=HttpStatus.Ok200,
-                content=x[5:],
-                content_encoding=content_encoding,
-            )
-        case x if x.startswith("files/"):
-            if not directory:
-                res = HttpResponse.empty(status=HttpStatus.NotFound404)
-            else:
-                filename = x[6:]
-                dirpath = pathlib.Path(directory)
-                filepath = dirpath / filename
-                if filepath.exists():
-                    with open(filepath, "r") as f:
-                        content = f.read()
-                    res = HttpResponse.text_content(
-                        status=HttpStatus.Ok200,
-                        content=content,
-                        content_type="application/octet-stream",
-                        content_encoding=content_encoding,
-                    )
-                else:
-                    res = HttpResponse.empty(status=HttpStatus.NotFound404)
-
-        case _:
-            res = HttpResponse.empty(status=HttpStatus.NotFound404)
+    def __init__(self, filepath: pathlib.Path):
+        self.filepath = filepath
+        # exclusive creation: a concurrent upload of the same file gets a 409
+        self.file = open(filepath, "xb")
+
+    def write(self, chunk: bytes):
+        self.file.write(chunk)
+
+    def finish(self) -> HttpResponse:
+        self.file.close()
+        res = HttpResponse.empty(status=HttpStatus.Created201)
+        METRICS.count_request(post_file.__name__, res.status.code)
+        return res
+
+    def abort(self):
+        """Removes the partial file, for ex when the client disconnects mid-upload"""
+        self.file.close()
+        self.filepath.unlink(missing_ok=True)
+
+
+class RequestContext:
+    """What the route handlers get besides the request and the path parameters"""
+
+    def __init__(
+        self,
+        directory: str | None,
+        config: ServerConfig,
+        content_encoding: str | None = None,
+    ):
+        self.directory = directory
+        self.config = config
+        # coding negotiated for the response body, None for no compression
+        self.content_encoding = content_encoding
+
+
+ROUTES = Router()
+
+
+def file_path(directory: str, filename: str) -> pathlib.Path | None:
+    """Path of `filename` within `directory`, None if it could point outside of it:
+    `..`, empty (a leading one makes the path absolute) or `.` segments"""
+    segments = filename.split("/")
+    if "\0" in filename or any(s in ("", ".", "..") for s in segments):
+        return None
+    return pathlib.Path(directory, *segments)
+
+
+def open_body_sink(req: HttpRequest, directory: str | None) -> FileUpload | None:
+    """Called once the headers are received. Returns where to stream the body for the
+    requests that support it, None if the body must be buffered and the request
+    answered by `handle_req`"""
+    if req.method != HttpMethod.POST or not directory:
+        return None
+    try:
+        handler, params = ROUTES.resolve(req.method, req.urlpath.path)
+    except LookupError:
+        return None
+    if handler is not post_file:
+        return None
+    filepath = file_path(directory, params["filename"])
+    if filepath is None:
+        # answered by `post_file`
+        return None
+    try:
+        return FileUpload(filepath)
+    except OSError:
+        # answered by `post_file`, which fails the same way
+        return None
+
+
+def blocking(handler: Handler) -> Handler:
+    """Marks a handler doing disk io or compression: the event loop engines run it
+    in their io threads (see `handle_req_async`)"""
+    handler.blocking = True
+    return handler
+
+
+def cached(vary: tuple[str, ...] = ()) -> Callable[[Handler], Handler]:
+    """Marks a GET handler whose response only depends on the path, the negotiated
+    coding and the request headers in `vary`: its responses are kept serialised
+    in the response cache (see `app.response_cache`)"""
+
+    def mark(handler: Handler) -> Handler:
+        handler.vary = vary
+        return handler
+
+    return mark
+
+
+def prepare_req(
+    req: HttpRequest, directory: str | None, config: ServerConfig
+) -> tuple[Callable[[], HttpResponse], bool]:
+    """Resolves the route of the request. Returns the call answering it and whether
+    that call blocks"""
+    try:
+        handler, params = ROUTES.resolve(req.method, req.urlpath.path)
+    except RouteNotFound:
+        res = HttpResponse.empty(status=HttpStatus.NotFound404)
+        return functools.partial(unmatched, res), False
+    except MethodNotAllowed as e:
+        res = HttpResponse.empty(status=HttpStatus.MethodNotAllowed405)
+        res.headers["Allow"] = ", ".join(method.value for method in e.allowed)
+        return functools.partial(unmatched, res), False
+
+    ctx = RequestContext(directory, config)
+    call = functools.partial(call_handler, req, handler, params, ctx)
+    vary = getattr(handler, "vary", None)
+    if vary is not None and req.method == HttpMethod.GET and RESPONSE_CACHE.max_bytes:
+        return functools.partial(call_cached, req, handler, vary, call), False
+    return call, getattr(handler, "blocking", False)
+
+
+def handle_req(
+    req: HttpRequest, directory: str | None, config: ServerConfig = ServerConfig()
+) -> HttpResponse:
+    call, _ = prepare_req(req, directory, config)
+    return call()
+
+
+async def handle_req_async(
+    req: HttpRequest, directory: str | None, config: ServerConfig = ServerConfig()
+) -> HttpResponse:
+    """`handle_req` for the event loop engines: the blocking handlers run in the io
+    threads, and so does the production of the bodies they stream"""
+    call, blocks = prepare_req(req, directory, config)
+    if not blocks:
+        return profiled(call)
+    return await call_in_io_thread(call)
+
+
+async def call_in_io_thread(call: Callable[[], HttpResponse]) -> HttpResponse:
+    # profiled in the io thread: cProfile follows threads, not coroutines
+    res = await run_blocking(profiled, call)
+    if isinstance(res.body, StreamBody) and not res.body.is_async:
+        res.body.chunks = offload_chunks(res.body.chunks)
+    return res
+
+
+def profiled(call: Callable[[], HttpResponse]) -> HttpResponse:
+    with PROFILER.request():
+        return call()
+
+
+def unmatched(res: HttpResponse) -> HttpResponse:
+    METRICS.count_request(UNMATCHED, res.status.code)
+    return res
+
+
+# responses to the requests refused while they are received, by error class
+REFUSALS = {
+    RequestLineTooLong: HttpStatus.UriTooLong414,
+    HeadersTooLarge: HttpStatus.RequestHeaderFieldsTooLarge431,
+    RequestTimeout: HttpStatus.RequestTimeout408,
+    InvalidRequest: HttpStatus.BadRequest400,
+    UnicodeDecodeError: HttpStatus.BadRequest400,
+}
+
+
+def refusal(error: RequestTooLarge | InvalidRequest | RequestTimeout) -> HttpResponse:
+    """Response to a request refused before it was entirely received, after which
+    the connection is closed"""
+    status = next(REFUSALS[cls] for cls in type(error).__mro__ if cls in REFUSALS)
+    res = HttpResponse.empty(status=status)
+    res.set_keep_alive(False, HttpVersion.V1_1)
+    return unmatched(res)
+
+
+def call_cached(
+    req: HttpRequest,
+    handler: Handler,
+    vary: tuple[str, ...],
+    call: Callable[[], HttpResponse],
+) -> HttpResponse:
+    key = (
+        req.method,
+        req.urlpath.path,
+        negotiate_encoding(req.headers.get("Accept-Encoding")),
+        *(req.headers.get(name) for name in vary),
+    )
+    res = RESPONSE_CACHE.get(key)
+    if res is None:
+        return RESPONSE_CACHE.store(key, call())
+    METRICS.count_request(handler.__name__, res.status.code)
     return res
 
 
-def handle_post_req(req: HttpRequest, directory: str | None) -> HttpResponse:
-    match req.urlpath.path:
-        case x if x.startswith("files/"):
-            if not directory:
-                res = HttpResponse.empty(status=HttpStatus.NotFound404)
-            else:
-                filename = x[6:]
-                dirpath = pathlib.Path(directory)
-                filepath = dirpath / filename
-                if filepath.exists():
-                    res = HttpResponse.empty(status=HttpStatus.Conflict409)
-                else:
-                    with open(filepath, "w") as f:
-                        f.write(req.body)
-
-                    res = HttpResponse.empty(status=HttpStatus.Created201)
-
-        case _:
-            res = HttpResponse.empty(status=HttpStatus.NotFound404)
+def call_handler(
+    req: HttpRequest, handler: Handler, params: dict[str, Any], ctx: RequestContext
+) -> HttpResponse:
+    res = run_handler(req, handler, params, ctx)
+    METRICS.count_request(handler.__name__, res.status.code)
+    return res
+
+
+def run_handler(
+    req: HttpRequest, handler: Handler, params: dict[str, Any], ctx: RequestContext
+) -> HttpResponse:
+    if req.method != HttpMethod.GET:
+        return handler(req, ctx, **params)
+
+    negotiated = negotiate_encoding(req.headers.get("Accept-Encoding"))
+    if negotiated is None:
+        return HttpResponse.empty(status=HttpStatus.NotAcceptable406)
+    ctx.content_encoding = None if negotiated == "identity" else negotiated
+
+    res = handler(req, ctx, **params)
+    if res.status == HttpStatus.Ok200 and res.body:
+        res.headers["Vary"] = ", ".join(
+            ("Accept-Encoding", *getattr(handler, "vary", ()))
+        )
     return res
+
+
+@ROUTES.get("/")
+def index(req: HttpRequest, ctx: RequestContext) -> HttpResponse:
+    return HttpResponse.empty(status=HttpStatus.Ok200)
+
+
+@ROUTES.get("/metrics")
+def metrics(req: HttpRequest, ctx: RequestContext) -> HttpResponse:
+    """Prometheus text format. Scrapes are small and never the same: they are not
+    compressed, which would only fill the compression cache"""
+    return HttpResponse.text_content(
+        status=HttpStatus.Ok200, content=METRICS.render(), content_type=CONTENT_TYPE
+    )
+
+
+@ROUTES.post("/admin/profile/start")
+def start_profiling(req: HttpRequest, ctx: RequestContext) -> HttpResponse:
+    if not ctx.config.admin_routes:
+        return HttpResponse.empty(status=HttpStatus.NotFound404)
+    if not PROFILER.start():
+        return HttpResponse.empty(status=HttpStatus.Conflict409)
+    return HttpResponse.text_content(content=f"Profiling started ({PROFILER.mode})\n")
+
+
+@ROUTES.post("/admin/profile/stop")
+@blocking
+def stop_profiling(req: HttpRequest, ctx: RequestContext) -> HttpResponse:
+    """Answers with the path of the dump, written on the server"""
+    if not ctx.config.admin_routes:
+        return HttpResponse.empty(status=HttpStatus.NotFound404)
+    if not PROFILER.active:
+        return HttpResponse.empty(status=HttpStatus.Conflict409)
+    path = PROFILER.stop()
+    return HttpResponse.text_content(content=f"{path or 'Nothing profiled'}\n")
+
+
+@ROUTES.get("/user-agent")
+@cached(vary=("User-Agent",))
+def user_agent(req: HttpRequest, ctx: RequestContext) -> HttpResponse:
+    return HttpResponse.text_content(
+        status=HttpStatus.Ok200,
+        content=req.headers.get("User-Agent", ""),
+        content_encoding=ctx.content_encoding,
+    )
+
+
+@ROUTES.get("/echo/{text:path}")
+@cached()
+def echo(req: HttpRequest, ctx: RequestContext, text: str) -> HttpResponse:
+    return HttpResponse.text_content(
+        status=HttpStatus.Ok200,
+        content=text,
+        content_encoding=ctx.content_encoding,
+    )
+
+
+@ROUTES.get("/files/{filename:path}")
+@blocking
+def get_file(req: HttpRequest, ctx: RequestContext, filename: str) -> HttpResponse:
+    if not ctx.directory:
+        return HttpResponse.empty(status=HttpStatus.NotFound404)
+    filepath = file_path(ctx.directory, filename)
+    if filepath is None:
+        return HttpResponse.empty(status=HttpStatus.NotFound404)
+    return handle_get_file(req, filepath, ctx.content_encoding, ctx.config)
+
+
+def handle_get_file(
+    req: HttpRequest,
+    filepath: pathlib.Path,
+    content_encoding: str | None,
+    config: ServerConfig,
+) -> HttpResponse:
+    info = FILE_CACHE.lookup(filepath)
+    if info is None:
+        return HttpResponse.empty(status=HttpStatus.NotFound404)
+
+    etag = info.etag_for(content_encoding)
+    if is_not_modified(req.headers, etag, info.mtime):
+        return HttpResponse.not_modified(
+            {
+                "ETag": etag,
+                "Last-Modified": info.last_modified,
+                "Vary": "Accept-Encoding",
+            }
+        )
+
+    # ranges are always served from the uncompressed file
+    range_header = req.headers.get("Range")
+    if_range = req.headers.get("If-Range")
+    if range_header is not None and (
+        if_range is None or if_range_matches(if_range, info.mtime, info.etag)
+    ):
+        ranges = parse_range(range_header, info.size)
+        if ranges == []:
+            return HttpResponse.range_not_satisfiable(info.size)
+        if ranges:
+            res = HttpResponse.partial_file_content(
+                filepath, ranges, info.size, source=info
+            )
+            res.headers["ETag"] = info.etag
+            res.headers["Last-Modified"] = info.last_modified
+            return res
+
+    sidecar = (
+        cached_sidecar(info, content_encoding)
+        if content_encoding and config.precompressed_sidecars
+        else None
+    )
+    if sidecar:
+        res = HttpResponse.file_content(
+            sidecar.path, content_encoding=content_encoding, source=sidecar
+        )
+    elif (
+        content_encoding
+        and req.version != HttpVersion.V1_0
+        and config.streams_compression(info.size)
+    ):
+        res = HttpResponse.stream_content(
+            compress_file_stream(filepath, content_encoding),
+            content_type="application/octet-stream",
+            content_encoding=content_encoding,
+        )
+    elif content_encoding:
+        res = HttpResponse.encoded_content(
+            status=HttpStatus.Ok200,
+            content=compress_file(filepath, content_encoding, source=info),
+            content_type="application/octet-stream",
+            content_encoding=content_encoding,
+        )
+    else:
+        res = HttpResponse.file_content(filepath, source=info)
+
+    res.headers["Accept-Ranges"] = "bytes"
+    res.headers["ETag"] = etag
+    res.headers["Last-Modified"] = info.last_modified
+    return res
+
+
+@ROUTES.post("/files/{filename:path}")
+@blocking
+def post_file(req: HttpRequest, ctx: RequestContext, filename: str) -> HttpResponse:
+    """Only used when the upload could not be streamed to disk by the connection"""
+    if not ctx.directory:
+        return HttpResponse.empty(status=HttpStatus.NotFound404)
+    filepath = file_path(ctx.directory, filename)
+    if filepath is None:
+        return HttpResponse.empty(status=HttpStatus.NotFound404)
+    try:
+        f = open(filepath, "xb")
+    except OSError as e:
+        return upload_failure(e)
+    with f:
+        f.write(req.body)
+    return HttpResponse.empty(status=HttpStatus.Created201)
+
+
+# all the routes are registered: compiled once rather than on the first request
+ROUTES.compile()
@@ -0,0 +1,171 @@
+"""Content encoding of response bodies.
+
+The encoding is negotiated from the Accept-Encoding header of the request.
+
+Compressed bodies are kept in an LRU cache so that a file or an echo served many
+times is only compressed once. Files are identified by path, mtime and size so that
+a modified file is compressed again; other bodies by a hash of their content.
+"""
+
+import gzip
+import hashlib
+import os
+import pathlib
+import time
+import zlib
+from typing import Iterator
+
+from app.cache import LRUBytesCache
+from app.config import ServerConfig
+from app.file_cache import FILE_CACHE, FileInfo
+from app.metrics import METRICS
+
+COMPRESSION_CACHE = LRUBytesCache(max_bytes=ServerConfig.compression_cache_size)
+
+# by order of preference when the client accepts several with the same q-value
+SUPPORTED_ENCODINGS = ("gzip", "deflate", "identity")
+
+# precompressed files are stored next to the original with this suffix
+SIDECAR_SUFFIXES = {"gzip": ".gz"}
+
+
+def parse_accept_encoding(header: str) -> dict[str, float]:
+    """`gzip;q=0.8, deflate, *;q=0` -> {"gzip": 0.8, "deflate": 1.0, "*": 0.0}.
+    Codings with an invalid q-value are ignored"""
+    qvalues = {}
+    for item in header.split(","):
+        coding, *params = item.split(";")
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        q = 1.0
+        for param in params:
+            key, _, val = param.partition("=")
+            if key.strip().lower() == "q":
+                try:
+                    q = float(val.strip())
+                except ValueError:
+                    q = -1.0
+        if 0 <= q <= 1:
+            qvalues[coding] = q
+    return qvalues
+
+
+def negotiate_encoding(accept_encoding: str | None) -> str | None:
+    """Returns the preferred supported coding, `identity` meaning no compression.
+    Returns None when the client refuses all of them (identity included)"""
+    if accept_encoding is None:
+        return "identity"
+    qvalues = parse_accept_encoding(accept_encoding)
+    wildcard = qvalues.get("*")
+
+    best, best_q = None, 0.0
+    for coding in SUPPORTED_ENCODINGS:
+        q = qvalues.get(coding, wildcard)
+        if q is None:
+            # identity is always acceptable unless explicitly refused
+            q = 1.0 if coding == "identity" else 0.0
+        if q > best_q:
+            best, best_q = coding, q
+    return best
+
+
+def compress(body: bytes, encoding: str) -> bytes:
+    start = time.perf_counter()
+    match encoding:
+        case "gzip":
+            compressed = gzip.compress(body, compresslevel=6)
+        case "deflate":
+            # the http deflate coding is the zlib format (RFC 1950), not raw deflate
+            compressed = zlib.compress(body, level=6)
+        case _:
+            raise ValueError(f"Unsupported content encoding: {encoding}")
+    METRICS.observe("compress", time.perf_counter() - start)
+    return compressed
+
+
+# zlib wbits selecting the container of the deflate stream
+WBITS = {"gzip": 16 + zlib.MAX_WBITS, "deflate": zlib.MAX_WBITS}
+
+
+def compress_file_stream(
+    path: pathlib.Path, encoding: str, block_size: int = 64 * 1024
+) -> Iterator[bytes]:
+    """Compresses the file block by block, so that memory stays flat whatever its
+    size. The first block is flushed right away to get the first bytes out fast.
+    The time spent compressing, reads and sends excluded, is observed once the
+    stream ends"""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, WBITS[encoding])
+    elapsed = 0.0
+    try:
+        with open(path, "rb") as f:
+            first = True
+            while block := f.read(block_size):
+                start = time.perf_counter()
+                out = compressor.compress(block)
+                if first:
+                    out += compressor.flush(zlib.Z_SYNC_FLUSH)
+                    first = False
+                elapsed += time.perf_counter() - start
+                if out:
+                    yield out
+        start = time.perf_counter()
+        out = compressor.flush()
+        elapsed += time.perf_counter() - start
+        yield out
+    finally:
+        METRICS.observe("compress", elapsed)
+
+
+def compress_bytes(body: bytes, encoding: str) -> bytes:
+    key = ("bytes", encoding, hashlib.blake2b(body, digest_size=16).digest())
+    compressed = COMPRESSION_CACHE.get(key)
+    if compressed is None:
+        compressed = compress(body, encoding)
+        COMPRESSION_CACHE.put(key, compressed)
+    return compressed
+
+
+def compress_file(
+    path: pathlib.Path, encoding: str, source: FileInfo | None = None
+) -> bytes:
+    """The file is only read when its compressed content is not cached. With a
+    `source` from the file cache, the file is not even stat'ed"""
+    if source is None:
+        st = os.stat(path)
+        version = (st.st_mtime_ns, st.st_size)
+    else:
+        version = (source.mtime_ns, source.size)
+    key = ("file", encoding, str(path), *version)
+    compressed = COMPRESSION_CACHE.get(key)
+    if compressed is None:
+        with source.open() if source is not None else open(path, "rb") as f:
+            compressed = compress(f.read(), encoding)
+        COMPRESSION_CACHE.put(key, compressed)
+    return compressed
+
+
+def fresh_sidecar(path: pathlib.Path, encoding: str) -> pathlib.Path | None:
+    """Returns the precompressed version of the file if there is one that is at least
+    as recent as the file itself"""
+    suffix = SIDECAR_SUFFIXES.get(encoding)
+    if suffix is None:
+        return None
+    sidecar = path.with_name(path.name + suffix)
+    try:
+        if os.stat(sidecar).st_mtime_ns >= os.stat(path).st_mtime_ns:
+            return sidecar
+    except FileNotFoundError:
+        pass
+    return None
+
+
+def cached_sidecar(source: FileInfo, encoding: str) -> FileInfo | None:
+    """Same as `fresh_sidecar` through the file cache"""
+    suffix = SIDECAR_SUFFIXES.get(encoding)
+    if suffix is None:
+        return None
+    sidecar = FILE_CACHE.lookup(source.path.with_name(source.path.name + suffix))
+    if sidecar is not None and sidecar.mtime_ns >= source.mtime_ns:
+        return sidecar
+    return None
@@ -0,0 +1,47 @@
+"""Conditional GET (RFC 9110 section 13).
+
+A client that already has a version of a file sends back its validators, the
+ETag in `If-None-Match` or the Last-Modified date in `If-Modified-Since`, and gets
+a 304 without body if that version is still current. `If-None-Match` takes
+precedence: `If-Modified-Since` is ignored when both are sent.
+"""
+
+import email.utils
+from datetime import timezone
+
+from app.headers import Headers
+
+
+def opaque_tag(etag: str) -> str:
+    return etag[2:] if etag.startswith("W/") else etag
+
+
+def none_match(if_none_match: str, etag: str) -> bool:
+    """Whether the current `etag` is one of those of the header, with the weak
+    comparison: `W/"x"` matches `"x"`"""
+    if if_none_match.strip() == "*":
+        return True
+    current = opaque_tag(etag)
+    return any(opaque_tag(tag.strip()) == current for tag in if_none_match.split(","))
+
+
+def not_modified_since(if_modified_since: str, mtime: float) -> bool:
+    """False for an invalid date: the header is then ignored"""
+    try:
+        date = email.utils.parsedate_to_datetime(if_modified_since)
+    except (TypeError, ValueError):
+        return False
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=timezone.utc)
+    # http dates have a one second resolution
+    return int(mtime) <= date.timestamp()
+
+
+def is_not_modified(headers: Headers, etag: str, mtime: float) -> bool:
+    if_none_match = headers.get("If-None-Match")
+    if if_none_match is not None:
+        return none_match(if_none_match, etag)
+    if_modified_since = headers.get("If-Modified-Since")
+    if if_modified_since is not None:
+        return not_modified_since(if_modified_since, mtime)
+    return False
@@ -0,0 +1,99 @@
+import time
+from dataclasses import dataclass
+
+
+@dataclass
+class ServerConfig:
+    """Settings shared by all server modes. Must stay picklable as it is sent to
+    the workers of the multiprocessing pool"""
+
+    # seconds a persistent connection can stay idle before being closed
+    keep_alive_timeout: float = 5.0
+    # seconds a client has to send the whole head of a request once it started,
+    # may stay silent while sending a body, and may not read while a response is
+    # sent to it. The first two are answered with a 408, the connection is closed
+    header_timeout: float = 10.0
+    body_timeout: float = 30.0
+    write_timeout: float = 30.0
+    # longer request lines get a 414, larger heads a 431 (0: no limit)
+    max_request_line: int = 8 * 1024
+    max_header_size: int = 64 * 1024
+    # connections open at once from a single IP, beyond which new ones get a 503
+    # (0: no limit)
+    max_connections_per_ip: int = 0
+    # the connection is closed after this many requests (0: no limit)
+    max_requests_per_connection: int = 100
+    # requests announcing a larger body are rejected with a 413 (0: no limit)
+    max_body_size: int = 1024**3
+    # total size in bytes of the compressed bodies kept in memory
+    compression_cache_size: int = 64 * 1024**2
+    # nb of served files whose metadata and descriptor are kept (0: none), and
+    # seconds during which they are trusted without checking the file again
+    file_cache_size: int = 256
+    file_cache_ttl: float = 1.0
+    # total size in bytes of the serialised responses of the cached routes (0:
+    # none), and seconds during which a response is served again
+    response_cache_size: int = 4 * 1024**2
+    response_cache_ttl: float = 1.0
+    # serve `name.gz` instead of compressing `name` when it is up to date
+    precompressed_sidecars: bool = False
+    # files larger than this are compressed on the fly and sent chunked rather
+    # than compressed in memory (0: never)
+    stream_compression_threshold: int = 1024**2
+    # prefork mode: nb of worker processes (0: nb of cpus) and the engine they run
+    workers: int = 0
+    prefork_engine: str = "thread-pool"
+    # thread pool mode: nb of worker threads and of accepted connections waiting
+    # for one (0: no limit). Connections beyond get a 503 asking to retry after
+    # `retry_after` seconds
+    threads: int = 4
+    max_pending_connections: int = 64
+    retry_after: int = 1
+    # event loop engines: nb of threads doing their disk io and compression, 0 to
+    # do it on the loop
+    io_threads: int = 4
+    # asyncio engine: serve HTTP/2 to the clients starting with its preface or
+    # asking to upgrade to h2c, with up to `http2_max_streams` requests in
+    # progress at once per connection
+    http2: bool = True
+    http2_max_streams: int = 100
+    # parser of the HTTP/1 request heads, see `app.http.ParserEngine`: "fast" or
+    # "pyparsing", the reference grammar, slower
+    parser: str = "fast"
+    # seconds left to the connections in progress to finish on graceful shutdown
+    shutdown_timeout: float = 10.0
+    # multiprocessing and prefork modes: directory where each process writes its
+    # metrics every `metrics_flush_interval` seconds for /metrics to merge them
+    # (None: a temporary directory)
+    metrics_dir: str | None = None
+    metrics_flush_interval: float = 1.0
+    # profiling toggled by SIGUSR1 (see app.profiling): "cprofile" profiles one
+    # request in `profile_sample_every`, "sampler" samples the stacks of all the
+    # threads. Dumps go to `profile_dir` (None: the temporary directory)
+    profile_mode: str = "cprofile"
+    profile_sample_every: int = 100
+    profile_dir: str | None = None
+    # serve POST /admin/profile/start and /stop
+    admin_routes: bool = False
+
+    def allows_more_requests(self, nb_requests: int) -> bool:
+        """Whether a connection that already served `nb_requests` can stay open"""
+        return (
+            not self.max_requests_per_connection
+            or nb_requests < self.max_requests_per_connection
+        )
+
+    def head_time_left(self, started_at: float | None) -> float:
+        """Seconds to wait for more of the head of the next request, whose first
+        bytes came at `started_at` (`time.perf_counter`, None if none came yet)"""
+        if started_at is None:
+            return self.keep_alive_timeout
+        return self.header_timeout - (time.perf_counter() - started_at)
+
+    def allows_body_size(self, size: int) -> bool:
+        return not self.max_body_size or size <= self.max_body_size
+
+    def streams_compression(self, size: int) -> bool:
+        return bool(self.stream_compression_threshold) and (
+            size >= self.stream_compression_threshold
+        )
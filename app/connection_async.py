@@ -1,36 +1,336 @@
 """Alternative way to handle connections in an async way (for use with asyncio for ex)"""
 
 import asyncio
-import socket
-from app.http import HttpRequest
-from app.api import handle_req
+import time
+from app.config import ServerConfig
+from app.framing import (
+    InvalidRequest,
+    RequestFramer,
+    RequestTimeout,
+    RequestTooLarge,
+)
+from app.http import (
+    CompositeBody,
+    FileBody,
+    HttpMethod,
+    HttpRequest,
+    HttpResponse,
+    HttpStatus,
+    StreamBody,
+)
+from app.api import FileUpload, handle_req_async, open_body_sink, refusal
+from app.http2 import (
+    PREFACE,
+    PREFACE_HEAD,
+    H2Connection,
+    switching_protocols,
+    upgrade_settings,
+    wants_h2c_upgrade,
+)
+from app.metrics import METRICS, UNMATCHED
+from app.offload import run_blocking
 
+RECV_BUF_LEN = 65536
+# files are handed to `loop.sendfile` in slices of this size, each of which must be
+# sent within the write timeout
+SENDFILE_SLICE = 1024**2
 
-async def receive_msg_async(reader: asyncio.StreamReader, buf_len: int = 1024) -> bytes:
-    chunks = []
-    while True:
-        chunk = await reader.read(1024)
-        if not chunk:
-            break
-        chunks.append(chunk)
-        if len(chunk) < buf_len:
-            break
-    return b"".join(chunks)
 
+async def receive_into_async(
+    reader: asyncio.StreamReader,
+    framer: RequestFramer,
+    buf_len: int = RECV_BUF_LEN,
+    timeout: float | None = None,
+) -> bool:
+    """Feeds the result of one read to the framer. Returns False if the client closed
+    the connection or stayed idle for more than `timeout` seconds. Raises
+    `RequestTimeout` if the timeout happens in the middle of a request"""
+    try:
+        chunk = await asyncio.wait_for(reader.read(buf_len), timeout)
+    except TimeoutError:
+        if framer.started_at is None:
+            return False
+        raise RequestTimeout() from None
+    if not chunk:
+        return False
+    METRICS.count_bytes_in(len(chunk))
+    framer.feed(chunk)
+    return True
 
-async def send_msg_async(writer: asyncio.StreamWriter, msg: bytes):
+
+async def receive_msg_async(
+    reader: asyncio.StreamReader,
+    framer: RequestFramer,
+    buf_len: int = RECV_BUF_LEN,
+    timeout: float | None = None,
+) -> bytes:
+    """Reads from the stream until the framer holds a complete request.
+    Returns an empty message if the connection is lost before that"""
+    while not framer.message_complete():
+        if not await receive_into_async(reader, framer, buf_len, timeout):
+            return b""
+    return framer.pop_message()
+
+
+async def receive_head_async(
+    reader: asyncio.StreamReader,
+    framer: RequestFramer,
+    buf_len: int = RECV_BUF_LEN,
+    config: ServerConfig = ServerConfig(),
+) -> bytes:
+    """Same as `receive_msg_async` but stops as soon as the headers are complete.
+    Same timeouts as `receive_head`"""
+    while not framer.head_complete():
+        timeout = config.head_time_left(framer.started_at)
+        if timeout <= 0:
+            raise RequestTimeout()
+        if not await receive_into_async(reader, framer, buf_len, timeout):
+            return b""
+    return framer.pop_head()
+
+
+async def receive_body_async(
+    reader: asyncio.StreamReader,
+    framer: RequestFramer,
+    buf_len: int = RECV_BUF_LEN,
+    timeout: float | None = None,
+) -> memoryview | None:
+    """Buffers the whole body of the request whose head was popped.
+    Returns None if the connection is lost before the end of the body"""
+    while not framer.message_complete():
+        if not await receive_into_async(reader, framer, buf_len, timeout):
+            return None
+    return framer.pop_body()
+
+
+async def stream_body_async(
+    reader: asyncio.StreamReader,
+    framer: RequestFramer,
+    sink: FileUpload,
+    buf_len: int = RECV_BUF_LEN,
+    timeout: float | None = None,
+) -> bool:
+    """Hands the body of the request whose head was popped to the sink chunk by chunk
+    as it is received. The writes to disk happen in the io threads. Returns False
+    if the connection is lost before the end"""
+    remaining = framer.content_length
+    while remaining:
+        chunk = framer.pop_body_chunk()
+        if chunk:
+            await run_blocking(sink.write, chunk)
+            remaining -= len(chunk)
+        elif not await receive_into_async(reader, framer, buf_len, timeout):
+            return False
+    return True
+
+
+async def send_msg_async(
+    writer: asyncio.StreamWriter, msg: bytes, timeout: float | None = None
+):
+    """Raises TimeoutError if the client does not read it within `timeout`"""
+    METRICS.count_bytes_out(len(msg))
     writer.write(msg)
-    await writer.drain()
+    await asyncio.wait_for(writer.drain(), timeout)
+
+
+async def send_buffers_async(
+    writer: asyncio.StreamWriter, buffers: list[bytes], timeout: float | None = None
+):
+    """Gather write, the buffers are not concatenated by us"""
+    METRICS.count_bytes_out(sum(map(len, buffers)))
+    writer.writelines(buffers)
+    await asyncio.wait_for(writer.drain(), timeout)
+
+
+async def sendfile_in_slices(
+    transport: asyncio.Transport,
+    file,
+    offset: int,
+    count: int,
+    timeout: float | None = None,
+) -> int:
+    """`loop.sendfile` raising TimeoutError if a `SENDFILE_SLICE` of the file takes
+    more than `timeout` seconds to be sent, rather than the whole file"""
+    loop = asyncio.get_running_loop()
+    sent = 0
+    while sent < count:
+        nb_bytes = await asyncio.wait_for(
+            loop.sendfile(
+                transport,
+                file,
+                offset=offset + sent,
+                count=min(count - sent, SENDFILE_SLICE),
+            ),
+            timeout,
+        )
+        if not nb_bytes:
+            raise ConnectionError("File truncated while sent")
+        sent += nb_bytes
+    return sent
+
+
+async def send_file_async(
+    writer: asyncio.StreamWriter, body: FileBody, timeout: float | None = None
+):
+    """The StreamWriter exposes a transport rather than a socket, so the transport
+    flavour of sock_sendfile is used: os.sendfile when the event loop supports it,
+    chunked reads otherwise"""
+    with body.open() as f:
+        METRICS.count_bytes_out(
+            await sendfile_in_slices(
+                writer.transport, f, body.offset, body.count, timeout
+            )
+        )
+
+
+async def send_chunked_async(
+    writer: asyncio.StreamWriter, body: StreamBody, timeout: float | None = None
+):
+    """Waits for each chunk to be flushed before producing the next one, so that a
+    slow client does not make the whole body pile up in the transport buffer"""
+    try:
+        if body.is_async:
+            async for chunk in body.chunks:
+                if chunk:
+                    await send_msg_async(writer, body.encode_chunk(chunk), timeout)
+        else:
+            for chunk in body.chunks:
+                if chunk:
+                    await send_msg_async(writer, body.encode_chunk(chunk), timeout)
+        await send_msg_async(writer, body.LAST_CHUNK, timeout)
+    finally:
+        await body.aclose()
+
+
+async def send_response_async(
+    writer: asyncio.StreamWriter, res: HttpResponse, timeout: float | None = None
+):
+    """Raises TimeoutError if the client stops reading for more than `timeout`"""
+    if isinstance(res.body, FileBody) and res.body.count:
+        await send_buffers_async(writer, res.head_buffers(), timeout)
+        await send_file_async(writer, res.body, timeout)
+    elif isinstance(res.body, CompositeBody):
+        await send_buffers_async(writer, res.head_buffers(), timeout)
+        for part in res.body.parts:
+            if isinstance(part, FileBody):
+                await send_file_async(writer, part, timeout)
+            else:
+                await send_msg_async(writer, part, timeout)
+    elif isinstance(res.body, StreamBody):
+        await send_buffers_async(writer, res.head_buffers(), timeout)
+        await send_chunked_async(writer, res.body, timeout)
+    else:
+        await send_buffers_async(writer, res.to_buffers(), timeout)
 
 
 async def handle_connection_async(
-    reader: asyncio.StreamReader, writer: asyncio.StreamWriter, directory: str | None
+    reader: asyncio.StreamReader,
+    writer: asyncio.StreamWriter,
+    directory: str | None,
+    config: ServerConfig = ServerConfig(),
 ):
-    """Synchronous way to handle one connection"""
-
-    msg = await receive_msg_async(reader)
-    req = HttpRequest.from_bytes(msg)
-    res = handle_req(req, directory=directory)
-    await send_msg_async(writer, msg=res.to_bytes())
-    writer.close()
-    await writer.wait_closed()
+    """Asynchronous way to handle one connection. Same keep-alive, pipelining and
+    timeout rules as `handle_connection`.
+
+    Unless `config.http2` is off, the connection switches to HTTP/2 when it starts
+    with the HTTP/2 preface (prior knowledge) or on a request to upgrade to h2c,
+    see `app.http2`"""
+    framer = RequestFramer(config.max_request_line, config.max_header_size)
+    nb_requests = 0
+    keep_alive = True
+    try:
+        while keep_alive:
+            head = await receive_head_async(reader, framer=framer, config=config)
+            if not head:
+                break
+            if head == PREFACE_HEAD and config.http2 and not nb_requests:
+                h2 = H2Connection(reader, writer, directory, config, framer.buffer)
+                await h2.serve(preface=PREFACE[len(PREFACE_HEAD) :])
+                break
+            received_from = framer.started_at
+            start = time.perf_counter()
+            req = HttpRequest.from_bytes(head, config.parser)
+            METRICS.observe("parse", time.perf_counter() - start)
+            nb_requests += 1
+
+            if config.http2 and not framer.content_length and wants_h2c_upgrade(req):
+                # the request is answered as the first stream of the connection
+                settings = upgrade_settings(req)
+                await send_msg_async(
+                    writer, switching_protocols().to_bytes(), config.write_timeout
+                )
+                h2 = H2Connection(reader, writer, directory, config, framer.buffer)
+                await h2.serve(upgrade=req, settings=settings)
+                break
+
+            if not config.allows_body_size(framer.content_length):
+                # the body is never read so the connection can not be reused
+                res = HttpResponse.empty(status=HttpStatus.PayloadTooLarge413)
+                res.set_keep_alive(False, req.version)
+                METRICS.count_request(UNMATCHED, res.status.code)
+                await send_response_async(writer, res, config.write_timeout)
+                break
+
+            if req.expects_continue() and framer.content_length:
+                continue_res = HttpResponse.informational(HttpStatus.Continue100)
+                await send_msg_async(
+                    writer, continue_res.to_bytes(), config.write_timeout
+                )
+
+            sink = (
+                await run_blocking(open_body_sink, req, directory)
+                if req.method == HttpMethod.POST
+                else None
+            )
+            if sink:
+                try:
+                    completed = await stream_body_async(
+                        reader,
+                        framer=framer,
+                        sink=sink,
+                        timeout=config.body_timeout,
+                    )
+                except BaseException:
+                    sink.abort()
+                    raise
+                if not completed:
+                    sink.abort()
+                    break
+                METRICS.observe("receive", time.perf_counter() - received_from)
+                res = await run_blocking(sink.finish)
+            else:
+                body = await receive_body_async(
+                    reader, framer=framer, timeout=config.body_timeout
+                )
+                if body is None:
+                    break
+                start = time.perf_counter()
+                METRICS.observe("receive", start - received_from)
+                req.body = body
+                res = await handle_req_async(req, directory=directory, config=config)
+                METRICS.observe("handle", time.perf_counter() - start)
+
+            keep_alive = req.wants_keep_alive() and config.allows_more_requests(
+                nb_requests
+            )
+            res.set_keep_alive(keep_alive, req.version)
+            start = time.perf_counter()
+            await send_response_async(writer, res, config.write_timeout)
+            METRICS.observe("send", time.perf_counter() - start)
+    except (RequestTooLarge, InvalidRequest, RequestTimeout) as e:
+        try:
+            await send_response_async(writer, refusal(e), config.write_timeout)
+        except (ConnectionError, TimeoutError):
+            writer.transport.abort()
+    except TimeoutError:
+        print("Client not reading its response, closing the connection")
+        # closing would wait for the buffered data to be sent
+        writer.transport.abort()
+    except ConnectionError as e:
+        print(f"Connection error: {e}")
+    finally:
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except ConnectionError:
+            pass
@@ -0,0 +1,401 @@
+"""Low level asyncio engine built on `asyncio.Protocol` instead of streams.
+
+Received bytes go straight from `data_received` into the request framer, and
+requests whose response is in memory are answered synchronously with
+`transport.write`: no task, no StreamReader buffering and no `drain()` per request.
+A task is only created for the handlers doing disk io, which run in the io
+threads (see `app.offload`), and to send responses that need to wait on the event
+loop (file, streamed and multipart bodies); reading is paused meanwhile so that
+pipelined requests keep their order.
+
+A single timer per connection bounds what it waits for: the keep-alive timeout
+for the next request, the header timeout for the rest of a head, the body timeout
+between two reads of a body. Writes are bounded by the write timeout while the
+transport asks to pause them.
+"""
+
+import asyncio
+import time
+from typing import Callable
+from app.admission import ConnectionLimiter, peer_ip, service_unavailable
+from app.api import (
+    FileUpload,
+    call_in_io_thread,
+    open_body_sink,
+    prepare_req,
+    profiled,
+    refusal,
+)
+from app.config import ServerConfig
+from app.connection_async import sendfile_in_slices
+from app.framing import (
+    InvalidRequest,
+    RequestFramer,
+    RequestTimeout,
+    RequestTooLarge,
+)
+from app.http import (
+    CompositeBody,
+    FileBody,
+    HttpRequest,
+    HttpResponse,
+    HttpStatus,
+    StreamBody,
+)
+from app.metrics import METRICS, UNMATCHED
+
+
+class HttpProtocol(asyncio.Protocol):
+    def __init__(
+        self,
+        directory: str | None,
+        config: ServerConfig = ServerConfig(),
+        limiter: ConnectionLimiter | None = None,
+    ):
+        self.directory = directory
+        self.config = config
+        # connections per IP, shared by the connections of a server
+        self.limiter = limiter or ConnectionLimiter(0)
+        self.ip: str | None = None
+        self.framer = RequestFramer(config.max_request_line, config.max_header_size)
+        self.transport: asyncio.Transport | None = None
+        self.nb_requests = 0
+        # request whose head was parsed, waiting for the end of its body
+        self.pending_req: HttpRequest | None = None
+        # perf_counter when its first bytes were received
+        self.received_from = 0.0
+        # upload in progress and the nb of its body bytes still to come
+        self.sink: FileUpload | None = None
+        self.sink_remaining = 0
+        # task sending a response that can not be written synchronously
+        self.send_task: asyncio.Task | None = None
+        self.closing = False
+        self.read_timer: asyncio.TimerHandle | None = None
+        self.write_timer: asyncio.TimerHandle | None = None
+        self.can_write = asyncio.Event()
+        self.can_write.set()
+
+    # asyncio callbacks ###########################################
+
+    def connection_made(self, transport: asyncio.Transport):
+        self.transport = transport
+        ip = peer_ip(transport.get_extra_info("peername"))
+        if not self.limiter.acquire(ip):
+            transport.write(service_unavailable(self.config.retry_after))
+            self.closing = True
+            transport.close()
+            return
+        self.ip = ip
+        self.reset_read_timer()
+
+    def data_received(self, data: bytes):
+        if self.closing:
+            return
+        METRICS.count_bytes_in(len(data))
+        try:
+            self.framer.feed(data)
+        except RequestTooLarge as e:
+            self.refuse(e)
+            return
+        self.process()
+        # for what is awaited once the buffered requests are handled
+        if not self.closing:
+            self.reset_read_timer()
+
+    def eof_received(self):
+        # close once the responses in progress are sent
+        self.closing = True
+        if self.send_task is None:
+            self.transport.close()
+        return True
+
+    def connection_lost(self, exc: Exception | None):
+        self.closing = True
+        if self.ip is not None:
+            self.limiter.release(self.ip)
+            self.ip = None
+        for timer in (self.read_timer, self.write_timer):
+            if timer is not None:
+                timer.cancel()
+        if self.sink is not None:
+            self.sink.abort()
+            self.sink = None
+        if self.send_task is not None:
+            self.send_task.cancel()
+        self.can_write.set()
+
+    def pause_writing(self):
+        self.can_write.clear()
+        self.write_timer = asyncio.get_running_loop().call_later(
+            self.config.write_timeout, self.on_write_timeout
+        )
+
+    def resume_writing(self):
+        self.can_write.set()
+        if self.write_timer is not None:
+            self.write_timer.cancel()
+            self.write_timer = None
+        if self.send_task is None and not self.closing:
+            # requests left waiting by `process`
+            self.transport.resume_reading()
+            self.process()
+
+    # timeouts ####################################################
+
+    def waits_for_body(self) -> bool:
+        return self.pending_req is not None or self.sink is not None
+
+    def reset_read_timer(self):
+        if self.read_timer is not None:
+            self.read_timer.cancel()
+        if self.send_task is not None:
+            # checked again once the response is sent
+            delay = self.config.keep_alive_timeout
+        elif self.waits_for_body():
+            delay = self.config.body_timeout
+        else:
+            delay = self.config.head_time_left(self.framer.started_at)
+        self.read_timer = asyncio.get_running_loop().call_later(
+            max(delay, 0), self.on_read_timeout
+        )
+
+    def on_read_timeout(self):
+        self.read_timer = None
+        if self.send_task is not None:
+            self.reset_read_timer()
+        elif self.waits_for_body() or self.framer.started_at is not None:
+            self.refuse(RequestTimeout())
+        else:
+            # idle persistent connection
+            self.closing = True
+            self.transport.close()
+
+    def on_write_timeout(self):
+        print("Client not reading its responses, closing the connection")
+        self.write_timer = None
+        self.closing = True
+        # closing would wait for the buffered data to be sent
+        self.transport.abort()
+
+    def refuse(self, error: RequestTooLarge | InvalidRequest | RequestTimeout):
+        self.closing = True
+        if self.send_task is not None:
+            # in the middle of another response
+            self.transport.abort()
+            return
+        self.writelines(refusal(error).to_buffers())
+        self.transport.close()
+
+    # request processing ##########################################
+
+    def process(self):
+        """Handles every request that the buffered bytes allow, in order. Stops
+        while the client does not read the responses"""
+        while not self.closing and self.send_task is None:
+            if not self.can_write.is_set():
+                self.transport.pause_reading()
+                return
+            if self.sink is not None:
+                if not self.stream_to_sink():
+                    return
+                METRICS.observe("receive", time.perf_counter() - self.received_from)
+                res, self.sink = self.sink.finish(), None
+                req, self.pending_req = self.pending_req, None
+                self.respond(req, res)
+                continue
+
+            if self.pending_req is None:
+                if not self.framer.head_complete():
+                    return
+                if not self.start_request():
+                    return
+                continue
+
+            if not self.framer.message_complete():
+                return
+            req, self.pending_req = self.pending_req, None
+            start = time.perf_counter()
+            METRICS.observe("receive", start - self.received_from)
+            req.body = self.framer.pop_body()
+            call, blocks = prepare_req(req, self.directory, self.config)
+            if blocks:
+                # the next requests wait for this one
+                self.transport.pause_reading()
+                self.send_task = asyncio.get_running_loop().create_task(
+                    self.handle_in_io_thread(req, call, start)
+                )
+                return
+            res = profiled(call)
+            METRICS.observe("handle", time.perf_counter() - start)
+            self.respond(req, res)
+
+    def start_request(self) -> bool:
+        """Parses the head of the next request. Returns False if the connection
+        must not process anything else"""
+        self.received_from = self.framer.started_at
+        try:
+            head = self.framer.pop_head()
+            start = time.perf_counter()
+            req = HttpRequest.from_bytes(head, self.config.parser)
+        except (RequestTooLarge, InvalidRequest) as e:
+            self.refuse(e)
+            return False
+        METRICS.observe("parse", time.perf_counter() - start)
+        self.nb_requests += 1
+
+        if not self.config.allows_body_size(self.framer.content_length):
+            # the body is never read so the connection can not be reused
+            res = HttpResponse.empty(status=HttpStatus.PayloadTooLarge413)
+            res.set_keep_alive(False, req.version)
+            METRICS.count_request(UNMATCHED, res.status.code)
+            self.writelines(res.to_buffers())
+            self.closing = True
+            self.transport.close()
+            return False
+
+        if req.expects_continue() and self.framer.content_length:
+            continue_res = HttpResponse.informational(HttpStatus.Continue100)
+            self.writelines(continue_res.to_buffers())
+
+        self.pending_req = req
+        sink = open_body_sink(req, directory=self.directory)
+        if sink is not None:
+            self.sink = sink
+            self.sink_remaining = self.framer.content_length
+        return True
+
+    def stream_to_sink(self) -> bool:
+        """Writes the body bytes received so far to the upload. Returns True once the
+        whole body is written"""
+        while self.sink_remaining:
+            chunk = self.framer.pop_body_chunk()
+            if not chunk:
+                return False
+            self.sink.write(chunk)
+            self.sink_remaining -= len(chunk)
+        return True
+
+    def respond(self, req: HttpRequest, res: HttpResponse):
+        keep_alive = req.wants_keep_alive() and self.config.allows_more_requests(
+            self.nb_requests
+        )
+        res.set_keep_alive(keep_alive, req.version)
+
+        if isinstance(res.body, (FileBody, StreamBody, CompositeBody)):
+            self.transport.pause_reading()
+            self.send_task = asyncio.get_running_loop().create_task(
+                self.send_async(res, keep_alive)
+            )
+            return
+
+        start = time.perf_counter()
+        self.writelines(res.to_buffers())
+        METRICS.observe("send", time.perf_counter() - start)
+        if not keep_alive:
+            self.closing = True
+            self.transport.close()
+
+    async def handle_in_io_thread(
+        self, req: HttpRequest, call: Callable[[], HttpResponse], start: float
+    ):
+        """Answers a request whose handler blocks without blocking the event loop"""
+        try:
+            res = await call_in_io_thread(call)
+        except asyncio.CancelledError:
+            return
+        except Exception as e:
+            print(f"Error while handling a request: {e!r}")
+            self.transport.abort()
+            return
+        finally:
+            self.send_task = None
+        METRICS.observe("handle", time.perf_counter() - start)
+
+        self.respond(req, res)
+        if self.send_task is not None:
+            # the response is sent by another task
+            return
+        if self.closing:
+            self.transport.close()
+            return
+        self.transport.resume_reading()
+        # pipelined requests received while the handler was running
+        self.process()
+        if not self.closing:
+            self.reset_read_timer()
+
+    async def send_async(self, res: HttpResponse, keep_alive: bool):
+        start = time.perf_counter()
+        try:
+            self.writelines(res.head_buffers())
+            match res.body:
+                case FileBody():
+                    await self.send_file(res.body)
+                case CompositeBody():
+                    for part in res.body.parts:
+                        if isinstance(part, FileBody):
+                            await self.send_file(part)
+                        else:
+                            await self.write(part)
+                case StreamBody():
+                    await self.send_chunked(res.body)
+        except (ConnectionError, asyncio.CancelledError):
+            self.transport.abort()
+            return
+        finally:
+            self.send_task = None
+        METRICS.observe("send", time.perf_counter() - start)
+
+        if not keep_alive or self.closing:
+            self.closing = True
+            self.transport.close()
+            return
+        self.transport.resume_reading()
+        # pipelined requests received before the response was sent
+        self.process()
+        if not self.closing:
+            self.reset_read_timer()
+
+    def writelines(self, buffers: list[bytes]):
+        METRICS.count_bytes_out(sum(map(len, buffers)))
+        self.transport.writelines(buffers)
+
+    async def write(self, data: bytes):
+        """Waits until the transport can take more, for at most the write timeout
+        (see `pause_writing`)"""
+        METRICS.count_bytes_out(len(data))
+        self.transport.write(data)
+        await self.can_write.wait()
+        if self.transport.is_closing():
+            raise ConnectionError("Connection lost while sending")
+
+    async def send_file(self, body: FileBody):
+        if not body.count:
+            return
+        with body.open() as f:
+            try:
+                METRICS.count_bytes_out(
+                    await sendfile_in_slices(
+                        self.transport,
+                        f,
+                        body.offset,
+                        body.count,
+                        self.config.write_timeout,
+                    )
+                )
+            except TimeoutError:
+                raise ConnectionError("Client not reading the file sent") from None
+
+    async def send_chunked(self, body: StreamBody):
+        try:
+            if body.is_async:
+                async for chunk in body.chunks:
+                    if chunk:
+                        await self.write(body.encode_chunk(chunk))
+            else:
+                for chunk in body.chunks:
+                    if chunk:
+                        await self.write(body.encode_chunk(chunk))
+            await self.write(body.LAST_CHUNK)
+        finally:
+            await body.aclose()
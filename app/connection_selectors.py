@@ -0,0 +1,530 @@
+"""Single threaded engine built on `selectors` (epoll on Linux).
+
+Sockets are non-blocking and each connection owns a read buffer (its request
+framer) and a queue of pending writes. Every readiness event is handled until the
+socket would block (recv until EAGAIN, send until EAGAIN) so the loop never relies
+on being notified again for data it did not consume.
+
+A connection is either reading or writing, never both: while responses are being
+sent it is only registered for EVENT_WRITE, so that a client pipelining faster
+than it reads can not make the server buffer without bound.
+
+Idle keep-alive connections cost a buffer and a selector entry, not a thread,
+which makes this mode suited to many mostly idle clients. What a connection may
+wait for is bounded by the timeout of its state: keep-alive, header, body or
+write timeout (see `SelectorConnection.timed_out`).
+"""
+
+import collections
+import itertools
+import os
+import selectors
+import socket
+import time
+from typing import Iterator
+
+from app.admission import ConnectionLimiter, peer_ip, reject, service_unavailable
+from app.api import FileUpload, handle_req, open_body_sink, refusal
+from app.config import ServerConfig
+from app.framing import (
+    InvalidRequest,
+    RequestFramer,
+    RequestTimeout,
+    RequestTooLarge,
+)
+from app.http import (
+    CompositeBody,
+    FileBody,
+    HttpRequest,
+    HttpResponse,
+    HttpStatus,
+    StreamBody,
+)
+from app.metrics import METRICS, UNMATCHED
+from app.profiling import PROFILER
+from app.prefork import Shutdown
+
+RECV_BUF_LEN = 65536
+# max nb of buffers of a single sendmsg call
+IOV_MAX = 1024
+
+
+class FileSlice:
+    """Part of a file still to be sent with `os.sendfile`"""
+
+    def __init__(self, body: FileBody):
+        self.file = body.open()
+        self.offset = body.offset
+        self.remaining = body.count
+
+    def close(self):
+        self.file.close()
+
+
+class ChunkedStream:
+    """StreamBody being sent, encoded one chunk at a time when the socket can take
+    more"""
+
+    def __init__(self, body: StreamBody):
+        if body.is_async:
+            raise TypeError("The selectors engine can not send an async stream")
+        self.body = body
+        self.chunks: Iterator[bytes] = iter(body.chunks)
+        self.done = False
+
+    def next_chunk(self) -> bytes | None:
+        """None once the last chunk was produced"""
+        if self.done:
+            return None
+        for chunk in self.chunks:
+            if chunk:
+                return self.body.encode_chunk(chunk)
+        self.done = True
+        return self.body.LAST_CHUNK
+
+    def close(self):
+        self.body.close()
+
+
+Outgoing = memoryview | FileSlice | ChunkedStream
+
+
+class SelectorConnection:
+    def __init__(
+        self,
+        sock: socket.socket,
+        directory: str | None,
+        config: ServerConfig,
+        ip: str | None = None,
+    ):
+        self.sock = sock
+        self.directory = directory
+        self.config = config
+        # set when counted by the connection limiter of the server
+        self.ip = ip
+        self.framer = RequestFramer(config.max_request_line, config.max_header_size)
+        self.out: collections.deque[Outgoing] = collections.deque()
+        self.nb_requests = 0
+        # request whose head was parsed, waiting for the end of its body
+        self.pending_req: HttpRequest | None = None
+        # perf_counter when its first bytes were received
+        self.received_from = 0.0
+        # upload in progress and the nb of its body bytes still to come
+        self.sink: FileUpload | None = None
+        self.sink_remaining = 0
+        # set when no other request must be processed: the connection is closed
+        # once `out` is flushed
+        self.closing = False
+        # set when the client is done sending
+        self.eof = False
+        self.closed = False
+
+    @property
+    def events(self) -> int:
+        return selectors.EVENT_WRITE if self.out else selectors.EVENT_READ
+
+    def on_readable(self):
+        """Reads until the socket would block, answering the requests as they
+        complete. Stops reading as soon as a response can not be sent right away"""
+        while not self.out and not self.closing and not self.closed:
+            try:
+                data = self.sock.recv(RECV_BUF_LEN)
+            except BlockingIOError:
+                return
+            if not data:
+                # answer what is buffered then close
+                self.eof = True
+            else:
+                METRICS.count_bytes_in(len(data))
+                try:
+                    self.framer.feed(data)
+                except RequestTooLarge as e:
+                    self.refuse(e)
+                    return
+            self.process()
+            if self.eof:
+                return
+            if (
+                self.waits_for_head()
+                and self.config.head_time_left(self.framer.started_at) <= 0
+            ):
+                # a head sent a few bytes at a time
+                self.refuse(RequestTimeout())
+                return
+
+    def on_writable(self):
+        """Sends until the socket would block. Requests that were pipelined while
+        the responses were being sent are processed once everything is flushed"""
+        if self.flush():
+            self.process()
+
+    def process(self):
+        """Handles every request that the buffered bytes allow, in order"""
+        while not self.out and not self.closing and not self.closed:
+            if self.sink is not None:
+                if not self.stream_to_sink():
+                    break
+                METRICS.observe("receive", time.perf_counter() - self.received_from)
+                res, self.sink = self.sink.finish(), None
+                req, self.pending_req = self.pending_req, None
+                self.respond(req, res)
+            elif self.pending_req is None:
+                if not self.framer.head_complete() or not self.start_request():
+                    break
+            else:
+                if not self.framer.message_complete():
+                    break
+                req, self.pending_req = self.pending_req, None
+                start = time.perf_counter()
+                METRICS.observe("receive", start - self.received_from)
+                req.body = self.framer.pop_body()
+                with PROFILER.request():
+                    res = handle_req(req, self.directory, self.config)
+                METRICS.observe("handle", time.perf_counter() - start)
+                self.respond(req, res)
+            self.flush()
+
+        if (self.closing or self.eof) and not self.out:
+            self.close()
+
+    def waits_for_head(self) -> bool:
+        return (
+            not self.closing
+            and not self.closed
+            and self.pending_req is None
+            and self.sink is None
+            and not self.out
+            and self.framer.started_at is not None
+        )
+
+    def timed_out(self, last_active: float, now: float) -> bool:
+        """Whether the connection waited too long for what its state waits for,
+        `last_active` and `now` being `time.monotonic` values"""
+        if self.out:
+            return now - last_active > self.config.write_timeout
+        if self.pending_req is not None or self.sink is not None:
+            return now - last_active > self.config.body_timeout
+        if self.framer.started_at is not None:
+            return self.config.head_time_left(self.framer.started_at) <= 0
+        return now - last_active > self.config.keep_alive_timeout
+
+    def on_timeout(self):
+        """A request in progress gets a 408, an idle connection or a client not
+        reading its responses is closed"""
+        if self.out or self.closing or self.framer.started_at is None:
+            self.close()
+        else:
+            self.refuse(RequestTimeout())
+
+    def refuse(self, error: RequestTooLarge | InvalidRequest | RequestTimeout):
+        """Answers with an error then closes, whatever was buffered"""
+        if self.sink is not None:
+            self.sink.abort()
+            self.sink = None
+        self.pending_req = None
+        self.queue(refusal(error))
+        self.closing = True
+        if self.flush():
+            self.close()
+
+    def start_request(self) -> bool:
+        """Parses the head of the next request. Returns False if the connection
+        must not process anything else"""
+        self.received_from = self.framer.started_at
+        try:
+            head = self.framer.pop_head()
+            start = time.perf_counter()
+            req = HttpRequest.from_bytes(head, self.config.parser)
+        except (RequestTooLarge, InvalidRequest) as e:
+            self.refuse(e)
+            return False
+        METRICS.observe("parse", time.perf_counter() - start)
+        self.nb_requests += 1
+
+        if not self.config.allows_body_size(self.framer.content_length):
+            # the body is never read so the connection can not be reused
+            res = HttpResponse.empty(status=HttpStatus.PayloadTooLarge413)
+            res.set_keep_alive(False, req.version)
+            METRICS.count_request(UNMATCHED, res.status.code)
+            self.queue(res)
+            self.closing = True
+            return False
+
+        if req.expects_continue() and self.framer.content_length:
+            continue_res = HttpResponse.informational(HttpStatus.Continue100)
+            self.queue_buffers(continue_res.to_buffers())
+
+        self.pending_req = req
+        sink = open_body_sink(req, directory=self.directory)
+        if sink is not None:
+            self.sink = sink
+            self.sink_remaining = self.framer.content_length
+        return True
+
+    def stream_to_sink(self) -> bool:
+        """Writes the body bytes received so far to the upload. Returns True once the
+        whole body is written"""
+        while self.sink_remaining:
+            chunk = self.framer.pop_body_chunk()
+            if not chunk:
+                return False
+            self.sink.write(chunk)
+            self.sink_remaining -= len(chunk)
+        return True
+
+    def respond(self, req: HttpRequest, res: HttpResponse):
+        keep_alive = req.wants_keep_alive() and self.config.allows_more_requests(
+            self.nb_requests
+        )
+        res.set_keep_alive(keep_alive, req.version)
+        # the first send is attempted right after, by `process`: only the
+        # serialization is timed
+        start = time.perf_counter()
+        self.queue(res)
+        METRICS.observe("send", time.perf_counter() - start)
+        if not keep_alive:
+            self.closing = True
+
+    def queue_buffers(self, buffers: list[bytes]):
+        self.out.extend(memoryview(buf) for buf in buffers if buf)
+
+    def queue(self, res: HttpResponse):
+        match res.body:
+            case FileBody():
+                self.queue_buffers(res.head_buffers())
+                self.out.append(FileSlice(res.body))
+            case CompositeBody():
+                self.queue_buffers(res.head_buffers())
+                for part in res.body.parts:
+                    if isinstance(part, FileBody):
+                        self.out.append(FileSlice(part))
+                    else:
+                        self.queue_buffers([part])
+            case StreamBody():
+                self.queue_buffers(res.head_buffers())
+                self.out.append(ChunkedStream(res.body))
+            case _:
+                self.queue_buffers(res.to_buffers())
+
+    def send_buffers(self):
+        """Gather write of the in-memory buffers at the front of `out`"""
+        views = list(
+            itertools.islice(
+                itertools.takewhile(
+                    lambda item: isinstance(item, memoryview), self.out
+                ),
+                IOV_MAX,
+            )
+        )
+        sent = self.sock.sendmsg(views)
+        METRICS.count_bytes_out(sent)
+        while self.out and isinstance(self.out[0], memoryview):
+            if sent < len(self.out[0]):
+                self.out[0] = self.out[0][sent:]
+                return
+            sent -= len(self.out.popleft())
+
+    def flush(self) -> bool:
+        """Returns True once all the pending writes are sent"""
+        try:
+            while self.out:
+                item = self.out[0]
+                match item:
+                    case memoryview():
+                        self.send_buffers()
+                        continue
+                    case FileSlice():
+                        if item.remaining:
+                            sent = os.sendfile(
+                                self.sock.fileno(),
+                                item.file.fileno(),
+                                item.offset,
+                                item.remaining,
+                            )
+                            if not sent:
+                                raise ConnectionError("File truncated while sent")
+                            METRICS.count_bytes_out(sent)
+                            item.offset += sent
+                            item.remaining -= sent
+                            if item.remaining:
+                                continue
+                        item.close()
+                    case ChunkedStream():
+                        chunk = item.next_chunk()
+                        if chunk is not None:
+                            # sent before asking the stream for the next one
+                            self.out.appendleft(memoryview(chunk))
+                            continue
+                        item.close()
+                self.out.popleft()
+        except BlockingIOError:
+            return False
+        return True
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self.sink is not None:
+            self.sink.abort()
+            self.sink = None
+        while self.out:
+            item = self.out.popleft()
+            if not isinstance(item, memoryview):
+                item.close()
+        self.sock.close()
+
+
+class SelectorServer:
+    """Event loop of the selectors mode. Connections are kept in the order of their
+    last activity so that the ones that timed out are found without scanning them
+    all: only those inactive for longer than the shortest timeout are checked, which
+    makes a timeout late by at most that much"""
+
+    def __init__(
+        self,
+        directory: str | None,
+        config: ServerConfig = ServerConfig(),
+        limiter: ConnectionLimiter | None = None,
+    ):
+        self.directory = directory
+        self.config = config
+        self.limiter = limiter or ConnectionLimiter(config.max_connections_per_ip)
+        self.rejection = service_unavailable(config.retry_after)
+        self.shortest_timeout = min(
+            config.keep_alive_timeout,
+            config.header_timeout,
+            config.body_timeout,
+            config.write_timeout,
+        )
+        self.selector = selectors.DefaultSelector()
+        self.listener: socket.socket | None = None
+        self.connections: collections.OrderedDict[SelectorConnection, float] = (
+            collections.OrderedDict()
+        )
+
+    def listen(self, listener: socket.socket):
+        listener.setblocking(False)
+        self.selector.register(listener, selectors.EVENT_READ)
+        self.listener = listener
+
+    def stop_listening(self):
+        if self.listener is not None:
+            self.selector.unregister(self.listener)
+            self.listener.close()
+            self.listener = None
+
+    def add_connection(
+        self, sock: socket.socket, ip: str | None = None
+    ) -> SelectorConnection:
+        sock.setblocking(False)
+        conn = SelectorConnection(sock, self.directory, self.config, ip)
+        self.selector.register(sock, conn.events, conn)
+        self.connections[conn] = time.monotonic()
+        return conn
+
+    def accept(self):
+        while True:
+            try:
+                sock, address = self.listener.accept()
+            except BlockingIOError:
+                return
+            ip = peer_ip(address)
+            if not self.limiter.acquire(ip):
+                reject(sock, self.rejection)
+                continue
+            self.add_connection(sock, ip)
+
+    def handle_event(self, conn: SelectorConnection, events: int):
+        events_before = conn.events
+        try:
+            if events & selectors.EVENT_WRITE:
+                conn.on_writable()
+            elif events & selectors.EVENT_READ:
+                conn.on_readable()
+        except OSError:
+            # client gone: only this connection is dropped
+            conn.close()
+        except Exception as e:
+            # a failing handler neither: the loop serves all the others
+            print(f"Error while handling a connection: {e!r}")
+            conn.close()
+        self.update(conn, events_before)
+
+    def update(self, conn: SelectorConnection, events_before: int):
+        """After some activity of the connection"""
+        if conn.closed:
+            self.remove(conn)
+            return
+        if conn.events != events_before:
+            self.selector.modify(conn.sock, conn.events, conn)
+        self.connections[conn] = time.monotonic()
+        self.connections.move_to_end(conn)
+
+    def remove(self, conn: SelectorConnection):
+        self.selector.unregister(conn.sock)
+        del self.connections[conn]
+        conn.close()
+        if conn.ip is not None:
+            self.limiter.release(conn.ip)
+
+    def expire(self):
+        now = time.monotonic()
+        inactive = list(
+            itertools.takewhile(
+                lambda item: item[1] <= now - self.shortest_timeout,
+                self.connections.items(),
+            )
+        )
+        for conn, last_active in inactive:
+            if conn.timed_out(last_active, now):
+                events_before = conn.events
+                try:
+                    conn.on_timeout()
+                except OSError:
+                    conn.close()
+                except Exception as e:
+                    print(f"Error while timing out a connection: {e!r}")
+                    conn.close()
+                self.update(conn, events_before)
+
+    def poll(self, timeout: float):
+        for key, events in self.selector.select(timeout):
+            if key.fileobj is self.listener:
+                self.accept()
+            else:
+                self.handle_event(key.data, events)
+        self.expire()
+
+    def serve_forever(self, listener: socket.socket):
+        """Serves until KeyboardInterrupt or `Shutdown`. The connections in progress
+        are then left `config.shutdown_timeout` seconds to finish"""
+        self.listen(listener)
+        # wakes up often enough to time the connections out
+        timeout = min(self.shortest_timeout, 1.0)
+        try:
+            while True:
+                self.poll(timeout)
+        except (KeyboardInterrupt, Shutdown):
+            self.stop_listening()
+            deadline = time.monotonic() + self.config.shutdown_timeout
+            while self.connections and time.monotonic() < deadline:
+                self.poll(min(timeout, deadline - time.monotonic()))
+        finally:
+            for conn in list(self.connections):
+                self.remove(conn)
+            self.stop_listening()
+            self.selector.close()
+
+
+def handle_connection_selectors(
+    conn: socket.socket, directory: str | None, config: ServerConfig = ServerConfig()
+):
+    """Serves a single connection with the selectors engine until it is closed"""
+    server = SelectorServer(directory, config)
+    server.add_connection(conn)
+    try:
+        while server.connections:
+            server.poll(min(server.shortest_timeout, 1.0))
+    finally:
+        server.selector.close()
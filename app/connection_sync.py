@@ -1,41 +1,286 @@
 import socket
-from app.http import HttpRequest
-from app.api import handle_req
+import time
+from app.config import ServerConfig
+from app.framing import (
+    InvalidRequest,
+    RequestFramer,
+    RequestTimeout,
+    RequestTooLarge,
+)
+from app.http import (
+    CompositeBody,
+    FileBody,
+    HttpRequest,
+    HttpResponse,
+    HttpStatus,
+    StreamBody,
+)
+from app.api import FileUpload, handle_req, open_body_sink, refusal
+from app.metrics import METRICS, UNMATCHED
+from app.profiling import PROFILER
 
+RECV_BUF_LEN = 65536
+# max nb of buffers of a single sendmsg call
+IOV_MAX = 1024
 
-def receive_msg(conn: socket.socket, buf_len: int = 1024):
-    chunks = []
 
+def receive_into(
+    conn: socket.socket, framer: RequestFramer, buf_len: int = RECV_BUF_LEN
+) -> bool:
+    """Feeds the result of one recv to the framer. Returns False if the client closed
+    the connection, stayed idle for too long or if the socket is broken. Raises
+    `RequestTimeout` if the socket times out in the middle of a request"""
     try:
-        while True:
-            chunk = conn.recv(buf_len)
-            if not chunk:
-                break
-            chunks.append(chunk)
-            if len(chunk) < buf_len:
-                break
+        chunk = conn.recv(buf_len)
+    except TimeoutError:
+        if framer.started_at is None:
+            # idle persistent connection
+            return False
+        raise RequestTimeout() from None
     except socket.error as e:
         print(f"Socket error while receiving: {e}")
+        return False
+    if not chunk:
+        return False
+    METRICS.count_bytes_in(len(chunk))
+    framer.feed(chunk)
+    return True
 
-    return b"".join(chunks)
 
+def receive_msg(
+    conn: socket.socket, framer: RequestFramer, buf_len: int = RECV_BUF_LEN
+) -> bytes:
+    """Reads from the socket until the framer holds a complete request.
+    Returns an empty message if the client closed the connection before that"""
+    while not framer.message_complete():
+        if not receive_into(conn, framer, buf_len):
+            return b""
+    return framer.pop_message()
 
-def send_msg(conn: socket.socket, msg: bytes):
-    total_sent = 0
-    msg_len = len(msg)
 
+def receive_head(
+    conn: socket.socket,
+    framer: RequestFramer,
+    buf_len: int = RECV_BUF_LEN,
+    config: ServerConfig = ServerConfig(),
+) -> bytes:
+    """Same as `receive_msg` but stops as soon as the headers are complete. The
+    first bytes are awaited for the keep-alive timeout, the whole head for the
+    header timeout: a client sending it byte by byte is not given more time"""
+    while not framer.head_complete():
+        timeout = config.head_time_left(framer.started_at)
+        if timeout <= 0:
+            raise RequestTimeout()
+        conn.settimeout(timeout)
+        if not receive_into(conn, framer, buf_len):
+            return b""
+    return framer.pop_head()
+
+
+def receive_body(
+    conn: socket.socket, framer: RequestFramer, buf_len: int = RECV_BUF_LEN
+) -> memoryview | None:
+    """Buffers the whole body of the request whose head was popped.
+    Returns None if the connection is lost before the end of the body"""
+    while not framer.message_complete():
+        if not receive_into(conn, framer, buf_len):
+            return None
+    return framer.pop_body()
+
+
+def stream_body(
+    conn: socket.socket,
+    framer: RequestFramer,
+    sink: FileUpload,
+    buf_len: int = RECV_BUF_LEN,
+) -> bool:
+    """Hands the body of the request whose head was popped to the sink chunk by chunk
+    as it is received. Returns False if the connection is lost before the end"""
+    remaining = framer.content_length
+    while remaining:
+        chunk = framer.pop_body_chunk()
+        if chunk:
+            sink.write(chunk)
+            remaining -= len(chunk)
+        elif not receive_into(conn, framer, buf_len):
+            return False
+    return True
+
+
+def send_buffers(conn: socket.socket, buffers: list[bytes]) -> bool:
+    """Gather write: the buffers are handed to the kernel together with sendmsg
+    instead of being concatenated first. Returns False if they could not be sent
+    entirely"""
+    views = [memoryview(buf) for buf in buffers if buf]
+    first = 0
     try:
-        while total_sent < msg_len:
-            sent = conn.send(msg[total_sent:])
-            total_sent += sent
+        while first < len(views):
+            sent = conn.sendmsg(views[first : first + IOV_MAX])
+            METRICS.count_bytes_out(sent)
+            while first < len(views) and sent >= len(views[first]):
+                sent -= len(views[first])
+                first += 1
+            if sent:
+                views[first] = views[first][sent:]
     except socket.error as e:
         print(f"Socket error while sending: {e}")
+        return False
+    return True
+
+
+def send_msg(conn: socket.socket, msg: bytes) -> bool:
+    """Returns False if the message could not be sent entirely"""
+    return send_buffers(conn=conn, buffers=[msg])
+
+
+def send_file(conn: socket.socket, body: FileBody) -> bool:
+    """Zero-copy send: socket.sendfile relies on os.sendfile so the file content goes
+    from the page cache to the socket without passing through python"""
+    try:
+        with body.open() as f:
+            METRICS.count_bytes_out(
+                conn.sendfile(f, offset=body.offset, count=body.count)
+            )
+    except socket.error as e:
+        print(f"Socket error while sending file: {e}")
+        return False
+    return True
+
 
+def send_chunked(conn: socket.socket, body: StreamBody) -> bool:
+    """Sends each chunk as soon as it is produced. Stops producing them if the
+    client is gone"""
+    try:
+        for chunk in body.chunks:
+            if chunk and not send_msg(conn=conn, msg=body.encode_chunk(chunk)):
+                return False
+        return send_msg(conn=conn, msg=body.LAST_CHUNK)
+    finally:
+        body.close()
+
+
+def send_response(conn: socket.socket, res: HttpResponse) -> bool:
+    """Returns False if the response could not be sent entirely"""
+    if isinstance(res.body, FileBody) and res.body.count:
+        return send_buffers(conn=conn, buffers=res.head_buffers()) and send_file(
+            conn=conn, body=res.body
+        )
+    elif isinstance(res.body, CompositeBody):
+        if not send_buffers(conn=conn, buffers=res.head_buffers()):
+            return False
+        for part in res.body.parts:
+            if isinstance(part, FileBody):
+                sent = send_file(conn=conn, body=part)
+            else:
+                sent = send_msg(conn=conn, msg=part)
+            if not sent:
+                return False
+        return True
+    elif isinstance(res.body, StreamBody):
+        if send_buffers(conn=conn, buffers=res.head_buffers()):
+            return send_chunked(conn=conn, body=res.body)
+        res.body.close()
+        return False
+    else:
+        return send_buffers(conn=conn, buffers=res.to_buffers())
+
+
+def handle_request(
+    conn: socket.socket,
+    framer: RequestFramer,
+    head: bytes,
+    nb_requests: int,
+    directory: str | None,
+    config: ServerConfig,
+) -> bool:
+    """Answers the request whose head was received. Returns whether the connection
+    can be kept open for the next one"""
+    received_from = framer.started_at
+    start = time.perf_counter()
+    req = HttpRequest.from_bytes(head, config.parser)
+    METRICS.observe("parse", time.perf_counter() - start)
+
+    if not config.allows_body_size(framer.content_length):
+        # the body is never read so the connection can not be reused
+        res = HttpResponse.empty(status=HttpStatus.PayloadTooLarge413)
+        res.set_keep_alive(False, req.version)
+        METRICS.count_request(UNMATCHED, res.status.code)
+        conn.settimeout(config.write_timeout)
+        send_response(conn=conn, res=res)
+        return False
+
+    if req.expects_continue() and framer.content_length:
+        continue_res = HttpResponse.informational(HttpStatus.Continue100)
+        conn.settimeout(config.write_timeout)
+        if not send_msg(conn=conn, msg=continue_res.to_bytes()):
+            return False
 
-def handle_connection(conn: socket.socket, directory: str | None):
-    """Synchronous way to handle one connection"""
+    # a timeout from now on is the client stalling in the middle of its body
+    conn.settimeout(config.body_timeout)
+    sink = open_body_sink(req, directory=directory)
+    if sink:
+        try:
+            completed = stream_body(conn=conn, framer=framer, sink=sink)
+        except BaseException:
+            sink.abort()
+            raise
+        if not completed:
+            sink.abort()
+            return False
+        METRICS.observe("receive", time.perf_counter() - received_from)
+        res = sink.finish()
+    else:
+        body = receive_body(conn=conn, framer=framer)
+        if body is None:
+            return False
+        start = time.perf_counter()
+        METRICS.observe("receive", start - received_from)
+        req.body = body
+        res = handle_req(req, directory=directory, config=config)
+        METRICS.observe("handle", time.perf_counter() - start)
+
+    keep_alive = req.wants_keep_alive() and config.allows_more_requests(nb_requests)
+    res.set_keep_alive(keep_alive, req.version)
+    start = time.perf_counter()
+    conn.settimeout(config.write_timeout)
+    sent = send_response(conn=conn, res=res)
+    METRICS.observe("send", time.perf_counter() - start)
+    return keep_alive and sent
+
+
+def handle_connection(
+    conn: socket.socket, directory: str | None, config: ServerConfig = ServerConfig()
+):
+    """Synchronous way to handle one connection. The connection is kept open for
+    the next requests unless the client or the config says otherwise. Pipelined
+    requests already in the buffer are answered in order without a new recv.
+
+    Requests too large, invalid or too slow to arrive are answered with an error
+    and the connection closed, so that a slow client holds a thread for a bounded time
+    """
     with conn:
-        msg = receive_msg(conn=conn)
-        req = HttpRequest.from_bytes(msg)
-        res = handle_req(req, directory=directory)
-        send_msg(conn=conn, msg=res.to_bytes())
+        framer = RequestFramer(config.max_request_line, config.max_header_size)
+        nb_requests = 0
+        keep_alive = True
+        try:
+            while keep_alive:
+                head = receive_head(conn=conn, framer=framer, config=config)
+                if not head:
+                    return
+                nb_requests += 1
+                with PROFILER.request():
+                    keep_alive = handle_request(
+                        conn, framer, head, nb_requests, directory, config
+                    )
+        except (RequestTooLarge, InvalidRequest, RequestTimeout) as e:
+            conn.settimeout(config.write_timeout)
+            send_response(conn=conn, res=refusal(e))
+
+
+def handle_shared_connection(shared_fd, directory: str | None, config: ServerConfig):
+    """Handles a connection whose fd was shared by another process with
+    `multiprocessing.reduction.DupFd`"""
+    if config.metrics_dir:
+        METRICS.share(config.metrics_dir, config.metrics_flush_interval)
+    conn = socket.socket(fileno=shared_fd.detach())
+    handle_connection(conn, directory=directory, config=config)
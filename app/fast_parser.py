@@ -0,0 +1,127 @@
+"""Hand-rolled request parser working directly on bytes.
+
+Contrary to the pyparsing grammar in `app.parser`, nothing here is built per request:
+the only compiled object is the request line regex, created once at import. Parsing
+is a single forward pass (request line, then one `split` of the header block) with no
+backtracking, and header values are only decoded when a handler looks them up.
+
+`parse_request` returns a dict with the same keys as the pyparsing grammar's
+`as_dict()` (`method`, `host`, `path`, `query_params`, `version`, `headers`, `body`)
+so that `HttpRequest.from_bytes` can build the request the same way for both engines.
+The body is not decoded nor copied: it is a view of the message.
+"""
+
+import re
+
+from app.framing import InvalidRequest
+from app.headers import Headers, RawFields, add_field
+
+HEADERS_END = b"\r\n\r\n"
+CRLF = b"\r\n"
+
+REQUEST_LINE_RE = re.compile(
+    rb"(GET|POST|DELETE|PUT) ([^ \r\n]+) (HTTP/(?:1\.0|1\.1|2\.0))(?:\r\n|\Z)"
+)
+
+
+class HttpParseError(InvalidRequest):
+    """Raised when a message is not a valid http request"""
+
+
+def parse_urlpath(target: str) -> tuple[str | None, str, dict[str, str]]:
+    """Splits a request target into host, path and query params.
+
+    Same conventions as `urlpath_parser`: the path has no leading slash and at most
+    one trailing slash is removed. The host is only set for the absolute-form
+    (http://example.org/test) and the asterisk-form (*)
+    """
+    if target == "*":
+        return "*", "", {}
+
+    host = None
+    if target.startswith("http://") or target.startswith("https://"):
+        target = target[target.index("://") + 3 :]
+        end = len(target)
+        for sep in "/?":
+            idx = target.find(sep)
+            if idx != -1 and idx < end:
+                end = idx
+        host = target[:end]
+        if not host:
+            raise HttpParseError(f"Missing host in request target: {target}")
+        target = target[end:]
+    elif not target.startswith("/"):
+        raise HttpParseError(f"Invalid request target: {target}")
+
+    path, _, query = target.partition("?")
+    path = path[1:] if path.startswith("/") else path
+    if path.endswith("/"):
+        path = path[:-1]
+
+    query_params = {}
+    if query:
+        for param in query.split("&"):
+            key, sep, val = param.partition("=")
+            if not sep or not key:
+                raise HttpParseError(f"Invalid query param: {param}")
+            query_params[key] = val
+
+    return host, path, query_params
+
+
+def parse_headers(header_block: bytes) -> Headers:
+    """Validates the `Key: value` lines separated by CRLF and indexes them by
+    lowercased name. Values are only decoded when looked up"""
+    fields: RawFields = {}
+    if not header_block:
+        return Headers()
+    for line in header_block.split(CRLF):
+        if not line:
+            continue
+        key, sep, val = line.partition(b":")
+        if not sep or not key or key != key.strip():
+            raise HttpParseError(f"Invalid header line: {line!r}")
+        key = key.lower()
+        if key in fields:
+            add_field(fields, key, val)
+        else:
+            fields[key] = val
+    return Headers(header_block, fields)
+
+
+def parse_request(msg: bytes) -> dict:
+    """Parses a full http request (request line, headers and body)"""
+    match = REQUEST_LINE_RE.match(msg)
+    if match is None:
+        raise HttpParseError(f"Invalid request line: {msg[:100]!r}")
+
+    method, target, version = match.groups()
+    try:
+        target = target.decode()
+    except UnicodeDecodeError:
+        raise HttpParseError(f"Invalid request target: {target!r}") from None
+    host, path, query_params = parse_urlpath(target)
+
+    start = match.end()
+    if msg.startswith(CRLF, start):
+        # empty line right after the request line: no headers
+        header_bytes = b""
+        body_start = start + 2
+    else:
+        end = msg.find(HEADERS_END, start)
+        if end == -1:
+            header_bytes = msg[start:]
+            body_start = len(msg)
+        else:
+            header_bytes = msg[start:end]
+            body_start = end + 4
+
+    return {
+        "method": method.decode(),
+        "host": host,
+        "path": path,
+        "query_params": query_params,
+        "version": version.decode(),
+        "headers": parse_headers(header_bytes),
+        "body": memoryview(msg)[body_start:],
+    }
@@ -0,0 +1,219 @@
+"""Cache of the metadata and descriptors of the served files.
+
+A `GET /files/` used to cost a stat to check the file, another one for its size
+and an open to send it. The cache keeps, per path, the stat result, the
+validators derived from it (ETag, Last-Modified) and an open descriptor, so that
+a file requested again within `ttl` seconds costs a dict lookup. After `ttl` the
+path is stat'ed again and the entry replaced if the file changed.
+
+Responses send the file from a duplicate of the cached descriptor (`FileInfo.open`)
+so that what is sent is always the version described by the headers, even if the
+file is replaced in the meantime, and so that evicting an entry never closes a
+descriptor in use. Duplicates share the position of the descriptor, so they are
+read with `os.pread` at a position of their own (`SharedFileReader`).
+"""
+
+import io
+import os
+import pathlib
+import stat
+import threading
+import time
+from collections import OrderedDict
+from typing import BinaryIO
+
+from app.config import ServerConfig
+from app.ranges import http_date
+
+
+class SharedFileReader(io.RawIOBase):
+    """Reads a descriptor whose position may be moved by others (a duplicate) at a
+    position of its own. `fileno` and `tell` give what `os.sendfile` needs"""
+
+    def __init__(self, fd: int):
+        self.fd = fd
+        self.position = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def fileno(self) -> int:
+        return self.fd
+
+    def readinto(self, buffer) -> int:
+        data = os.pread(self.fd, len(buffer), self.position)
+        buffer[: len(data)] = data
+        self.position += len(data)
+        return len(data)
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += os.fstat(self.fd).st_size
+        if offset < 0:
+            raise ValueError(f"Negative seek position {offset}")
+        self.position = offset
+        return offset
+
+    def tell(self) -> int:
+        return self.position
+
+    def close(self):
+        if not self.closed:
+            os.close(self.fd)
+        super().close()
+
+
+class FileInfo:
+    __slots__ = (
+        "path",
+        "size",
+        "mtime",
+        "mtime_ns",
+        "ino",
+        "etag",
+        "last_modified",
+        "checked_at",
+        "fd",
+        "lock",
+    )
+
+    def __init__(self, path: pathlib.Path, st: os.stat_result, fd: int = -1):
+        self.path = path
+        self.size = st.st_size
+        self.mtime = st.st_mtime
+        self.mtime_ns = st.st_mtime_ns
+        self.ino = st.st_ino
+        # strong validator of the file as is, see `etag_for` for its encodings
+        self.etag = f'"{st.st_ino:x}-{st.st_size:x}-{st.st_mtime_ns:x}"'
+        self.last_modified = http_date(st.st_mtime)
+        self.checked_at = time.monotonic()
+        # -1 once closed
+        self.fd = fd
+        self.lock = threading.Lock()
+
+    def same_version(self, st: os.stat_result) -> bool:
+        return (st.st_ino, st.st_size, st.st_mtime_ns) == (
+            self.ino,
+            self.size,
+            self.mtime_ns,
+        )
+
+    def etag_for(self, content_encoding: str | None) -> str:
+        """Compressing twice does not always give the same bytes (gzip headers hold
+        a timestamp), so the tags of the compressed versions are weak"""
+        if not content_encoding:
+            return self.etag
+        return f'W/{self.etag[:-1]}-{content_encoding}"'
+
+    def open(self) -> BinaryIO:
+        """File object of its own, to be closed by the caller"""
+        with self.lock:
+            if self.fd >= 0:
+                return io.BufferedReader(SharedFileReader(os.dup(self.fd)))
+        # evicted in the meantime
+        return open(self.path, "rb")
+
+    def close(self):
+        with self.lock:
+            if self.fd >= 0:
+                os.close(self.fd)
+                self.fd = -1
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}(path={self.path}, etag={self.etag})"
+
+
+def load(path: pathlib.Path, keep_open: bool) -> FileInfo | None:
+    """None if the path is not a regular file that can be read"""
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return None
+    try:
+        # stat of what was opened rather than of the path, which may have changed
+        st = os.fstat(fd)
+    except OSError:
+        os.close(fd)
+        return None
+    if not stat.S_ISREG(st.st_mode):
+        os.close(fd)
+        return None
+    if not keep_open:
+        os.close(fd)
+        fd = -1
+    return FileInfo(path, st, fd)
+
+
+class FileCache:
+    """LRU of at most `max_entries` files (0: no caching), each trusted for `ttl`
+    seconds (0: stat'ed on every lookup, the descriptor is still reused)"""
+
+    def __init__(self, max_entries: int, ttl: float):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[str, FileInfo] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def configure(self, max_entries: int, ttl: float):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.evict()
+
+    def lookup(self, path: pathlib.Path) -> FileInfo | None:
+        key = str(path)
+        with self._lock:
+            info = self._entries.get(key)
+            if info is not None and time.monotonic() - info.checked_at < self.ttl:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return info
+            self.misses += 1
+
+        # io outside of the lock
+        if info is not None:
+            try:
+                st = os.stat(path)
+            except OSError:
+                st = None
+            if st is not None and info.same_version(st):
+                info.checked_at = time.monotonic()
+                return info
+
+        new_info = load(path, keep_open=self.max_entries > 0)
+        with self._lock:
+            if self._entries.get(key) is info:
+                self._entries.pop(key, None)
+                if info is not None:
+                    info.close()
+            if new_info is not None and self.max_entries:
+                previous = self._entries.pop(key, None)
+                if previous is not None:
+                    previous.close()
+                self._entries[key] = new_info
+        self.evict()
+        return new_info
+
+    def evict(self):
+        with self._lock:
+            while len(self._entries) > self.max_entries:
+                _, info = self._entries.popitem(last=False)
+                info.close()
+
+    def clear(self):
+        with self._lock:
+            for info in self._entries.values():
+                info.close()
+            self._entries.clear()
+
+
+FILE_CACHE = FileCache(ServerConfig.file_cache_size, ServerConfig.file_cache_ttl)
@@ -0,0 +1,234 @@
+"""Incremental framing of http requests.
+
+Bytes are fed to a `RequestFramer` as they come out of the socket. It tracks where
+the header block ends and how many body bytes are still expected (from
+`Content-Length`), so the connection layer knows exactly when a request is complete
+instead of guessing from the size of the last `recv`.
+
+The size of the head is bounded: the request line and the whole head are checked
+as they grow, so that a client can not make the buffer grow without end before
+the headers are complete.
+
+The length of the body must be unambiguous: a request with several different
+Content-Length, an invalid one, or a Transfer-Encoding (chunked requests are not
+supported) is refused rather than framed one way while a proxy in front of us may
+have framed it another way (request smuggling).
+"""
+
+import re
+import time
+from enum import Enum
+
+HEADERS_END = b"\r\n\r\n"
+
+# the headers that delimit the body, whatever their value
+BODY_LENGTH_RE = re.compile(
+    rb"\r\n(content-length|transfer-encoding):[ \t]*([^\r\n]*?)[ \t]*\r\n", re.I
+)
+
+
+class FramingError(ValueError):
+    """Raised when the framing of a request can not be determined"""
+
+
+class RequestTooLarge(FramingError):
+    """The head of a request goes beyond a limit of the framer"""
+
+
+class RequestLineTooLong(RequestTooLarge):
+    pass
+
+
+class HeadersTooLarge(RequestTooLarge):
+    pass
+
+
+class InvalidRequest(FramingError):
+    """The request can not be framed or parsed, it is answered with a 400"""
+
+
+class RequestTimeout(Exception):
+    """Raised by the connection layer when a client does not send the rest of a
+    request it started in time"""
+
+
+class FramerState(Enum):
+    HEADERS = "headers"
+    BODY = "body"
+    DONE = "done"
+
+
+class RequestFramer:
+    """State machine: HEADERS -> BODY -> DONE.
+
+    All received bytes go in a single growable buffer. Once a request is DONE,
+    `pop_message` removes it from the front of the buffer; bytes received after it
+    stay in the buffer for the next request.
+
+    Alternatively, the body can be consumed while it arrives: `pop_head` as soon as
+    the headers are complete, then `pop_body_chunk` until the body is exhausted, or
+    `pop_body` once it is complete.
+
+    `feed` and `pop_head` raise a `RequestTooLarge` once the request line is longer
+    than `max_request_line` or the head larger than `max_header_size` (0: no
+    limit). `pop_head` and `pop_message` raise an `InvalidRequest` when the length
+    of the body is ambiguous.
+    """
+
+    def __init__(self, max_request_line: int = 0, max_header_size: int = 0):
+        self.buffer = bytearray()
+        self.max_request_line = max_request_line
+        self.max_header_size = max_header_size
+        self.reset()
+
+    def reset(self):
+        self.state = FramerState.HEADERS
+        # index just after the empty line ending the headers (0 once popped)
+        self.headers_end = -1
+        # body bytes of the current request not popped yet
+        self.content_length = 0
+        # where to resume the search for the empty line
+        self._scan_from = 0
+        # set once the request line is known to be within the limit
+        self._line_checked = not self.max_request_line
+        # why the length of the body is ambiguous, raised when the head is popped
+        self.invalid_length: str | None = None
+        # perf_counter when the first bytes of the current request were fed, None
+        # until then
+        self.started_at = time.perf_counter() if self.buffer else None
+        self._advance()
+
+    @property
+    def message_len(self) -> int:
+        return self.headers_end + self.content_length
+
+    @property
+    def body_remaining(self) -> int:
+        if self.state != FramerState.BODY:
+            return 0
+        return self.message_len - len(self.buffer)
+
+    def feed(self, data: bytes) -> FramerState:
+        if self.started_at is None:
+            self.started_at = time.perf_counter()
+        self.buffer += data
+        self._advance()
+        self._check_head_size()
+        return self.state
+
+    def _advance(self):
+        if self.state == FramerState.HEADERS:
+            idx = self.buffer.find(HEADERS_END, self._scan_from)
+            if idx == -1:
+                # the empty line can be split between two chunks
+                self._scan_from = max(0, len(self.buffer) - len(HEADERS_END) + 1)
+                return
+            # the request line is included so that the regex can anchor on \r\n
+            self.headers_end = idx + len(HEADERS_END)
+            self.content_length = self._body_length()
+            self.state = FramerState.BODY
+
+        if self.state == FramerState.BODY and len(self.buffer) >= self.message_len:
+            self.state = FramerState.DONE
+
+    def _body_length(self) -> int:
+        lengths = set()
+        # a search rather than a findall: the \r\n ending a header starts the next
+        pos = 0
+        while match := BODY_LENGTH_RE.search(self.buffer, pos, self.headers_end):
+            pos = match.end() - 2
+            name, value = match.groups()
+            if name.lower() == b"transfer-encoding":
+                self.invalid_length = "Transfer-Encoding is not supported"
+                return 0
+            lengths.update(v.strip() for v in value.split(b","))
+        if not lengths:
+            return 0
+        if len(lengths) > 1 or not next(iter(lengths)).isdigit():
+            self.invalid_length = f"Invalid Content-Length: {sorted(lengths)}"
+            return 0
+        return int(lengths.pop())
+
+    def _check_head_size(self):
+        if self.state == FramerState.HEADERS:
+            head_len = len(self.buffer)
+        elif self.headers_end > 0:
+            head_len = self.headers_end
+        else:
+            # popped already
+            return
+        if not self._line_checked:
+            # up to the \r\n of a line of exactly the max length
+            limit = self.max_request_line + 2
+            if self.buffer.find(b"\r\n", 0, min(head_len, limit)) != -1:
+                self._line_checked = True
+            elif head_len >= limit:
+                raise RequestLineTooLong(
+                    f"Request line longer than {self.max_request_line} bytes"
+                )
+        if self.max_header_size and head_len > self.max_header_size:
+            raise HeadersTooLarge(f"Head larger than {self.max_header_size} bytes")
+
+    def _check_length(self):
+        if self.invalid_length is not None:
+            raise InvalidRequest(self.invalid_length)
+
+    def message_complete(self) -> bool:
+        return self.state == FramerState.DONE
+
+    def head_complete(self) -> bool:
+        return self.state != FramerState.HEADERS
+
+    def pop_head(self) -> bytes:
+        """Returns the request line and headers of the current request. Its body
+        must then be consumed with `pop_body_chunk`"""
+        if self.state == FramerState.HEADERS:
+            raise FramingError("Headers are not complete")
+        # a pipelined head may have been completed by `reset` rather than `feed`
+        self._check_head_size()
+        self._check_length()
+        head = self._take(self.headers_end)
+        self.headers_end = 0
+        return head
+
+    def pop_body_chunk(self) -> bytes:
+        """Returns the body bytes received so far, without going past the end of the
+        current body. Prepares for the next request once the body is exhausted"""
+        if self.headers_end != 0:
+            raise FramingError("Head must be popped before the body")
+        n = min(len(self.buffer), self.content_length)
+        chunk = self._take(n)
+        self.content_length -= n
+        if not self.content_length:
+            self.reset()
+        return chunk
+
+    def pop_body(self) -> memoryview:
+        """Returns the whole body of the request whose head was popped, once it is
+        received, as a view of the receive buffer rather than a copy. The buffer goes
+        with it: the bytes received after the body move to a new one"""
+        if self.headers_end != 0:
+            raise FramingError("Head must be popped before the body")
+        if len(self.buffer) < self.content_length:
+            raise FramingError("Body is not complete")
+        body, self.buffer = self.buffer, self.buffer[self.content_length :]
+        del body[self.content_length :]
+        self.content_length = 0
+        self.reset()
+        return memoryview(body)
+
+    def pop_message(self) -> bytes:
+        """Returns the current complete request and prepares for the next one"""
+        if self.state != FramerState.DONE:
+            raise FramingError("Request is not complete")
+        self._check_head_size()
+        self._check_length()
+        msg = self._take(self.message_len)
+        self.reset()
+        return msg
+
+    def _take(self, n: int) -> bytes:
+        """Removes the first `n` bytes of the buffer, copied once"""
+        data = memoryview(self.buffer)[:n].tobytes()
+        del self.buffer[:n]
+        return data
@@ -0,0 +1,110 @@
+"""Request header fields.
+
+The parser validates the header block and indexes the fields by lowercased name
+in the same pass, keeping their values as raw bytes: a value is only decoded the
+first time it is looked up. Handlers read a couple of fields per request, so most
+of them are never decoded.
+
+Field names are case-insensitive (RFC 9110 section 5.1). A field repeated on
+several lines is looked up as its values joined with a comma (section 5.3), or
+line by line with `get_all`.
+
+Names and values are decoded as latin-1, the historical charset of the fields
+(section 5.5): any byte decodes, so a client sending a value that is not UTF-8
+can not make the lookup of a handler fail.
+"""
+
+from collections.abc import Iterable, Iterator, Mapping
+
+CRLF = b"\r\n"
+FIELD_CHARSET = "latin-1"
+
+# lowercased name -> raw value, or raw values of a field sent on several lines
+RawFields = dict[bytes, bytes | list[bytes]]
+
+
+class Headers(Mapping[str, str]):
+    __slots__ = ("raw", "fields", "cache")
+
+    def __init__(self, raw: bytes = b"", fields: RawFields | None = None):
+        """`raw` is the header block and `fields` its index, built by the parser"""
+        self.raw = raw
+        self.fields = fields if fields is not None else {}
+        # lowercased name -> decoded values
+        self.cache: dict[str, list[str]] = {}
+
+    @classmethod
+    def from_dict(cls, headers: Mapping[str, str]) -> "Headers":
+        fields: RawFields = {}
+        for name, value in headers.items():
+            add_field(fields, name.encode().lower(), value.encode())
+        raw = CRLF.join(f"{k}: {v}".encode() for k, v in headers.items())
+        return cls(raw, fields)
+
+    @classmethod
+    def from_fields(cls, fields: Iterable[tuple[bytes, bytes]]) -> "Headers":
+        """From (name, value) pairs whose names are lowercase already, as decoded
+        from an HTTP/2 header block"""
+        index: RawFields = {}
+        lines = []
+        for name, value in fields:
+            add_field(index, name, value)
+            lines.append(b"%b: %b" % (name, value))
+        return cls(CRLF.join(lines), index)
+
+    def get_all(self, name: str) -> list[str]:
+        key = name.lower()
+        values = self.cache.get(key)
+        if values is None:
+            raw_values = self.fields.get(key.encode(FIELD_CHARSET, "replace"), ())
+            if isinstance(raw_values, bytes):
+                raw_values = (raw_values,)
+            values = self.cache[key] = [
+                v.strip().decode(FIELD_CHARSET) for v in raw_values
+            ]
+        return values
+
+    def get(self, name: str, default=None):
+        values = self.get_all(name)
+        if not values:
+            return default
+        if len(values) == 1:
+            return values[0]
+        return ", ".join(values)
+
+    def __getitem__(self, name: str) -> str:
+        value = self.get(name)
+        if value is None:
+            raise KeyError(name)
+        return value
+
+    def __contains__(self, name) -> bool:
+        return (
+            isinstance(name, str)
+            and name.lower().encode(FIELD_CHARSET, "replace") in self.fields
+        )
+
+    def __iter__(self) -> Iterator[str]:
+        """Names as first sent by the client, each once"""
+        seen = set()
+        for line in self.raw.split(CRLF):
+            name = line.partition(b":")[0]
+            if name and name.lower() not in seen:
+                seen.add(name.lower())
+                yield name.decode(FIELD_CHARSET)
+
+    def __len__(self) -> int:
+        return len(self.fields)
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}({dict(self.items())})"
+
+
+def add_field(fields: RawFields, key: bytes, value: bytes):
+    previous = fields.get(key)
+    if previous is None:
+        fields[key] = value
+    elif isinstance(previous, bytes):
+        fields[key] = [previous, value]
+    else:
+        previous.append(value)
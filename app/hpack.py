@@ -0,0 +1,461 @@
+"""HPACK, the header compression of HTTP/2 (RFC 7541).
+
+A header block is a sequence of representations, each either an index in the
+static table (the 61 most common fields, see Appendix A) and the dynamic table (the
+fields recently sent on the connection, newest first), or a literal name and value
+that may be added to the dynamic table. Both ends keep their own copy of the table
+of the other direction in sync, so blocks must be decoded in the order they were
+encoded, and a block that fails to decode breaks the whole connection.
+
+Literal strings are Huffman coded when that is shorter (Appendix B). The code is
+canonical: once left-aligned on 30 bits, the codes of a length follow each other
+and are all above the shorter ones, so the length of the next code in a string is
+found by bisecting the upper bounds of each length.
+
+Names and values are kept as bytes: they are only decoded by `Headers` when looked
+up.
+"""
+
+import bisect
+from collections import deque
+
+HeaderField = tuple[bytes, bytes]
+
+# a table holds fields for up to this many bytes, name and value included
+DEFAULT_TABLE_SIZE = 4096
+# counted for each field besides its name and value
+ENTRY_OVERHEAD = 32
+
+# fmt: off
+STATIC_TABLE: tuple[HeaderField, ...] = (
+    (b":authority", b""),
+    (b":method", b"GET"),
+    (b":method", b"POST"),
+    (b":path", b"/"),
+    (b":path", b"/index.html"),
+    (b":scheme", b"http"),
+    (b":scheme", b"https"),
+    (b":status", b"200"),
+    (b":status", b"204"),
+    (b":status", b"206"),
+    (b":status", b"304"),
+    (b":status", b"400"),
+    (b":status", b"404"),
+    (b":status", b"500"),
+    (b"accept-charset", b""),
+    (b"accept-encoding", b"gzip, deflate"),
+    (b"accept-language", b""),
+    (b"accept-ranges", b""),
+    (b"accept", b""),
+    (b"access-control-allow-origin", b""),
+    (b"age", b""),
+    (b"allow", b""),
+    (b"authorization", b""),
+    (b"cache-control", b""),
+    (b"content-disposition", b""),
+    (b"content-encoding", b""),
+    (b"content-language", b""),
+    (b"content-length", b""),
+    (b"content-location", b""),
+    (b"content-range", b""),
+    (b"content-type", b""),
+    (b"cookie", b""),
+    (b"date", b""),
+    (b"etag", b""),
+    (b"expect", b""),
+    (b"expires", b""),
+    (b"from", b""),
+    (b"host", b""),
+    (b"if-match", b""),
+    (b"if-modified-since", b""),
+    (b"if-none-match", b""),
+    (b"if-range", b""),
+    (b"if-unmodified-since", b""),
+    (b"last-modified", b""),
+    (b"link", b""),
+    (b"location", b""),
+    (b"max-forwards", b""),
+    (b"proxy-authenticate", b""),
+    (b"proxy-authorization", b""),
+    (b"range", b""),
+    (b"referer", b""),
+    (b"refresh", b""),
+    (b"retry-after", b""),
+    (b"server", b""),
+    (b"set-cookie", b""),
+    (b"strict-transport-security", b""),
+    (b"transfer-encoding", b""),
+    (b"user-agent", b""),
+    (b"vary", b""),
+    (b"via", b""),
+    (b"www-authenticate", b""),
+)
+
+# (code, nb of bits) of each byte, and of the end of string (256)
+HUFFMAN_CODES: tuple[tuple[int, int], ...] = (
+    (0x1ff8, 13), (0x7fffd8, 23), (0xfffffe2, 28), (0xfffffe3, 28),
+    (0xfffffe4, 28), (0xfffffe5, 28), (0xfffffe6, 28), (0xfffffe7, 28),
+    (0xfffffe8, 28), (0xffffea, 24), (0x3ffffffc, 30), (0xfffffe9, 28),
+    (0xfffffea, 28), (0x3ffffffd, 30), (0xfffffeb, 28), (0xfffffec, 28),
+    (0xfffffed, 28), (0xfffffee, 28), (0xfffffef, 28), (0xffffff0, 28),
+    (0xffffff1, 28), (0xffffff2, 28), (0x3ffffffe, 30), (0xffffff3, 28),
+    (0xffffff4, 28), (0xffffff5, 28), (0xffffff6, 28), (0xffffff7, 28),
+    (0xffffff8, 28), (0xffffff9, 28), (0xffffffa, 28), (0xffffffb, 28),
+    (0x14, 6), (0x3f8, 10), (0x3f9, 10), (0xffa, 12),
+    (0x1ff9, 13), (0x15, 6), (0xf8, 8), (0x7fa, 11),
+    (0x3fa, 10), (0x3fb, 10), (0xf9, 8), (0x7fb, 11),
+    (0xfa, 8), (0x16, 6), (0x17, 6), (0x18, 6),
+    (0x0, 5), (0x1, 5), (0x2, 5), (0x19, 6),
+    (0x1a, 6), (0x1b, 6), (0x1c, 6), (0x1d, 6),
+    (0x1e, 6), (0x1f, 6), (0x5c, 7), (0xfb, 8),
+    (0x7ffc, 15), (0x20, 6), (0xffb, 12), (0x3fc, 10),
+    (0x1ffa, 13), (0x21, 6), (0x5d, 7), (0x5e, 7),
+    (0x5f, 7), (0x60, 7), (0x61, 7), (0x62, 7),
+    (0x63, 7), (0x64, 7), (0x65, 7), (0x66, 7),
+    (0x67, 7), (0x68, 7), (0x69, 7), (0x6a, 7),
+    (0x6b, 7), (0x6c, 7), (0x6d, 7), (0x6e, 7),
+    (0x6f, 7), (0x70, 7), (0x71, 7), (0x72, 7),
+    (0xfc, 8), (0x73, 7), (0xfd, 8), (0x1ffb, 13),
+    (0x7fff0, 19), (0x1ffc, 13), (0x3ffc, 14), (0x22, 6),
+    (0x7ffd, 15), (0x3, 5), (0x23, 6), (0x4, 5),
+    (0x24, 6), (0x5, 5), (0x25, 6), (0x26, 6),
+    (0x27, 6), (0x6, 5), (0x74, 7), (0x75, 7),
+    (0x28, 6), (0x29, 6), (0x2a, 6), (0x7, 5),
+    (0x2b, 6), (0x76, 7), (0x2c, 6), (0x8, 5),
+    (0x9, 5), (0x2d, 6), (0x77, 7), (0x78, 7),
+    (0x79, 7), (0x7a, 7), (0x7b, 7), (0x7ffe, 15),
+    (0x7fc, 11), (0x3ffd, 14), (0x1ffd, 13), (0xffffffc, 28),
+    (0xfffe6, 20), (0x3fffd2, 22), (0xfffe7, 20), (0xfffe8, 20),
+    (0x3fffd3, 22), (0x3fffd4, 22), (0x3fffd5, 22), (0x7fffd9, 23),
+    (0x3fffd6, 22), (0x7fffda, 23), (0x7fffdb, 23), (0x7fffdc, 23),
+    (0x7fffdd, 23), (0x7fffde, 23), (0xffffeb, 24), (0x7fffdf, 23),
+    (0xffffec, 24), (0xffffed, 24), (0x3fffd7, 22), (0x7fffe0, 23),
+    (0xffffee, 24), (0x7fffe1, 23), (0x7fffe2, 23), (0x7fffe3, 23),
+    (0x7fffe4, 23), (0x1fffdc, 21), (0x3fffd8, 22), (0x7fffe5, 23),
+    (0x3fffd9, 22), (0x7fffe6, 23), (0x7fffe7, 23), (0xffffef, 24),
+    (0x3fffda, 22), (0x1fffdd, 21), (0xfffe9, 20), (0x3fffdb, 22),
+    (0x3fffdc, 22), (0x7fffe8, 23), (0x7fffe9, 23), (0x1fffde, 21),
+    (0x7fffea, 23), (0x3fffdd, 22), (0x3fffde, 22), (0xfffff0, 24),
+    (0x1fffdf, 21), (0x3fffdf, 22), (0x7fffeb, 23), (0x7fffec, 23),
+    (0x1fffe0, 21), (0x1fffe1, 21), (0x3fffe0, 22), (0x1fffe2, 21),
+    (0x7fffed, 23), (0x3fffe1, 22), (0x7fffee, 23), (0x7fffef, 23),
+    (0xfffea, 20), (0x3fffe2, 22), (0x3fffe3, 22), (0x3fffe4, 22),
+    (0x7ffff0, 23), (0x3fffe5, 22), (0x3fffe6, 22), (0x7ffff1, 23),
+    (0x3ffffe0, 26), (0x3ffffe1, 26), (0xfffeb, 20), (0x7fff1, 19),
+    (0x3fffe7, 22), (0x7ffff2, 23), (0x3fffe8, 22), (0x1ffffec, 25),
+    (0x3ffffe2, 26), (0x3ffffe3, 26), (0x3ffffe4, 26), (0x7ffffde, 27),
+    (0x7ffffdf, 27), (0x3ffffe5, 26), (0xfffff1, 24), (0x1ffffed, 25),
+    (0x7fff2, 19), (0x1fffe3, 21), (0x3ffffe6, 26), (0x7ffffe0, 27),
+    (0x7ffffe1, 27), (0x3ffffe7, 26), (0x7ffffe2, 27), (0xfffff2, 24),
+    (0x1fffe4, 21), (0x1fffe5, 21), (0x3ffffe8, 26), (0x3ffffe9, 26),
+    (0xffffffd, 28), (0x7ffffe3, 27), (0x7ffffe4, 27), (0x7ffffe5, 27),
+    (0xfffec, 20), (0xfffff3, 24), (0xfffed, 20), (0x1fffe6, 21),
+    (0x3fffe9, 22), (0x1fffe7, 21), (0x1fffe8, 21), (0x7ffff3, 23),
+    (0x3fffea, 22), (0x3fffeb, 22), (0x1ffffee, 25), (0x1ffffef, 25),
+    (0xfffff4, 24), (0xfffff5, 24), (0x3ffffea, 26), (0x7ffff4, 23),
+    (0x3ffffeb, 26), (0x7ffffe6, 27), (0x3ffffec, 26), (0x3ffffed, 26),
+    (0x7ffffe7, 27), (0x7ffffe8, 27), (0x7ffffe9, 27), (0x7ffffea, 27),
+    (0x7ffffeb, 27), (0xffffffe, 28), (0x7ffffec, 27), (0x7ffffed, 27),
+    (0x7ffffee, 27), (0x7ffffef, 27), (0x7fffff0, 27), (0x3ffffee, 26),
+    (0x3fffffff, 30),
+)
+# fmt: on
+
+STATIC_INDEX: dict[HeaderField, int] = {}
+STATIC_NAME_INDEX: dict[bytes, int] = {}
+for i, (name, value) in enumerate(STATIC_TABLE, start=1):
+    STATIC_INDEX.setdefault((name, value), i)
+    STATIC_NAME_INDEX.setdefault(name, i)
+
+EOS = 256
+CODE_BITS = 30
+CODE_MASK = (1 << CODE_BITS) - 1
+
+
+def _decoding_table() -> tuple[list[int], ...]:
+    """Per length: upper bound of its codes left-aligned on 30 bits, length, first
+    code and position of its first symbol in the symbols sorted by (length,
+    symbol). Then those symbols"""
+    symbols = sorted(range(len(HUFFMAN_CODES)), key=lambda s: HUFFMAN_CODES[s][::-1])
+    limits, lengths, first_codes, offsets = [], [], [], []
+    for position, symbol in enumerate(symbols):
+        code, length = HUFFMAN_CODES[symbol]
+        if not lengths or lengths[-1] != length:
+            lengths.append(length)
+            first_codes.append(code)
+            offsets.append(position)
+            limits.append(0)
+        limits[-1] = (code + 1) << (CODE_BITS - length)
+    return limits, lengths, first_codes, offsets, symbols
+
+
+(
+    HUFFMAN_LIMITS,
+    HUFFMAN_LENGTHS,
+    HUFFMAN_FIRST_CODES,
+    HUFFMAN_OFFSETS,
+    HUFFMAN_SYMBOLS,
+) = _decoding_table()
+
+
+class HpackError(ValueError):
+    """Raised on a header block that can not be decoded"""
+
+
+class HeaderListTooLarge(HpackError):
+    """The fields of a block go beyond the size limit of the decoder. The block
+    was decoded all the same: the table is still in sync"""
+
+
+def huffman_encode(data: bytes) -> bytes:
+    value = nb_bits = 0
+    for byte in data:
+        code, length = HUFFMAN_CODES[byte]
+        value = (value << length) | code
+        nb_bits += length
+    # padded with the most significant bits of the end of string code: ones
+    padding = -nb_bits % 8
+    value = (value << padding) | ((1 << padding) - 1)
+    return value.to_bytes((nb_bits + padding) // 8, "big")
+
+
+def huffman_encoded_len(data: bytes) -> int:
+    return (sum(HUFFMAN_CODES[byte][1] for byte in data) + 7) // 8
+
+
+def huffman_decode(data: bytes) -> bytes:
+    value = int.from_bytes(data, "big")
+    remaining = len(data) * 8
+    decoded = bytearray()
+    while remaining:
+        if remaining >= CODE_BITS:
+            window = (value >> (remaining - CODE_BITS)) & CODE_MASK
+        else:
+            # completed with ones, as the padding
+            pad = CODE_BITS - remaining
+            window = ((value & ((1 << remaining) - 1)) << pad) | ((1 << pad) - 1)
+        i = bisect.bisect_right(HUFFMAN_LIMITS, window)
+        length = HUFFMAN_LENGTHS[i]
+        if length > remaining:
+            # the rest must be the padding: less than a byte of ones
+            if remaining > 7 or value & ((1 << remaining) - 1) != (1 << remaining) - 1:
+                raise HpackError("Invalid Huffman padding")
+            break
+        code = window >> (CODE_BITS - length)
+        symbol = HUFFMAN_SYMBOLS[HUFFMAN_OFFSETS[i] + code - HUFFMAN_FIRST_CODES[i]]
+        if symbol == EOS:
+            raise HpackError("End of string code in a Huffman string")
+        decoded.append(symbol)
+        remaining -= length
+    return bytes(decoded)
+
+
+def encode_int(value: int, prefix_bits: int, flags: int = 0) -> bytes:
+    """`value` on the last `prefix_bits` bits of a first byte whose other bits are
+    `flags`, continued on the next bytes if it does not fit"""
+    max_prefix = (1 << prefix_bits) - 1
+    if value < max_prefix:
+        return bytes((flags | value,))
+    encoded = bytearray((flags | max_prefix,))
+    value -= max_prefix
+    while value >= 0x80:
+        encoded.append((value & 0x7F) | 0x80)
+        value >>= 7
+    encoded.append(value)
+    return bytes(encoded)
+
+
+def decode_int(data: bytes, pos: int, prefix_bits: int) -> tuple[int, int]:
+    """Returns the integer starting at `data[pos]` and the position after it"""
+    max_prefix = (1 << prefix_bits) - 1
+    try:
+        value = data[pos] & max_prefix
+        pos += 1
+        if value < max_prefix:
+            return value, pos
+        shift = 0
+        while True:
+            byte = data[pos]
+            pos += 1
+            value += (byte & 0x7F) << shift
+            if not byte & 0x80:
+                return value, pos
+            shift += 7
+            if shift > 28:
+                raise HpackError("Integer too large")
+    except IndexError:
+        raise HpackError("Truncated integer") from None
+
+
+def encode_string(data: bytes) -> bytes:
+    """Huffman coded when shorter"""
+    huffman_len = huffman_encoded_len(data)
+    if huffman_len < len(data):
+        return encode_int(huffman_len, 7, 0x80) + huffman_encode(data)
+    return encode_int(len(data), 7) + data
+
+
+def decode_string(data: bytes, pos: int) -> tuple[bytes, int]:
+    huffman = data[pos] & 0x80 if pos < len(data) else 0
+    length, pos = decode_int(data, pos, 7)
+    end = pos + length
+    if end > len(data):
+        raise HpackError("Truncated string")
+    string = bytes(data[pos:end])
+    return (huffman_decode(string) if huffman else string), end
+
+
+def entry_size(field: HeaderField) -> int:
+    return len(field[0]) + len(field[1]) + ENTRY_OVERHEAD
+
+
+class DynamicTable:
+    """Fields most recently added first, evicted from the oldest once their total
+    size goes beyond `max_size`"""
+
+    def __init__(self, max_size: int = DEFAULT_TABLE_SIZE):
+        self.max_size = max_size
+        self.size = 0
+        self.entries: deque[HeaderField] = deque()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, field: HeaderField):
+        self.entries.appendleft(field)
+        self.size += entry_size(field)
+        self.evict()
+
+    def resize(self, max_size: int):
+        self.max_size = max_size
+        self.evict()
+
+    def evict(self):
+        while self.size > self.max_size:
+            self.size -= entry_size(self.entries.pop())
+
+    def get(self, index: int) -> HeaderField:
+        """`index` counted from 1 in the static table then in this one"""
+        if 0 < index <= len(STATIC_TABLE):
+            return STATIC_TABLE[index - 1]
+        try:
+            return self.entries[index - len(STATIC_TABLE) - 1]
+        except IndexError:
+            raise HpackError(f"Invalid table index {index}") from None
+
+
+class Decoder:
+    """Decodes the header blocks received on a connection. `max_table_size` is what
+    the other end was told the table may hold (SETTINGS_HEADER_TABLE_SIZE)"""
+
+    def __init__(self, max_table_size: int = DEFAULT_TABLE_SIZE):
+        self.max_table_size = max_table_size
+        self.table = DynamicTable(max_table_size)
+
+    def decode(self, block: bytes, max_list_size: int = 0) -> list[HeaderField]:
+        """Raises `HeaderListTooLarge` once the fields, counted like the entries of
+        the table, go beyond `max_list_size` (0: no limit). That is checked as they
+        are decoded: a byte referencing a large entry of the table is enough to
+        repeat it"""
+        fields: list[HeaderField] = []
+        list_size = 0
+        pos = 0
+        while pos < len(block):
+            byte = block[pos]
+            if byte & 0x80:
+                # indexed field
+                index, pos = decode_int(block, pos, 7)
+                if not index:
+                    raise HpackError("Index 0")
+                field = self.table.get(index)
+            elif byte & 0xE0 == 0x20:
+                # dynamic table size update, only at the start of a block
+                if list_size:
+                    raise HpackError("Table size update after a field")
+                size, pos = decode_int(block, pos, 5)
+                if size > self.max_table_size:
+                    raise HpackError(f"Table size {size} above the limit")
+                self.table.resize(size)
+                continue
+            else:
+                # literal, with incremental indexing (01), without indexing (0000)
+                # or never indexed (0001)
+                indexing = byte & 0xC0 == 0x40
+                index, pos = decode_int(block, pos, 6 if indexing else 4)
+                if index:
+                    name = self.table.get(index)[0]
+                else:
+                    name, pos = decode_string(block, pos)
+                value, pos = decode_string(block, pos)
+                field = (name, value)
+                if indexing:
+                    self.table.add(field)
+            list_size += entry_size(field)
+            # beyond the limit, the rest is still decoded for the table, not kept
+            if not max_list_size or list_size <= max_list_size:
+                fields.append(field)
+        if max_list_size and list_size > max_list_size:
+            raise HeaderListTooLarge(f"Header list larger than {max_list_size} bytes")
+        return fields
+
+
+class Encoder:
+    """Encodes the header blocks sent on a connection, adding the fields to its
+    table except the ones in `not_indexed`, which change from one message to the
+    next and would only evict the others"""
+
+    def __init__(
+        self,
+        max_table_size: int = DEFAULT_TABLE_SIZE,
+        not_indexed: frozenset[bytes] = frozenset(),
+    ):
+        self.table = DynamicTable(max_table_size)
+        self.not_indexed = not_indexed
+        # smallest and last size the table was given since the last block: the
+        # decoder must be told both
+        self.size_updates: list[int] = []
+
+    def resize(self, max_size: int):
+        """When the decoder limits the size of the table (SETTINGS_HEADER_TABLE_SIZE)"""
+        if max_size == self.table.max_size:
+            return
+        self.table.resize(max_size)
+        if not self.size_updates:
+            self.size_updates = [max_size]
+        else:
+            self.size_updates = [min(self.size_updates[0], max_size), max_size]
+
+    def find(self, field: HeaderField) -> tuple[int, bool]:
+        """Index of the field, or else of its name (False), 0 if unknown"""
+        index = STATIC_INDEX.get(field)
+        if index:
+            return index, True
+        name_index = STATIC_NAME_INDEX.get(field[0], 0)
+        for i, entry in enumerate(self.table.entries, start=len(STATIC_TABLE) + 1):
+            if entry == field:
+                return i, True
+            if not name_index and entry[0] == field[0]:
+                name_index = i
+        return name_index, False
+
+    def encode(self, fields: list[HeaderField]) -> bytes:
+        block = bytearray()
+        for size in dict.fromkeys(self.size_updates):
+            block += encode_int(size, 5, 0x20)
+        self.size_updates = []
+        for name, value in fields:
+            index, full = self.find((name, value))
+            if full:
+                block += encode_int(index, 7, 0x80)
+                continue
+            indexing = name not in self.not_indexed
+            if indexing:
+                block += encode_int(index, 6, 0x40)
+            else:
+                block += encode_int(index, 4)
+            if not index:
+                block += encode_string(name)
+            block += encode_string(value)
+            if indexing:
+                self.table.add((name, value))
+        return bytes(block)
@@ -1,16 +1,27 @@
-import gzip
+import functools
+import os
+import pathlib
 from io import BytesIO
-from typing import Dict, Self
+from typing import AsyncIterable, BinaryIO, Dict, Iterable, Self
+from app.compression import compress_bytes
+from app.fast_parser import HEADERS_END, HttpParseError, parse_request
+from app.file_cache import FileInfo
+from app.headers import Headers
+from app.ranges import (
+    ByteRange,
+    content_range,
+    multipart_boundary,
+    unsatisfied_range,
+)
 from app.parser import (
-    body_parser,
     method_parser,
     urlpath_parser,
     version_parser,
     headers_parser,
 )
 
-from enum import Enum
-from pyparsing import Optional, ParseException
+from enum import Enum, StrEnum
+from pyparsing import Optional, ParseException, ParserElement
 
 
 class HttpMethod(Enum):
@@ -27,14 +38,62 @@ class HttpVersion(Enum):
 
 
 class HttpStatus(Enum):
+    Continue100 = "100 Continue"
+    SwitchingProtocols101 = "101 Switching Protocols"
     Ok200 = "200 OK"
+    PartialContent206 = "206 Partial Content"
+    NotModified304 = "304 Not Modified"
+    BadRequest400 = "400 Bad Request"
+    Forbidden403 = "403 Forbidden"
     NotFound404 = "404 Not Found"
+    MethodNotAllowed405 = "405 Method Not Allowed"
     Created201 = "201 Created"
+    NotAcceptable406 = "406 Not Acceptable"
     Conflict409 = "409 Conflict"
+    RangeNotSatisfiable416 = "416 Range Not Satisfiable"
+    RequestTimeout408 = "408 Request Timeout"
+    PayloadTooLarge413 = "413 Payload Too Large"
+    UriTooLong414 = "414 URI Too Long"
+    RequestHeaderFieldsTooLarge431 = "431 Request Header Fields Too Large"
     InternalServerError500 = "500 Internal Server Error"
+    ServiceUnavailable503 = "503 Service Unavailable"
+
+    @property
+    def code(self) -> str:
+        return self.value[:3]
+
+
+# faster than calling the enums
+METHODS = {method.value: method for method in HttpMethod}
+VERSIONS = {version.value: version for version in HttpVersion}
+
+
+class ParserEngine(StrEnum):
+    """Fast is the hand-rolled parser from `app.fast_parser`. Pyparsing is the
+    reference grammar from `app.parser`, slower but useful to validate the former.
+    Equal to their values, which `ServerConfig.parser` holds"""
+
+    FAST = "fast"
+    PYPARSING = "pyparsing"
+
+
+def request_grammar() -> ParserElement:
+    """Request line and headers: the body is never decoded"""
+    return (
+        method_parser()
+        + urlpath_parser()
+        + version_parser()
+        + Optional(headers_parser())
+    )
+
+
+# built once: constructing the grammar costs more than parsing a small request
+REQUEST_GRAMMAR = request_grammar()
 
 
 class HttpUrlPath:
+    __slots__ = ("host", "path", "query_params")
+
     def __init__(self, host: str | None, path: str, query_params: Dict[str, str]):
         self.host = host
         self.path = path
@@ -44,18 +103,123 @@ class HttpUrlPath:
         return f"{self.__class__.__name__}(host={self.host}, path={self.path}, query_params={self.query_params})"
 
 
+class FileBody:
+    """Response body backed by a file. The connection layer sends it with sendfile so
+    the content is never loaded in memory. With a `source` from the file cache, its
+    descriptor is used rather than opening the path again"""
+
+    def __init__(
+        self,
+        path: pathlib.Path,
+        offset: int = 0,
+        count: int | None = None,
+        source: FileInfo | None = None,
+    ):
+        self.path = path
+        self.offset = offset
+        self.source = source
+        if count is None:
+            size = source.size if source is not None else os.stat(path).st_size
+            count = size - offset
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def open(self) -> BinaryIO:
+        if self.source is not None:
+            return self.source.open()
+        return open(self.path, "rb")
+
+    def read(self) -> bytes:
+        with self.open() as f:
+            f.seek(self.offset)
+            return f.read(self.count)
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}(path={self.path}, offset={self.offset}, count={self.count})"
+
+
+class StreamBody:
+    """Response body produced chunk by chunk while it is sent, with chunked transfer
+    encoding since its length is unknown upfront. `chunks` is either an iterable or
+    an async iterable of bytes, the latter only being usable by the asyncio server"""
+
+    LAST_CHUNK = b"0\r\n\r\n"
+
+    def __init__(self, chunks: Iterable[bytes] | AsyncIterable[bytes]):
+        self.chunks = chunks
+
+    @property
+    def is_async(self) -> bool:
+        return hasattr(self.chunks, "__aiter__")
+
+    @staticmethod
+    def encode_chunk(data: bytes) -> bytes:
+        return b"%x\r\n%b\r\n" % (len(data), data)
+
+    def close(self):
+        """Releases the resources of a generator that was not exhausted"""
+        close = getattr(self.chunks, "close", None)
+        if close is not None:
+            close()
+
+    async def aclose(self):
+        aclose = getattr(self.chunks, "aclose", None)
+        if aclose is not None:
+            await aclose()
+        else:
+            self.close()
+
+    def read(self) -> bytes:
+        """The whole chunked-encoded body"""
+        if self.is_async:
+            raise TypeError("An async stream can not be read synchronously")
+        try:
+            encoded = [self.encode_chunk(chunk) for chunk in self.chunks if chunk]
+        finally:
+            self.close()
+        return b"".join(encoded) + self.LAST_CHUNK
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}(chunks={self.chunks})"
+
+
+class CompositeBody:
+    """Response body made of in-memory parts and file slices sent one after the
+    other, for ex the parts of a multipart/byteranges response"""
+
+    def __init__(self, parts: list[bytes | FileBody]):
+        self.parts = parts
+
+    def __len__(self):
+        return sum(len(part) for part in self.parts)
+
+    def read(self) -> bytes:
+        return b"".join(
+            part.read() if isinstance(part, FileBody) else part for part in self.parts
+        )
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}(parts={self.parts})"
+
+
 HttpHeaders = dict
-HttpBody = str | bytes
+HttpBody = str | bytes | FileBody | StreamBody | CompositeBody
+# a slice of the buffer the request was received in, see `RequestFramer.pop_body`
+RequestBody = bytes | memoryview
 
 
 class HttpRequest:
+    __slots__ = ("method", "urlpath", "version", "headers", "body")
+
     def __init__(
         self,
         method: HttpMethod,
         urlpath: HttpUrlPath,
         version: HttpVersion,
-        headers: HttpHeaders,
-        body: HttpBody,
+        headers: Headers,
+        body: RequestBody,
     ):
         self.method = method
         self.urlpath = urlpath
@@ -64,26 +228,28 @@ class HttpRequest:
         self.body = body
 
     @classmethod
-    def from_bytes(cls, msg_bytes: bytes):
-        msg = msg_bytes.decode()
-
-        request_line = (
-            method_parser()
-            + urlpath_parser()
-            + version_parser()
-            + Optional(headers_parser())
-            + Optional(body_parser())
-        )
-        try:
-            result = request_line.parse_string(msg).as_dict()
-        except ParseException:
-            print(msg)
-            raise
+    def from_bytes(
+        cls, msg_bytes: bytes, engine: ParserEngine | str = ParserEngine.FAST
+    ):
+        """Only the request line and the headers are decoded, the body is a view of
+        `msg_bytes`. Raises `HttpParseError` whatever the engine"""
+        match engine:
+            case ParserEngine.FAST:
+                result = parse_request(msg_bytes)
+            case ParserEngine.PYPARSING:
+                end = msg_bytes.find(HEADERS_END)
+                head_end = len(msg_bytes) if end == -1 else end + len(HEADERS_END)
+                try:
+                    msg = msg_bytes[:head_end].decode()
+                    result = REQUEST_GRAMMAR.parse_string(msg).as_dict()
+                except (ParseException, UnicodeDecodeError) as e:
+                    raise HttpParseError(str(e)) from e
+                result["body"] = memoryview(msg_bytes)[head_end:]
 
         try:
-            method = HttpMethod(result.get("method"))
+            method = METHODS[result.get("method")]
 
-            path = result.get("path", "")
+            path = result.get("path") or ""
             host = result.get("host")
             query_params = dict(result.get("query_params") or {})
 
@@ -93,19 +259,33 @@ class HttpRequest:
                 query_params=query_params,
             )
 
-            version = HttpVersion(result.get("version"))
+            version = VERSIONS[result.get("version")]
 
             # \r\n
 
-            headers = HttpHeaders(result.get("headers", {}))
-            body: str = result.get("body", "")
+            headers = result.get("headers")
+            if not isinstance(headers, Headers):
+                # the pyparsing grammar gives (name, value) pairs
+                headers = Headers.from_dict(dict(headers or {}))
+            body: RequestBody = result.get("body", b"")
 
-        except ValueError:
-            raise
+        except KeyError as e:
+            raise HttpParseError(f"Unsupported method or version: {e}") from e
         return cls(
             method=method, urlpath=urlpath, version=version, headers=headers, body=body
         )
 
+    def expects_continue(self) -> bool:
+        """The client waits for a 100 Continue before sending the body"""
+        return self.headers.get("Expect", "").lower() == "100-continue"
+
+    def wants_keep_alive(self) -> bool:
+        """Persistent connection by default in HTTP/1.1, opt-in in HTTP/1.0"""
+        connection = self.headers.get("Connection", "").lower()
+        if self.version == HttpVersion.V1_0:
+            return connection == "keep-alive"
+        return connection != "close"
+
     def __repr__(self):
         return (
             f"{self.__class__.__name__}("
@@ -117,7 +297,37 @@ class HttpRequest:
         )
 
 
+# status line of every version and status, encoded once
+STATUS_LINES: dict[tuple[HttpVersion, HttpStatus], bytes] = {
+    (version, status): f"{version.value} {status.value}\r\n".encode()
+    for version in HttpVersion
+    for status in HttpStatus
+}
+
+
+# headers taking a handful of values, repeated from one response to the next. The
+# others (lengths, validators, ranges) change with every file or body: cached, they
+# would only evict these
+CACHED_HEADERS = frozenset(
+    ("Connection", "Content-Type", "Content-Encoding", "Vary", "Accept-Ranges")
+)
+
+
+def header_line(name: str, value: str) -> bytes:
+    """`name: value` line, encoded once for the `CACHED_HEADERS`"""
+    if name in CACHED_HEADERS:
+        return cached_header_line(name, value)
+    return f"{name}: {value}\r\n".encode()
+
+
+@functools.lru_cache(maxsize=256)
+def cached_header_line(name: str, value: str) -> bytes:
+    return f"{name}: {value}\r\n".encode()
+
+
 class HttpResponse:
+    __slots__ = ("version", "status", "headers", "body")
+
     def __init__(
         self,
         version: HttpVersion,
@@ -140,24 +350,39 @@ class HttpResponse:
             ")"
         )
 
-    def to_bytes(self) -> bytes:
-        res: str = f"{self.version.value} {self.status.value}\r\n"
-
-        for key, val in self.headers.items():
-            res += f"{key}: {val}\r\n"
-
-        res += "\r\n"
-
+    def set_keep_alive(self, keep_alive: bool, req_version: HttpVersion):
+        """Tells the client whether the connection stays open after this response"""
+        if not keep_alive:
+            self.headers["Connection"] = "close"
+        elif req_version == HttpVersion.V1_0:
+            self.headers["Connection"] = "keep-alive"
+
+    def head_buffers(self) -> list[bytes]:
+        """Status line and header lines, including the empty line before the body,
+        as separate buffers to be written with a single gather write"""
+        buffers = [STATUS_LINES[self.version, self.status]]
+        buffers.extend(header_line(key, val) for key, val in self.headers.items())
+        buffers.append(b"\r\n")
+        return buffers
+
+    def head_bytes(self) -> bytes:
+        return b"".join(self.head_buffers())
+
+    def to_buffers(self) -> list[bytes]:
+        """The whole response for an in-memory body, which is not copied. Bodies
+        sent by the connection layer itself (files, streams) are read"""
+        buffers = self.head_buffers()
         if self.body:
             if isinstance(self.body, bytes):
-                return res.encode() + self.body
+                buffers.append(self.body)
             elif isinstance(self.body, str):
-                res += self.body
-                return res.encode()
-            else:
-                return res.encode()
-        else:
-            return res.encode()
+                buffers.append(self.body.encode())
+            elif isinstance(self.body, (FileBody, StreamBody, CompositeBody)):
+                buffers.append(self.body.read())
+        return buffers
+
+    def to_bytes(self) -> bytes:
+        return b"".join(self.to_buffers())
 
     @classmethod
     def empty(
@@ -172,23 +397,171 @@ class HttpResponse:
             body="",
         )
 
+    @classmethod
+    def not_modified(
+        cls, validators: dict[str, str], version: HttpVersion = HttpVersion.V1_1
+    ) -> Self:
+        """304: no body, and no Content-Length which would describe the version the
+        client already has rather than this empty response"""
+        return cls(
+            version=version,
+            status=HttpStatus.NotModified304,
+            headers=validators,
+            body="",
+        )
+
+    @classmethod
+    def informational(
+        cls, status: HttpStatus, version: HttpVersion = HttpVersion.V1_1
+    ) -> Self:
+        """1xx interim response: no body and no Content-Length"""
+        return cls(version=version, status=status, headers={}, body="")
+
     @classmethod
     def text_content(
         cls,
         version: HttpVersion = HttpVersion.V1_1,
         status: HttpStatus = HttpStatus.Ok200,
-        content: str = "",
+        content: str | bytes = "",
+        content_type: str = "text/plain",
+        content_encoding: str | None = None,
+    ) -> Self:
+        body = content.encode() if isinstance(content, str) else content
+
+        if content_encoding:
+            body = compress_bytes(body, content_encoding)
+        return cls.encoded_content(
+            version=version,
+            status=status,
+            content=body,
+            content_type=content_type,
+            content_encoding=content_encoding,
+        )
+
+    @classmethod
+    def encoded_content(
+        cls,
+        version: HttpVersion = HttpVersion.V1_1,
+        status: HttpStatus = HttpStatus.Ok200,
+        content: bytes = b"",
         content_type: str = "text/plain",
         content_encoding: str | None = None,
     ) -> Self:
-        content_len = len(content)
-        body = content
-        headers = {"Content-Type": content_type, "Content-Length": str(content_len)}
-
-        if content_encoding == "gzip":
-            headers["Content-Encoding"] = "gzip"
-            body = gzip.compress(content.encode(), compresslevel=6)
-            headers["Content-Length"] = str(len(body))
+        """Same as `text_content` for a content already compressed with
+        `content_encoding`"""
+        headers = {"Content-Type": content_type}
+        if content_encoding:
+            headers["Content-Encoding"] = content_encoding
+        headers["Content-Length"] = str(len(content))
+        return cls(
+            version=version,
+            status=status,
+            headers=headers,
+            body=content,
+        )
+
+    @classmethod
+    def partial_file_content(
+        cls,
+        path: pathlib.Path,
+        ranges: list[ByteRange],
+        size: int,
+        version: HttpVersion = HttpVersion.V1_1,
+        content_type: str = "application/octet-stream",
+        source: FileInfo | None = None,
+    ) -> Self:
+        """206 response for satisfiable ranges of the file. Each slice is sent from
+        its offset in the file, the rest of the file is never read"""
+        if len(ranges) == 1:
+            start, end = ranges[0]
+            body = FileBody(path, offset=start, count=end - start + 1, source=source)
+            headers = {
+                "Content-Type": content_type,
+                "Content-Range": content_range(start, end, size),
+                "Content-Length": str(len(body)),
+            }
+            return cls(
+                version=version,
+                status=HttpStatus.PartialContent206,
+                headers=headers,
+                body=body,
+            )
+
+        boundary = multipart_boundary()
+        parts: list[bytes | FileBody] = []
+        for i, (start, end) in enumerate(ranges):
+            # the CRLF before a delimiter belongs to the delimiter
+            separator = "" if i == 0 else "\r\n"
+            part_head = (
+                f"{separator}--{boundary}\r\n"
+                f"Content-Type: {content_type}\r\n"
+                f"Content-Range: {content_range(start, end, size)}\r\n\r\n"
+            )
+            parts.append(part_head.encode())
+            parts.append(
+                FileBody(path, offset=start, count=end - start + 1, source=source)
+            )
+        parts.append(f"\r\n--{boundary}--\r\n".encode())
+        body = CompositeBody(parts)
+        headers = {
+            "Content-Type": f"multipart/byteranges; boundary={boundary}",
+            "Content-Length": str(len(body)),
+        }
+        return cls(
+            version=version,
+            status=HttpStatus.PartialContent206,
+            headers=headers,
+            body=body,
+        )
+
+    @classmethod
+    def range_not_satisfiable(
+        cls, size: int, version: HttpVersion = HttpVersion.V1_1
+    ) -> Self:
+        return cls(
+            version=version,
+            status=HttpStatus.RangeNotSatisfiable416,
+            headers={"Content-Range": unsatisfied_range(size), "Content-Length": "0"},
+            body="",
+        )
+
+    @classmethod
+    def stream_content(
+        cls,
+        chunks: Iterable[bytes] | AsyncIterable[bytes],
+        version: HttpVersion = HttpVersion.V1_1,
+        status: HttpStatus = HttpStatus.Ok200,
+        content_type: str = "application/octet-stream",
+        content_encoding: str | None = None,
+    ) -> Self:
+        """Chunked response: only for HTTP/1.1 clients"""
+        headers = {"Content-Type": content_type}
+        if content_encoding:
+            headers["Content-Encoding"] = content_encoding
+        headers["Transfer-Encoding"] = "chunked"
+        return cls(
+            version=version,
+            status=status,
+            headers=headers,
+            body=StreamBody(chunks),
+        )
+
+    @classmethod
+    def file_content(
+        cls,
+        path: pathlib.Path,
+        version: HttpVersion = HttpVersion.V1_1,
+        status: HttpStatus = HttpStatus.Ok200,
+        content_type: str = "application/octet-stream",
+        content_encoding: str | None = None,
+        source: FileInfo | None = None,
+    ) -> Self:
+        """`content_encoding` is set when the file is already compressed"""
+        body = FileBody(path, source=source)
+        headers = {"Content-Type": content_type}
+        if content_encoding:
+            headers["Content-Encoding"] = content_encoding
+        headers["Content-Length"] = str(len(body))
         return cls(
             version=version,
             status=status,
@@ -0,0 +1,813 @@
+"""HTTP/2 over cleartext TCP (h2c, RFC 9113) for the asyncio engine.
+
+A client starts HTTP/2 either with prior knowledge, sending the connection preface
+right away, or by asking to upgrade an HTTP/1.1 request (`Upgrade: h2c`), in which
+case the response to that request is the first stream of the connection. See
+`handle_connection_async` for both.
+
+The connection is a sequence of frames. Requests come as streams, each a HEADERS
+block (HPACK compressed, see `app.hpack`) followed by DATA frames, which can be
+interleaved with those of the other streams. Once a request is received (END_STREAM)
+it is answered by a task of its own, so that many requests are in progress at
+once over the same connection: up to `http2_max_streams`, beyond which new streams
+are refused.
+
+Flow control: the peer grants how many DATA bytes may be sent, per stream and for
+the whole connection. Responses wait for WINDOW_UPDATE frames when they exhaust
+either window. Received bodies are buffered whole for the handlers, so the window
+granted to the client is given back as soon as the bytes are received, bounded by
+`max_body_size` rather than by flow control.
+"""
+
+import asyncio
+import base64
+import time
+from enum import IntEnum
+
+from app.api import handle_req_async
+from app.config import ServerConfig
+from app.fast_parser import HttpParseError, parse_urlpath
+from app.framing import InvalidRequest
+from app.headers import Headers
+from app.hpack import Decoder, Encoder, HeaderField, HeaderListTooLarge, HpackError
+from app.http import (
+    METHODS,
+    CompositeBody,
+    FileBody,
+    HttpBody,
+    HttpRequest,
+    HttpResponse,
+    HttpStatus,
+    HttpUrlPath,
+    HttpVersion,
+    StreamBody,
+)
+from app.metrics import METRICS, UNMATCHED
+from app.offload import run_blocking
+
+PREFACE = b"PRI * HTTP/2.0\r\n\r\nSM\r\n\r\n"
+# what the HTTP/1 framer sees of the preface: a request without headers
+PREFACE_HEAD = PREFACE[:18]
+
+FRAME_HEADER_LEN = 9
+DEFAULT_MAX_FRAME_SIZE = 16384
+DEFAULT_WINDOW = 65535
+MAX_WINDOW = 2**31 - 1
+# granted to the client per stream and for the connection, so that uploads are not
+# throttled by round trips
+RECEIVE_WINDOW = 1024**2
+# files are read and sent by slices of this size
+FILE_SLICE = 64 * 1024
+
+
+class FrameType(IntEnum):
+    DATA = 0x0
+    HEADERS = 0x1
+    PRIORITY = 0x2
+    RST_STREAM = 0x3
+    SETTINGS = 0x4
+    PUSH_PROMISE = 0x5
+    PING = 0x6
+    GOAWAY = 0x7
+    WINDOW_UPDATE = 0x8
+    CONTINUATION = 0x9
+
+
+class Flag:
+    END_STREAM = 0x1
+    ACK = 0x1
+    END_HEADERS = 0x4
+    PADDED = 0x8
+    PRIORITY = 0x20
+
+
+class ErrorCode(IntEnum):
+    NO_ERROR = 0x0
+    PROTOCOL_ERROR = 0x1
+    INTERNAL_ERROR = 0x2
+    FLOW_CONTROL_ERROR = 0x3
+    STREAM_CLOSED = 0x5
+    FRAME_SIZE_ERROR = 0x6
+    REFUSED_STREAM = 0x7
+    CANCEL = 0x8
+    COMPRESSION_ERROR = 0x9
+    ENHANCE_YOUR_CALM = 0xB
+
+
+class Setting(IntEnum):
+    HEADER_TABLE_SIZE = 0x1
+    ENABLE_PUSH = 0x2
+    MAX_CONCURRENT_STREAMS = 0x3
+    INITIAL_WINDOW_SIZE = 0x4
+    MAX_FRAME_SIZE = 0x5
+    MAX_HEADER_LIST_SIZE = 0x6
+
+
+# meaningless in HTTP/2, where they make a message malformed
+CONNECTION_HEADERS = frozenset(
+    (
+        b"connection",
+        b"keep-alive",
+        b"proxy-connection",
+        b"transfer-encoding",
+        b"upgrade",
+    )
+)
+RESPONSE_CONNECTION_HEADERS = frozenset(h.decode() for h in CONNECTION_HEADERS)
+# response headers changing from one response to the next: not worth a place in
+# the table of the client
+NOT_INDEXED = frozenset(
+    (b"content-length", b"content-range", b"etag", b"last-modified", b"retry-after")
+)
+
+
+class H2ConnectionError(Exception):
+    """Ends the connection with a GOAWAY"""
+
+    def __init__(self, code: ErrorCode, message: str):
+        super().__init__(message)
+        self.code = code
+
+
+class H2StreamError(Exception):
+    """Ends a stream with a RST_STREAM, the connection goes on"""
+
+    def __init__(self, stream_id: int, code: ErrorCode, message: str):
+        super().__init__(message)
+        self.stream_id = stream_id
+        self.code = code
+
+
+def frame(type: FrameType, flags: int, stream_id: int, payload: bytes = b"") -> bytes:
+    return (
+        len(payload).to_bytes(3, "big")
+        + bytes((type, flags))
+        + stream_id.to_bytes(4, "big")
+        + payload
+    )
+
+
+def frame_header(type: FrameType, flags: int, stream_id: int, length: int) -> bytes:
+    return (
+        length.to_bytes(3, "big") + bytes((type, flags)) + stream_id.to_bytes(4, "big")
+    )
+
+
+def parse_settings(payload: bytes) -> dict[int, int]:
+    if len(payload) % 6:
+        raise H2ConnectionError(ErrorCode.FRAME_SIZE_ERROR, "Invalid SETTINGS length")
+    return {
+        int.from_bytes(payload[i : i + 2], "big"): int.from_bytes(
+            payload[i + 2 : i + 6], "big"
+        )
+        for i in range(0, len(payload), 6)
+    }
+
+
+def check_settings(settings: dict[int, int]):
+    """Raises `H2ConnectionError` on a value out of the range of its setting"""
+    for key, value in settings.items():
+        match key:
+            case Setting.ENABLE_PUSH if value > 1:
+                raise H2ConnectionError(ErrorCode.PROTOCOL_ERROR, "ENABLE_PUSH")
+            case Setting.INITIAL_WINDOW_SIZE if value > MAX_WINDOW:
+                raise H2ConnectionError(
+                    ErrorCode.FLOW_CONTROL_ERROR, "INITIAL_WINDOW_SIZE"
+                )
+            case Setting.MAX_FRAME_SIZE if not (
+                DEFAULT_MAX_FRAME_SIZE <= value < 2**24
+            ):
+                raise H2ConnectionError(ErrorCode.PROTOCOL_ERROR, "MAX_FRAME_SIZE")
+
+
+def encode_settings(settings: dict[int, int]) -> bytes:
+    return b"".join(
+        key.to_bytes(2, "big") + value.to_bytes(4, "big")
+        for key, value in settings.items()
+    )
+
+
+def strip_padding(flags: int, payload: bytes) -> bytes:
+    if not flags & Flag.PADDED:
+        return payload
+    if not payload or payload[0] >= len(payload):
+        raise H2ConnectionError(ErrorCode.PROTOCOL_ERROR, "Invalid padding")
+    return payload[1 : len(payload) - payload[0]]
+
+
+def wants_h2c_upgrade(req: HttpRequest) -> bool:
+    """HTTP/1.1 request asking to continue in HTTP/2 (RFC 7540 section 3.2)"""
+    if req.version != HttpVersion.V1_1 or "HTTP2-Settings" not in req.headers:
+        return False
+    upgrade = req.headers.get("Upgrade", "").lower()
+    connection = req.headers.get("Connection", "").lower()
+    return "h2c" in (token.strip() for token in upgrade.split(",")) and (
+        "http2-settings" in (token.strip() for token in connection.split(","))
+    )
+
+
+def switching_protocols() -> HttpResponse:
+    res = HttpResponse.informational(HttpStatus.SwitchingProtocols101)
+    res.headers["Connection"] = "Upgrade"
+    res.headers["Upgrade"] = "h2c"
+    return res
+
+
+def request_from_fields(fields: list[HeaderField], stream_id: int) -> HttpRequest:
+    """Raises `H2StreamError` if the request is malformed"""
+    pseudo: dict[bytes, bytes] = {}
+    regular: list[HeaderField] = []
+    for name, value in fields:
+        if name.startswith(b":"):
+            if regular or name in pseudo:
+                raise malformed(stream_id, f"Misplaced pseudo-header {name!r}")
+            pseudo[name] = value
+        elif name in CONNECTION_HEADERS or name != name.lower():
+            raise malformed(stream_id, f"Invalid header {name!r}")
+        elif name == b"te" and value != b"trailers":
+            raise malformed(stream_id, "Invalid te header")
+        else:
+            regular.append((name, value))
+
+    method = METHODS.get(pseudo.pop(b":method", b"").decode())
+    target = pseudo.pop(b":path", b"")
+    authority = pseudo.pop(b":authority", None)
+    if method is None or not target or pseudo.pop(b":scheme", None) is None:
+        raise malformed(stream_id, "Missing or unsupported pseudo-header")
+    if pseudo:
+        raise malformed(stream_id, f"Unknown pseudo-headers {list(pseudo)}")
+    try:
+        _, path, query_params = parse_urlpath(target.decode())
+    except (HttpParseError, UnicodeDecodeError) as e:
+        raise malformed(stream_id, str(e)) from None
+    if authority is not None and not any(name == b"host" for name, _ in regular):
+        regular.append((b"host", authority))
+    return HttpRequest(
+        method=method,
+        urlpath=HttpUrlPath(
+            host=authority.decode() if authority else None,
+            path=path,
+            query_params=query_params,
+        ),
+        version=HttpVersion.V2_0,
+        headers=Headers.from_fields(regular),
+        body=b"",
+    )
+
+
+def malformed(stream_id: int, message: str) -> H2StreamError:
+    return H2StreamError(stream_id, ErrorCode.PROTOCOL_ERROR, message)
+
+
+def response_fields(res: HttpResponse) -> list[HeaderField]:
+    fields = [(b":status", res.status.code.encode())]
+    for name, value in res.headers.items():
+        name = name.lower()
+        if name not in RESPONSE_CONNECTION_HEADERS:
+            fields.append((name.encode(), value.encode()))
+    return fields
+
+
+class Stream:
+    __slots__ = (
+        "id",
+        "req",
+        "body",
+        "remote_closed",
+        "send_window",
+        "receive_window",
+        "last_active",
+        "task",
+    )
+
+    def __init__(self, stream_id: int, req: HttpRequest, send_window: int):
+        self.id = stream_id
+        self.req = req
+        self.body = bytearray()
+        # the client sent END_STREAM
+        self.remote_closed = False
+        self.send_window = send_window
+        self.receive_window = RECEIVE_WINDOW
+        self.last_active = time.monotonic()
+        # answering the request once received
+        self.task: asyncio.Task | None = None
+
+
+class H2Connection:
+    def __init__(
+        self,
+        reader: asyncio.StreamReader,
+        writer: asyncio.StreamWriter,
+        directory: str | None,
+        config: ServerConfig,
+        received: bytes = b"",
+    ):
+        self.reader = reader
+        self.writer = writer
+        self.directory = directory
+        self.config = config
+        # bytes received by the HTTP/1 framer before switching to HTTP/2
+        self.received = bytearray(received)
+        self.decoder = Decoder()
+        self.encoder = Encoder(not_indexed=NOT_INDEXED)
+        self.streams: dict[int, Stream] = {}
+        self.last_stream_id = 0
+        # settings of the client
+        self.max_frame_size = DEFAULT_MAX_FRAME_SIZE
+        self.initial_window = DEFAULT_WINDOW
+        self.send_window = DEFAULT_WINDOW
+        self.receive_window = RECEIVE_WINDOW
+        # set when a window grows, for the responses waiting for one
+        self.window_open = asyncio.Event()
+        # stream whose header block continues in CONTINUATION frames, and its block
+        self.continued: tuple[int, int, bytearray] | None = None
+        self.closing = False
+
+    # receiving ###################################################
+
+    async def read_exactly(self, n: int, timeout: float | None) -> bytes:
+        if self.received:
+            data = bytes(self.received[:n])
+            del self.received[:n]
+            if len(data) == n:
+                return data
+            n -= len(data)
+        else:
+            data = b""
+        data += await asyncio.wait_for(self.reader.readexactly(n), timeout)
+        METRICS.count_bytes_in(n)
+        return data
+
+    async def read_frame(self) -> tuple[int, int, int, bytes] | None:
+        """None once the connection is idle for `keep_alive_timeout` seconds"""
+        try:
+            header = await self.read_exactly(
+                FRAME_HEADER_LEN, self.config.keep_alive_timeout
+            )
+        except TimeoutError:
+            return None
+        length = int.from_bytes(header[:3], "big")
+        if length > DEFAULT_MAX_FRAME_SIZE:
+            raise H2ConnectionError(ErrorCode.FRAME_SIZE_ERROR, "Frame too large")
+        # a frame started must come entirely
+        payload = await self.read_exactly(length, self.config.body_timeout)
+        stream_id = int.from_bytes(header[5:9], "big") & 0x7FFFFFFF
+        return header[3], header[4], stream_id, payload
+
+    async def serve(
+        self,
+        preface: bytes = PREFACE,
+        upgrade: HttpRequest | None = None,
+        settings: dict[int, int] | None = None,
+    ):
+        """Serves the connection until it is closed. `preface` is what is left to
+        receive of the client preface, `upgrade` the request that asked for h2c and
+        `settings` those it carried, see `upgrade_settings`"""
+        own_settings = {
+            Setting.MAX_CONCURRENT_STREAMS: self.config.http2_max_streams,
+            Setting.INITIAL_WINDOW_SIZE: RECEIVE_WINDOW,
+        }
+        if self.config.max_header_size:
+            own_settings[Setting.MAX_HEADER_LIST_SIZE] = self.config.max_header_size
+        self.write(
+            frame(FrameType.SETTINGS, 0, 0, encode_settings(own_settings)),
+            frame(
+                FrameType.WINDOW_UPDATE,
+                0,
+                0,
+                (RECEIVE_WINDOW - DEFAULT_WINDOW).to_bytes(4, "big"),
+            ),
+        )
+        try:
+            if upgrade is not None:
+                self.apply_settings(settings or {})
+                upgrade.version = HttpVersion.V2_0
+                self.last_stream_id = 1
+                stream = self.open_stream(1, upgrade)
+                self.end_of_request(stream)
+
+            received = await self.read_exactly(
+                len(preface), self.config.keep_alive_timeout
+            )
+            if received != preface:
+                raise H2ConnectionError(ErrorCode.PROTOCOL_ERROR, "Invalid preface")
+            while not self.closing:
+                received = await self.read_frame()
+                if received is None:
+                    if not self.streams:
+                        self.go_away(ErrorCode.NO_ERROR)
+                        break
+                    self.expire_streams()
+                    continue
+                try:
+                    self.on_frame(*received)
+                except H2StreamError as e:
+                    self.reset(e.stream_id, e.code)
+            else:
+                # GOAWAY from the client: the streams in progress are answered
+                tasks = [s.task for s in self.streams.values() if s.task]
+                if tasks:
+                    await asyncio.wait(tasks, timeout=self.config.shutdown_timeout)
+        except H2ConnectionError as e:
+            print(f"HTTP/2 connection error: {e}")
+            self.go_away(e.code)
+        except (asyncio.IncompleteReadError, TimeoutError):
+            pass
+        finally:
+            for stream in self.streams.values():
+                if stream.task is not None:
+                    stream.task.cancel()
+            try:
+                await asyncio.wait_for(self.writer.drain(), self.config.write_timeout)
+            except (ConnectionError, TimeoutError):
+                self.writer.transport.abort()
+
+    def on_frame(self, type: int, flags: int, stream_id: int, payload: bytes):
+        if self.continued is not None and (
+            type != FrameType.CONTINUATION or stream_id != self.continued[0]
+        ):
+            raise H2ConnectionError(
+                ErrorCode.PROTOCOL_ERROR, "Header block interrupted"
+            )
+        match type:
+            case FrameType.DATA:
+                self.on_data(flags, stream_id, payload)
+            case FrameType.HEADERS:
+                self.on_headers(flags, stream_id, payload)
+            case FrameType.CONTINUATION:
+                self.on_continuation(flags, stream_id, payload)
+            case FrameType.PRIORITY:
+                if len(payload) != 5:
+                    raise H2StreamError(
+                        stream_id, ErrorCode.FRAME_SIZE_ERROR, "Invalid PRIORITY"
+                    )
+            case FrameType.RST_STREAM:
+                self.on_rst_stream(stream_id, payload)
+            case FrameType.SETTINGS:
+                self.on_settings(flags, stream_id, payload)
+            case FrameType.PING:
+                if len(payload) != 8 or stream_id:
+                    raise H2ConnectionError(ErrorCode.FRAME_SIZE_ERROR, "Invalid PING")
+                if not flags & Flag.ACK:
+                    self.write(frame(FrameType.PING, Flag.ACK, 0, payload))
+            case FrameType.GOAWAY:
+                self.closing = True
+            case FrameType.WINDOW_UPDATE:
+                self.on_window_update(stream_id, payload)
+            case FrameType.PUSH_PROMISE:
+                raise H2ConnectionError(
+                    ErrorCode.PROTOCOL_ERROR, "PUSH_PROMISE from a client"
+                )
+            # unknown frame types are ignored
+
+    def on_data(self, flags: int, stream_id: int, payload: bytes):
+        if not stream_id:
+            raise H2ConnectionError(ErrorCode.PROTOCOL_ERROR, "DATA on stream 0")
+        # padding included
+        self.receive_window -= len(payload)
+        if self.receive_window < 0:
+            raise H2ConnectionError(ErrorCode.FLOW_CONTROL_ERROR, "Window exceeded")
+        self.give_back_window(0)
+
+        stream = self.streams.get(stream_id)
+        if stream is None:
+            if stream_id > self.last_stream_id:
+                raise H2ConnectionError(ErrorCode.PROTOCOL_ERROR, "DATA on idle stream")
+            # the rest of a request that was answered or reset already
+            return
+        if stream.remote_closed:
+            raise H2StreamError(stream_id, ErrorCode.STREAM_CLOSED, "Stream closed")
+        stream.last_active = time.monotonic()
+        stream.receive_window -= len(payload)
+        if stream.receive_window < 0:
+            raise H2StreamError(
+                stream_id, ErrorCode.FLOW_CONTROL_ERROR, "Window exceeded"
+            )
+        stream.body += strip_padding(flags, payload)
+        if not self.config.allows_body_size(len(stream.body)):
+            self.refuse(stream_id, HttpStatus.PayloadTooLarge413)
+            return
+        if flags & Flag.END_STREAM:
+            self.end_of_request(stream)
+        else:
+            self.give_back_window(stream_id)
+
+    def give_back_window(self, stream_id: int):
+        """Once half of a receive window is used, it is given back whole: bodies
+        are buffered rather than read by the handlers"""
+        holder = self.streams[stream_id] if stream_id else self
+        used = RECEIVE_WINDOW - holder.receive_window
+        if used >= RECEIVE_WINDOW // 2:
+            holder.receive_window = RECEIVE_WINDOW
+            self.write(
+                frame(FrameType.WINDOW_UPDATE, 0, stream_id, used.to_bytes(4, "big"))
+            )
+
+    def on_headers(self, flags: int, stream_id: int, payload: bytes):
+        if not stream_id:
+            raise H2ConnectionError(ErrorCode.PROTOCOL_ERROR, "HEADERS on stream 0")
+        payload = strip_padding(flags, payload)
+        if flags & Flag.PRIORITY:
+            payload = payload[5:]
+        self.continued = (stream_id, flags, bytearray(payload))
+        self.on_continuation(flags, stream_id, b"")
+
+    def on_continuation(self, flags: int, stream_id: int, payload: bytes):
+        if self.continued is None:
+            raise H2ConnectionError(ErrorCode.PROTOCOL_ERROR, "Unexpected CONTINUATION")
+        _, headers_flags, block = self.continued
+        block += payload
+        if self.config.max_header_size and len(block) > self.config.max_header_size:
+            raise H2ConnectionError(
+                ErrorCode.ENHANCE_YOUR_CALM, "Header block too large"
+            )
+        if not flags & Flag.END_HEADERS:
+            return
+        self.continued = None
+        try:
+            fields = self.decoder.decode(block, self.config.max_header_size)
+        except HeaderListTooLarge:
+            fields = None
+        except HpackError as e:
+            raise H2ConnectionError(ErrorCode.COMPRESSION_ERROR, str(e)) from None
+        self.on_header_block(headers_flags, stream_id, fields)
+
+    def on_header_block(
+        self, flags: int, stream_id: int, fields: list[HeaderField] | None
+    ):
+        """`fields` is None when they go beyond `max_header_size`"""
+        stream = self.streams.get(stream_id)
+        if stream is not None:
+            # trailers, ignored
+            if stream.remote_closed:
+                raise H2StreamError(stream_id, ErrorCode.STREAM_CLOSED, "Stream closed")
+            if not flags & Flag.END_STREAM:
+                raise malformed(stream_id, "Trailers without END_STREAM")
+            self.end_of_request(stream)
+            return
+
+        if stream_id % 2 == 0 or stream_id <= self.last_stream_id:
+            raise H2ConnectionError(ErrorCode.PROTOCOL_ERROR, "Invalid stream id")
+        self.last_stream_id = stream_id
+        if len(self.streams) >= self.config.http2_max_streams:
+            raise H2StreamError(stream_id, ErrorCode.REFUSED_STREAM, "Too many streams")
+        if fields is None:
+            self.refuse(stream_id, HttpStatus.RequestHeaderFieldsTooLarge431)
+            return
+        req = request_from_fields(fields, stream_id)
+        stream = self.open_stream(stream_id, req)
+
+        if self.config.max_request_line and (
+            len(req.urlpath.path) > self.config.max_request_line
+        ):
+            self.refuse(stream_id, HttpStatus.UriTooLong414)
+        elif flags & Flag.END_STREAM:
+            self.end_of_request(stream)
+
+    def on_rst_stream(self, stream_id: int, payload: bytes):
+        if len(payload) != 4:
+            raise H2ConnectionError(ErrorCode.FRAME_SIZE_ERROR, "Invalid RST_STREAM")
+        if not stream_id or stream_id > self.last_stream_id:
+            raise H2ConnectionError(
+                ErrorCode.PROTOCOL_ERROR, "RST_STREAM on idle stream"
+            )
+        stream = self.streams.pop(stream_id, None)
+        if stream is not None and stream.task is not None:
+            stream.task.cancel()
+
+    def on_settings(self, flags: int, stream_id: int, payload: bytes):
+        if stream_id:
+            raise H2ConnectionError(ErrorCode.PROTOCOL_ERROR, "SETTINGS on a stream")
+        if flags & Flag.ACK:
+            if payload:
+                raise H2ConnectionError(ErrorCode.FRAME_SIZE_ERROR, "SETTINGS ACK")
+            return
+        self.apply_settings(parse_settings(payload))
+        self.write(frame(FrameType.SETTINGS, Flag.ACK, 0))
+
+    def apply_settings(self, settings: dict[int, int]):
+        check_settings(settings)
+        for key, value in settings.items():
+            match key:
+                case Setting.HEADER_TABLE_SIZE:
+                    self.encoder.resize(min(value, self.decoder.max_table_size))
+                case Setting.INITIAL_WINDOW_SIZE:
+                    for stream in self.streams.values():
+                        stream.send_window += value - self.initial_window
+                    self.initial_window = value
+                    self.window_open.set()
+                case Setting.MAX_FRAME_SIZE:
+                    self.max_frame_size = value
+
+    def on_window_update(self, stream_id: int, payload: bytes):
+        if len(payload) != 4:
+            raise H2ConnectionError(ErrorCode.FRAME_SIZE_ERROR, "Invalid WINDOW_UPDATE")
+        increment = int.from_bytes(payload, "big") & 0x7FFFFFFF
+        if not stream_id:
+            if not increment:
+                raise H2ConnectionError(ErrorCode.PROTOCOL_ERROR, "Increment of 0")
+            self.send_window += increment
+            if self.send_window > MAX_WINDOW:
+                raise H2ConnectionError(
+                    ErrorCode.FLOW_CONTROL_ERROR, "Window too large"
+                )
+        else:
+            stream = self.streams.get(stream_id)
+            if stream is None:
+                return
+            if not increment:
+                raise malformed(stream_id, "Increment of 0")
+            stream.send_window += increment
+            if stream.send_window > MAX_WINDOW:
+                raise H2StreamError(
+                    stream_id, ErrorCode.FLOW_CONTROL_ERROR, "Window too large"
+                )
+        self.window_open.set()
+
+    def expire_streams(self):
+        """Resets the streams whose client stopped sending the body"""
+        now = time.monotonic()
+        for stream in list(self.streams.values()):
+            if (
+                not stream.remote_closed
+                and now - stream.last_active > self.config.body_timeout
+            ):
+                self.reset(stream.id, ErrorCode.CANCEL)
+
+    # answering ###################################################
+
+    def open_stream(self, stream_id: int, req: HttpRequest) -> Stream:
+        stream = Stream(stream_id, req, self.initial_window)
+        self.streams[stream_id] = stream
+        return stream
+
+    def end_of_request(self, stream: Stream):
+        stream.remote_closed = True
+        stream.req.body = memoryview(stream.body)
+        stream.task = asyncio.get_running_loop().create_task(self.respond(stream))
+
+    def refuse(self, stream_id: int, status: HttpStatus):
+        """Answers without waiting for the rest of the request, which is then
+        reset: the frames still coming for it are ignored"""
+        res = HttpResponse.empty(status=status)
+        METRICS.count_request(UNMATCHED, res.status.code)
+        self.send_headers(stream_id, res, end_stream=True)
+        self.reset(stream_id, ErrorCode.NO_ERROR)
+
+    async def respond(self, stream: Stream):
+        """A handler failing gets a 500: the stream must end, or it would count
+        against `http2_max_streams` and keep the connection open"""
+        start = time.perf_counter()
+        try:
+            res = await handle_req_async(stream.req, self.directory, self.config)
+        except Exception as e:
+            print(f"Error while handling stream {stream.id}: {e!r}")
+            res = HttpResponse.empty(status=HttpStatus.InternalServerError500)
+            METRICS.count_request(UNMATCHED, res.status.code)
+        METRICS.observe("handle", time.perf_counter() - start)
+        start = time.perf_counter()
+        await self.send(stream, res)
+        METRICS.observe("send", time.perf_counter() - start)
+
+    async def send(self, stream: Stream, res: HttpResponse):
+        try:
+            body = res.body
+            has_body = bool(body) and not (
+                isinstance(body, FileBody) and not body.count
+            )
+            self.send_headers(stream.id, res, end_stream=not has_body)
+            if has_body:
+                await self.send_body(stream, body)
+        except (ConnectionError, TimeoutError) as e:
+            print(f"HTTP/2 connection error while sending: {e!r}")
+            self.closing = True
+            self.writer.transport.abort()
+        except Exception as e:
+            # the headers may be sent already: only the stream can tell the error
+            print(f"Error while sending stream {stream.id}: {e!r}")
+            code = ErrorCode.INTERNAL_ERROR.to_bytes(4, "big")
+            self.write(frame(FrameType.RST_STREAM, 0, stream.id, code))
+        finally:
+            if self.streams.get(stream.id) is stream:
+                del self.streams[stream.id]
+
+    def send_headers(self, stream_id: int, res: HttpResponse, end_stream: bool):
+        """The block and its CONTINUATION frames are written at once: no other frame
+        may come in between, and the blocks must reach the client in the order they
+        were encoded"""
+        block = self.encoder.encode(response_fields(res))
+        size = self.max_frame_size
+        chunks = [block[i : i + size] for i in range(0, len(block), size)] or [b""]
+        frames = []
+        for i, chunk in enumerate(chunks):
+            flags = Flag.END_HEADERS if i == len(chunks) - 1 else 0
+            if i == 0:
+                flags |= Flag.END_STREAM if end_stream else 0
+                frames.append(frame(FrameType.HEADERS, flags, stream_id, chunk))
+            else:
+                frames.append(frame(FrameType.CONTINUATION, flags, stream_id, chunk))
+        self.write(*frames)
+
+    async def send_body(self, stream: Stream, body: HttpBody):
+        match body:
+            case FileBody():
+                await self.send_file(stream, body, end_stream=True)
+            case CompositeBody():
+                for i, part in enumerate(body.parts):
+                    last = i == len(body.parts) - 1
+                    if isinstance(part, FileBody):
+                        await self.send_file(stream, part, end_stream=last)
+                    else:
+                        await self.send_data(stream, part, end_stream=last)
+            case StreamBody():
+                try:
+                    if body.is_async:
+                        async for chunk in body.chunks:
+                            await self.send_data(stream, chunk, end_stream=False)
+                    else:
+                        for chunk in body.chunks:
+                            await self.send_data(stream, chunk, end_stream=False)
+                finally:
+                    await body.aclose()
+                await self.send_data(stream, b"", end_stream=True)
+            case str():
+                await self.send_data(stream, body.encode(), end_stream=True)
+            case _:
+                await self.send_data(stream, body, end_stream=True)
+
+    async def send_file(self, stream: Stream, body: FileBody, end_stream: bool):
+        f = await run_blocking(body.open)
+        try:
+            await run_blocking(f.seek, body.offset)
+            remaining = body.count
+            while remaining:
+                chunk = await run_blocking(f.read, min(remaining, FILE_SLICE))
+                if not chunk:
+                    raise ConnectionError("File truncated while sent")
+                remaining -= len(chunk)
+                await self.send_data(stream, chunk, end_stream and not remaining)
+        finally:
+            f.close()
+
+    async def send_data(self, stream: Stream, data: bytes, end_stream: bool):
+        """DATA frames within the windows granted by the client, waiting for them to
+        grow when exhausted"""
+        view = memoryview(data)
+        while True:
+            size = min(
+                len(view), stream.send_window, self.send_window, self.max_frame_size
+            )
+            if size <= 0 and view:
+                self.window_open.clear()
+                await asyncio.wait_for(
+                    self.window_open.wait(), self.config.write_timeout
+                )
+                continue
+            last = size == len(view)
+            flags = Flag.END_STREAM if end_stream and last else 0
+            self.write(
+                frame_header(FrameType.DATA, flags, stream.id, size), view[:size]
+            )
+            stream.send_window -= size
+            self.send_window -= size
+            view = view[size:]
+            await asyncio.wait_for(self.writer.drain(), self.config.write_timeout)
+            if last:
+                return
+
+    def reset(self, stream_id: int, code: ErrorCode):
+        stream = self.streams.pop(stream_id, None)
+        if stream is not None and stream.task is not None:
+            stream.task.cancel()
+        self.write(frame(FrameType.RST_STREAM, 0, stream_id, code.to_bytes(4, "big")))
+
+    def go_away(self, code: ErrorCode):
+        self.closing = True
+        self.write(
+            frame(
+                FrameType.GOAWAY,
+                0,
+                0,
+                self.last_stream_id.to_bytes(4, "big") + code.to_bytes(4, "big"),
+            )
+        )
+
+    def write(self, *buffers: bytes):
+        if self.writer.transport.is_closing():
+            return
+        METRICS.count_bytes_out(sum(map(len, buffers)))
+        self.writer.writelines(buffers)
+
+
+def upgrade_settings(req: HttpRequest) -> dict[int, int]:
+    """Settings of the client sent base64url encoded in its upgrade request. Raises
+    `InvalidRequest` if they are invalid: the request is then answered with a 400
+    rather than upgraded"""
+    value = req.headers.get("HTTP2-Settings", "").strip()
+    try:
+        payload = base64.urlsafe_b64decode(value + "=" * (-len(value) % 4))
+        settings = parse_settings(payload)
+        check_settings(settings)
+    except (ValueError, H2ConnectionError) as e:
+        raise InvalidRequest(f"Invalid HTTP2-Settings: {e}") from None
+    return settings
@@ -1,39 +1,103 @@
 import asyncio
+import functools
 import multiprocessing
+import os
+import signal
 import socket
+import tempfile
 import threading
-from concurrent.futures import ThreadPoolExecutor
+import weakref
+from multiprocessing.reduction import DupFd
 import argparse
 
+from app.admission import (
+    BoundedThreadPool,
+    ConnectionLimiter,
+    SharedConnectionLimiter,
+    peer_ip,
+    reject,
+    service_unavailable,
+)
+from app.compression import COMPRESSION_CACHE
+from app.file_cache import FILE_CACHE
+from app.config import ServerConfig
 from app.connection_async import handle_connection_async
-from app.connection_sync import handle_connection
+from app.connection_protocol import HttpProtocol
+from app.connection_selectors import SelectorServer
+from app.connection_sync import handle_connection, handle_shared_connection
+from app.metrics import METRICS
+from app.offload import configure as configure_io_threads
+from app.precompress import precompress_directory
+from app.prefork import Shutdown, Supervisor, forward_to_children, raise_shutdown
+from app.profiling import PROFILE_MODES, PROFILER, install_profiling
+from app.response_cache import RESPONSE_CACHE
 
 
-def handle_connection_with_multiprocessing_pool(directory: str):
+def handle_connection_with_multiprocessing_pool(
+    directory: str, config: ServerConfig = ServerConfig()
+):
     """uses a pool of workers to handle concurrent connections"""
-    pool = multiprocessing.Pool(processes=4)
+    pool = multiprocessing.Pool(
+        processes=4, initializer=install_profiling, initargs=(config,)
+    )
+    signal.signal(signal.SIGUSR1, forward_to_children)
+    # the parent accepts all the connections, it counts them
+    limiter = ConnectionLimiter(config.max_connections_per_ip)
+    rejection = service_unavailable(config.retry_after)
     with socket.create_server(("localhost", 4221), reuse_port=True) as server_socket:
         with pool:
             while True:
                 conn, address = server_socket.accept()
+                ip = peer_ip(address)
+                if not limiter.acquire(ip):
+                    reject(conn, rejection)
+                    continue
+
+                # the fd is duplicated for the worker so that the parent can close
+                # its copy right away: otherwise the client never sees the
+                # connection closing when the worker is done with it
+                with conn:
+                    shared_fd = DupFd(conn.fileno())
+                release = functools.partial(release_after, limiter, ip)
+                pool.apply_async(
+                    handle_shared_connection,
+                    (shared_fd, directory, config),
+                    callback=release,
+                    error_callback=release,
+                )
 
-                # handle_connection(conn)
-                pool.apply_async(handle_connection, (conn, directory))
 
+def release_after(limiter: ConnectionLimiter, ip: str, result):
+    """Callback of the connections handled by the pool"""
+    limiter.release(ip)
 
-def handle_connection_with_multithreading_naive(directory):
+
+def handle_connection_with_multithreading_naive(
+    directory, config: ServerConfig = ServerConfig()
+):
     """Spawns a new thread per connection. A bit naive because we can spawn a very
     large nb of threads"""
     threads = []
+    limiter = ConnectionLimiter(config.max_connections_per_ip)
+    rejection = service_unavailable(config.retry_after)
+
+    def handle_and_release(conn: socket.socket, ip: str):
+        try:
+            handle_connection(conn, directory, config)
+        finally:
+            limiter.release(ip)
+
     try:
         with socket.create_server(
             ("localhost", 4221), reuse_port=True
         ) as server_socket:
             while True:
                 conn, address = server_socket.accept()
-                thread = threading.Thread(
-                    target=handle_connection, args=(conn, directory)
-                )
+                ip = peer_ip(address)
+                if not limiter.acquire(ip):
+                    reject(conn, rejection)
+                    continue
+                thread = threading.Thread(target=handle_and_release, args=(conn, ip))
                 thread.start()
                 threads.append(thread)
     except KeyboardInterrupt:
@@ -43,40 +107,236 @@ def handle_connection_with_multithreading_naive(directory):
     print("All threads have finished")
 
 
-def handle_connection_with_thread_pool(directory):
+def serve_with_thread_pool(
+    server_socket: socket.socket,
+    directory,
+    config: ServerConfig = ServerConfig(),
+    limiter: ConnectionLimiter | None = None,
+):
+    """Accept loop of the thread pool mode. Connections beyond what the pool and its
+    queue can take, or beyond the limit of their IP, are turned away with a 503.
+    Leaving the loop waits for the admitted connections to finish"""
+    pool = BoundedThreadPool(
+        functools.partial(handle_connection, directory=directory, config=config),
+        nb_threads=config.threads,
+        max_pending=config.max_pending_connections,
+        retry_after=config.retry_after,
+        limiter=limiter or ConnectionLimiter(config.max_connections_per_ip),
+    )
+    try:
+        while True:
+            conn, address = server_socket.accept()
+            pool.submit(conn, peer_ip(address))
+    finally:
+        # stop accepting before waiting for the connections in progress
+        server_socket.close()
+        pool.shutdown()
+
+
+def handle_connection_with_thread_pool(
+    directory, config: ServerConfig = ServerConfig()
+):
     """Uses the high level interface from concurrent futures to manage a
     threadpool"""
-    max_threads = 4
     try:
         with socket.create_server(
             ("localhost", 4221), reuse_port=True
         ) as server_socket:
-            with ThreadPoolExecutor(max_threads) as executor:
-                while True:
-                    conn, address = server_socket.accept()
-                    executor.submit(handle_connection, conn=conn, directory=directory)
+            serve_with_thread_pool(server_socket, directory, config)
     except KeyboardInterrupt:
         print("Shutting down")
 
 
-async def handle_connection_with_asyncio(directory):
-    """uses asyncio to handle the connections"""
+async def handle_connection_with_asyncio(
+    directory,
+    config: ServerConfig = ServerConfig(),
+    sock: socket.socket | None = None,
+    stop: asyncio.Event | None = None,
+    limiter: ConnectionLimiter | None = None,
+):
+    """uses asyncio to handle the connections. Serves on `sock` if given, until
+    `stop` is set if given: the connections in progress are then left
+    `config.shutdown_timeout` seconds to finish"""
+    connections: set[asyncio.Task] = set()
+    limiter = limiter or ConnectionLimiter(config.max_connections_per_ip)
+
+    async def client_connected(reader, writer):
+        ip = peer_ip(writer.get_extra_info("peername"))
+        if not limiter.acquire(ip):
+            writer.write(service_unavailable(config.retry_after))
+            writer.close()
+            return
+        task = asyncio.current_task()
+        connections.add(task)
+        try:
+            await handle_connection_async(reader, writer, directory, config)
+        finally:
+            connections.discard(task)
+            limiter.release(ip)
+
     # Set up the async server
-    server = await asyncio.start_server(
-        client_connected_cb=lambda r, w: handle_connection_async(r, w, directory),
-        host="localhost",
-        port=4221,
-        reuse_port=True,
-    )
+    if sock is None:
+        server = await asyncio.start_server(
+            client_connected_cb=client_connected,
+            host="localhost",
+            port=4221,
+            reuse_port=True,
+        )
+    else:
+        server = await asyncio.start_server(
+            client_connected_cb=client_connected, sock=sock
+        )
+
+    async with server:
+        print("Server listening on port 4221...")
+        if stop is None:
+            await server.serve_forever()
+        else:
+            await stop.wait()
+            server.close()
+            if connections:
+                await asyncio.wait(connections, timeout=config.shutdown_timeout)
+
+
+def run_asyncio(directory, config: ServerConfig = ServerConfig()):
+    asyncio.run(handle_connection_with_asyncio(directory, config))
+
+
+async def handle_connection_with_asyncio_protocol(
+    directory,
+    config: ServerConfig = ServerConfig(),
+    sock: socket.socket | None = None,
+    stop: asyncio.Event | None = None,
+    limiter: ConnectionLimiter | None = None,
+):
+    """Same as `handle_connection_with_asyncio` with the `asyncio.Protocol` engine"""
+    loop = asyncio.get_running_loop()
+    protocols: weakref.WeakSet[HttpProtocol] = weakref.WeakSet()
+    limiter = limiter or ConnectionLimiter(config.max_connections_per_ip)
+
+    def protocol_factory():
+        protocol = HttpProtocol(directory, config, limiter)
+        protocols.add(protocol)
+        return protocol
+
+    if sock is None:
+        server = await loop.create_server(
+            protocol_factory, host="localhost", port=4221, reuse_port=True
+        )
+    else:
+        server = await loop.create_server(protocol_factory, sock=sock)
 
     async with server:
         print("Server listening on port 4221...")
-        await server.serve_forever()
+        if stop is None:
+            await server.serve_forever()
+        else:
+            await stop.wait()
+            server.close()
+            # connections in progress are given some time to finish
+            deadline = loop.time() + config.shutdown_timeout
+            while loop.time() < deadline and any(
+                not p.transport.is_closing() for p in protocols
+            ):
+                await asyncio.sleep(0.1)
+
+
+def run_asyncio_protocol(directory, config: ServerConfig = ServerConfig()):
+    asyncio.run(handle_connection_with_asyncio_protocol(directory, config))
+
+
+def handle_connection_with_selectors(directory, config: ServerConfig = ServerConfig()):
+    """Single threaded readiness loop (epoll on Linux) over non-blocking sockets"""
+    server_socket = socket.create_server(("localhost", 4221), reuse_port=True)
+    print("Server listening on port 4221...")
+    SelectorServer(directory, config).serve_forever(server_socket)
+
+
+async def serve_asyncio_until_terminated(
+    server_socket: socket.socket,
+    directory,
+    config: ServerConfig,
+    limiter: ConnectionLimiter | None = None,
+):
+    stop = asyncio.Event()
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stop.set)
+    if config.prefork_engine == "asyncio-protocol":
+        serve = handle_connection_with_asyncio_protocol
+    else:
+        serve = handle_connection_with_asyncio
+    await serve(directory, config, sock=server_socket, stop=stop, limiter=limiter)
+
+
+def run_prefork_worker(
+    directory, config: ServerConfig, limiter: SharedConnectionLimiter | None = None
+):
+    """Body of a pre-fork worker process: binds its own listener and serves it with
+    the configured engine until the supervisor sends SIGTERM. `limiter` counts the
+    connections of all the workers"""
+    # the supervisor decides when workers stop
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, raise_shutdown)
+    install_profiling(config)
+    if config.metrics_dir:
+        METRICS.share(config.metrics_dir, config.metrics_flush_interval)
+    server_socket = socket.create_server(("localhost", 4221), reuse_port=True)
+    try:
+        match config.prefork_engine:
+            case "asyncio" | "asyncio-protocol":
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                asyncio.run(
+                    serve_asyncio_until_terminated(
+                        server_socket, directory, config, limiter
+                    )
+                )
+            case "selectors":
+                SelectorServer(directory, config, limiter).serve_forever(server_socket)
+            case _:
+                serve_with_thread_pool(server_socket, directory, config, limiter)
+    except Shutdown:
+        pass
+    finally:
+        server_socket.close()
+        # what was recorded since the last periodic flush
+        METRICS.flush()
+        PROFILER.stop()
+
+
+def handle_connection_with_prefork(directory, config: ServerConfig = ServerConfig()):
+    """N worker processes each accepting on their own SO_REUSEPORT listener"""
+    nb_workers = config.workers or os.cpu_count() or 1
+    limiter = SharedConnectionLimiter(config.max_connections_per_ip, nb_workers)
+    supervisor = Supervisor(
+        nb_workers,
+        target=run_prefork_worker,
+        args=(directory, config, limiter),
+        shutdown_timeout=config.shutdown_timeout,
+        before_spawn=limiter.use_row,
+    )
+    supervisor.run()
+
+
+SERVER_MODES = {
+    "multiprocessing": handle_connection_with_multiprocessing_pool,
+    "threads": handle_connection_with_multithreading_naive,
+    "thread-pool": handle_connection_with_thread_pool,
+    "asyncio": run_asyncio,
+    "asyncio-protocol": run_asyncio_protocol,
+    "selectors": handle_connection_with_selectors,
+    "prefork": handle_connection_with_prefork,
+}
+
+# modes whose requests are handled by several processes
+MULTI_PROCESS_MODES = ("multiprocessing", "prefork")
 
 
 def main():
     """Launches tcp server
-    Current benchmark with `oha -n 100 --burst-delay 2ms --burst-rate 4 http://localhost:4221`
+    Reproducible benchmarks of the parser, the serializer and every mode are in the
+    `benchmarks` package: `python -m benchmarks.micro`, `python -m benchmarks.load`
+    and `python -m benchmarks.compare` to compare the reports of two commits.
+
+    First benchmark with `oha -n 100 --burst-delay 2ms --burst-rate 4 http://localhost:4221`
     - handle_connection_with_multiprocessing_pool() -> 93/100
     - handle_connection_with_multithreading_naive() -> 83/100
     - handle_connection_with_thread_pool() -> 83/100
@@ -90,21 +350,255 @@ def main():
         prog="Http server", description="A simple http server"
     )
     parser.add_argument("--directory", help="directory where files are stored")
-    args = parser.parse_args()
-
-    # Uncomment this to pass the first stage
-
-    # Multiprocessing solution ####################
-    # handle_connection_with_multiprocessing_pool(directory=args.directory)
+    parser.add_argument(
+        "--mode",
+        choices=SERVER_MODES.keys(),
+        default="thread-pool",
+        help="how concurrent connections are handled",
+    )
+    parser.add_argument(
+        "--keep-alive-timeout",
+        type=float,
+        default=ServerConfig.keep_alive_timeout,
+        help="seconds an idle persistent connection stays open",
+    )
+    parser.add_argument(
+        "--max-requests",
+        type=int,
+        default=ServerConfig.max_requests_per_connection,
+        help="max nb of requests per connection (0 for no limit)",
+    )
+    parser.add_argument(
+        "--header-timeout",
+        type=float,
+        default=ServerConfig.header_timeout,
+        help="seconds to receive the head of a request once it started (408 after)",
+    )
+    parser.add_argument(
+        "--body-timeout",
+        type=float,
+        default=ServerConfig.body_timeout,
+        help="max seconds between two reads of a request body (408 after)",
+    )
+    parser.add_argument(
+        "--write-timeout",
+        type=float,
+        default=ServerConfig.write_timeout,
+        help="max seconds a client may leave a response unread",
+    )
+    parser.add_argument(
+        "--max-request-line",
+        type=int,
+        default=ServerConfig.max_request_line,
+        help="max length of the request line, 414 beyond (0 for no limit)",
+    )
+    parser.add_argument(
+        "--max-header-size",
+        type=int,
+        default=ServerConfig.max_header_size,
+        help="max size in bytes of a request head, 431 beyond (0 for no limit)",
+    )
+    parser.add_argument(
+        "--max-connections-per-ip",
+        type=int,
+        default=ServerConfig.max_connections_per_ip,
+        help="connections open at once per client IP, 503 beyond (0 for no limit)",
+    )
+    parser.add_argument(
+        "--max-body-size",
+        type=int,
+        default=ServerConfig.max_body_size,
+        help="max size in bytes of a request body (0 for no limit)",
+    )
+    parser.add_argument(
+        "--compression-cache-size",
+        type=int,
+        default=ServerConfig.compression_cache_size,
+        help="max total size in bytes of the cached compressed bodies",
+    )
+    parser.add_argument(
+        "--file-cache-size",
+        type=int,
+        default=ServerConfig.file_cache_size,
+        help="nb of files whose metadata and descriptor are cached (0: none)",
+    )
+    parser.add_argument(
+        "--file-cache-ttl",
+        type=float,
+        default=ServerConfig.file_cache_ttl,
+        help="seconds a cached file is served without checking it changed",
+    )
+    parser.add_argument(
+        "--response-cache-size",
+        type=int,
+        default=ServerConfig.response_cache_size,
+        help="max total size in bytes of the cached responses (0: none)",
+    )
+    parser.add_argument(
+        "--response-cache-ttl",
+        type=float,
+        default=ServerConfig.response_cache_ttl,
+        help="seconds a cached response is served again",
+    )
+    parser.add_argument(
+        "--precompressed",
+        action="store_true",
+        help="serve up to date `name.gz` sidecars of the requested files",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=ServerConfig.workers,
+        help="nb of processes of the prefork mode (0: nb of cpus)",
+    )
+    parser.add_argument(
+        "--prefork-engine",
+        choices=["thread-pool", "asyncio", "asyncio-protocol", "selectors"],
+        default=ServerConfig.prefork_engine,
+        help="how each prefork worker handles its connections",
+    )
+    parser.add_argument(
+        "--stream-compression-threshold",
+        type=int,
+        default=ServerConfig.stream_compression_threshold,
+        help="size in bytes above which files are compressed on the fly (0: never)",
+    )
+    parser.add_argument(
+        "--threads",
+        type=int,
+        default=ServerConfig.threads,
+        help="nb of worker threads of the thread pool mode",
+    )
+    parser.add_argument(
+        "--io-threads",
+        type=int,
+        default=ServerConfig.io_threads,
+        help="threads of the asyncio engines for disk io and compression (0: none)",
+    )
+    parser.add_argument(
+        "--no-http2",
+        dest="http2",
+        action="store_false",
+        help="asyncio mode: answer in HTTP/1.1 only, even to h2c clients",
+    )
+    parser.add_argument(
+        "--http2-max-streams",
+        type=int,
+        default=ServerConfig.http2_max_streams,
+        help="requests in progress at once on an HTTP/2 connection",
+    )
+    parser.add_argument(
+        "--parser",
+        choices=["fast", "pyparsing"],
+        default=ServerConfig.parser,
+        help="parser of the HTTP/1 requests: pyparsing is the slower reference grammar",
+    )
+    parser.add_argument(
+        "--max-pending",
+        type=int,
+        default=ServerConfig.max_pending_connections,
+        help="connections waiting for a thread beyond which a 503 is sent (0: no limit)",
+    )
+    parser.add_argument(
+        "--retry-after",
+        type=int,
+        default=ServerConfig.retry_after,
+        help="Retry-After seconds of the 503 sent when the thread pool is full",
+    )
+    parser.add_argument(
+        "--metrics-dir",
+        help="where the worker processes share their metrics (default: a temporary"
+        " directory)",
+    )
+    parser.add_argument(
+        "--profile-mode",
+        choices=PROFILE_MODES,
+        default=ServerConfig.profile_mode,
+        help="what SIGUSR1 toggles: cProfile of sampled requests or a stack sampler",
+    )
+    parser.add_argument(
+        "--profile-every",
+        type=int,
+        default=ServerConfig.profile_sample_every,
+        help="cprofile mode: one request in N is profiled",
+    )
+    parser.add_argument(
+        "--profile-dir",
+        help="where the profiles are written (default: the temporary directory)",
+    )
+    parser.add_argument(
+        "--admin-routes",
+        action="store_true",
+        help="serve POST /admin/profile/start and /admin/profile/stop",
+    )
 
-    # Multithreading naive solution ###############
-    # handle_connection_with_multithreading_naive(directory=args.directory)
+    subparsers = parser.add_subparsers(dest="command")
+    precompress_parser = subparsers.add_parser(
+        "precompress", help="write gzip sidecars for all files of a directory"
+    )
+    precompress_parser.add_argument(
+        "--directory", required=True, help="directory to precompress"
+    )
+    precompress_parser.add_argument(
+        "--jobs", type=int, help="nb of parallel workers (default: nb of cpus)"
+    )
+    args = parser.parse_args()
 
-    # Multithreading thread pool solution ########
-    handle_connection_with_thread_pool(directory=args.directory)
+    if args.command == "precompress":
+        nb_written = precompress_directory(args.directory, jobs=args.jobs)
+        print(f"{nb_written} sidecar(s) written in {args.directory}")
+        return
 
-    # Asyncio solution #########################
-    # asyncio.run(handle_connection_with_asyncio(directory=args.directory))
+    config = ServerConfig(
+        keep_alive_timeout=args.keep_alive_timeout,
+        max_requests_per_connection=args.max_requests,
+        header_timeout=args.header_timeout,
+        body_timeout=args.body_timeout,
+        write_timeout=args.write_timeout,
+        max_request_line=args.max_request_line,
+        max_header_size=args.max_header_size,
+        max_connections_per_ip=args.max_connections_per_ip,
+        max_body_size=args.max_body_size,
+        compression_cache_size=args.compression_cache_size,
+        file_cache_size=args.file_cache_size,
+        file_cache_ttl=args.file_cache_ttl,
+        response_cache_size=args.response_cache_size,
+        response_cache_ttl=args.response_cache_ttl,
+        precompressed_sidecars=args.precompressed,
+        stream_compression_threshold=args.stream_compression_threshold,
+        workers=args.workers,
+        prefork_engine=args.prefork_engine,
+        threads=args.threads,
+        io_threads=args.io_threads,
+        http2=args.http2,
+        http2_max_streams=args.http2_max_streams,
+        parser=args.parser,
+        max_pending_connections=args.max_pending,
+        retry_after=args.retry_after,
+        metrics_dir=args.metrics_dir,
+        profile_mode=args.profile_mode,
+        profile_sample_every=args.profile_every,
+        profile_dir=args.profile_dir,
+        admin_routes=args.admin_routes,
+    )
+    COMPRESSION_CACHE.resize(config.compression_cache_size)
+    FILE_CACHE.configure(config.file_cache_size, config.file_cache_ttl)
+    RESPONSE_CACHE.configure(config.response_cache_size, config.response_cache_ttl)
+    configure_io_threads(config.io_threads)
+    if args.mode not in MULTI_PROCESS_MODES:
+        # the multi process modes install it in their workers
+        install_profiling(config)
+    if args.mode not in MULTI_PROCESS_MODES:
+        SERVER_MODES[args.mode](directory=args.directory, config=config)
+        return
+    if config.metrics_dir:
+        # what a previous run left is not part of this one
+        METRICS.clear_directory(config.metrics_dir)
+        SERVER_MODES[args.mode](directory=args.directory, config=config)
+        return
+    with tempfile.TemporaryDirectory(prefix="http-metrics-") as metrics_dir:
+        config.metrics_dir = metrics_dir
+        SERVER_MODES[args.mode](directory=args.directory, config=config)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,373 @@
+"""Request metrics, exposed in the Prometheus text format by `GET /metrics`.
+
+Per request stage latencies go in histograms with fixed buckets, the requests are
+counted by handler and status, and the bytes by direction. The stages are:
+
+- queue: thread pool mode, from the admission of a connection to a thread taking
+  it (see `app.admission`)
+- receive: from the first bytes of a request to the end of its body
+- parse: request line and headers, `HttpRequest.from_bytes`
+- handle: `handle_req`, compression included
+- compress: gzip or deflate of a body (cache hits are not timed)
+- send: handing the response to the socket, or to the transport for the engines
+  whose writes are asynchronous
+
+The thread pool also counts the connections it admits and rejects, and exposes
+its queue depth as a gauge, read when the metrics are.
+
+Each thread records into its own shard, so that recording never takes a lock:
+reading merges all the shards. A scrape can miss the increments made while it
+reads, it never counts one twice.
+
+Processes do not share memory: in the multiprocessing and prefork modes a thread
+of each process writes a snapshot of its metrics to
+`<directory>/metrics-<pid>-<start>.json` every `interval` seconds (see
+`Metrics.share`), and reading merges the snapshots of the other processes with its
+own live metrics. The snapshots of the processes that exited are kept so that the
+counters never go down: the start time in their name keeps a process reusing the
+pid of an exited one from overwriting its snapshot. Their gauges are not current
+anymore though: those of the snapshots not written for a few intervals are left
+out. The directory is emptied when the server starts (`clear_directory`), so that
+the snapshots of a previous run are not counted.
+"""
+
+import bisect
+import glob
+import json
+import os
+import threading
+import time
+from typing import Callable
+
+# upper bounds in seconds of the histogram buckets, the last bucket is +Inf
+BUCKETS = (
+    0.00005,
+    0.0001,
+    0.00025,
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+
+STAGES = ("queue", "receive", "parse", "handle", "compress", "send")
+
+# the gauges of a snapshot not written for this many flush intervals are left out
+STALE_INTERVALS = 3
+
+# gauges that can be registered with `Metrics.gauge`, and their help
+GAUGES = {
+    "http_pool_queue_depth": "Admitted connections waiting for a thread",
+}
+
+# handler label of the requests that did not reach a route handler
+UNMATCHED = "unmatched"
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class Histogram:
+    __slots__ = ("counts", "sum")
+
+    def __init__(self):
+        # per bucket, not cumulative
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+
+    def merge(self, counts: list[int], total: float):
+        for i, count in enumerate(counts):
+            self.counts[i] += count
+        self.sum += total
+
+
+class Shard:
+    """Metrics recorded by a single thread"""
+
+    __slots__ = ("stages", "requests", "connections", "gauges", "bytes_in", "bytes_out")
+
+    def __init__(self):
+        self.stages: dict[str, Histogram] = {}
+        # (handler, status code) -> nb of requests
+        self.requests: dict[tuple[str, str], int] = {}
+        # outcome (admitted, rejected) -> nb of connections
+        self.connections: dict[str, int] = {}
+        # only in snapshots, summed over the processes
+        self.gauges: dict[str, float] = {}
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def merge(self, other: "Shard"):
+        # copies first: the other shard may be written to by its thread
+        for stage, hist in list(other.stages.items()):
+            self.histogram(stage).merge(list(hist.counts), hist.sum)
+        for key, count in list(other.requests.items()):
+            self.requests[key] = self.requests.get(key, 0) + count
+        for key, count in list(other.connections.items()):
+            self.connections[key] = self.connections.get(key, 0) + count
+        for name, value in other.gauges.items():
+            self.gauges[name] = self.gauges.get(name, 0) + value
+        self.bytes_in += other.bytes_in
+        self.bytes_out += other.bytes_out
+
+    def histogram(self, stage: str) -> Histogram:
+        hist = self.stages.get(stage)
+        if hist is None:
+            hist = self.stages[stage] = Histogram()
+        return hist
+
+    def to_dict(self) -> dict:
+        return {
+            "stages": {
+                stage: {"counts": hist.counts, "sum": hist.sum}
+                for stage, hist in self.stages.items()
+            },
+            "requests": [[*key, count] for key, count in self.requests.items()],
+            "connections": self.connections,
+            "gauges": self.gauges,
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "Shard":
+        shard = cls()
+        for stage, hist in data["stages"].items():
+            shard.histogram(stage).merge(hist["counts"], hist["sum"])
+        for handler, status, count in data["requests"]:
+            shard.requests[(handler, status)] = count
+        shard.connections = data.get("connections", {})
+        shard.gauges = data.get("gauges", {})
+        shard.bytes_in = data["bytes_in"]
+        shard.bytes_out = data["bytes_out"]
+        return shard
+
+
+class Metrics:
+    def __init__(self):
+        self.directory: str | None = None
+        self.interval = 1.0
+        self.clear()
+
+    def clear(self):
+        """Forgets everything recorded. Called in forked children, which must not
+        count the metrics of their parent a second time"""
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.shards: list[tuple[threading.Thread, Shard]] = []
+        # shards of the threads that exited
+        self.retired = Shard()
+        # threads do not survive a fork
+        self.flusher: threading.Thread | None = None
+        # names the snapshot of this process, see `snapshot_path`
+        self.key = f"{os.getpid()}-{time.time_ns()}"
+        # name -> function reading the current value of the gauge
+        self.gauges: dict[str, Callable[[], float]] = {}
+
+    def share(self, directory: str, interval: float = 1.0):
+        """Aggregates the metrics of all the processes sharing `directory`. Called
+        by each process, it starts the thread writing the snapshots of this one"""
+        self.directory = directory
+        self.interval = interval
+        if self.flusher is None:
+            self.flusher = threading.Thread(
+                target=self.flush_periodically, name="metrics-flush", daemon=True
+            )
+            self.flusher.start()
+
+    def flush_periodically(self):
+        while True:
+            time.sleep(self.interval)
+            self.flush()
+
+    # recording ###################################################
+
+    def shard(self) -> Shard:
+        try:
+            return self.local.shard
+        except AttributeError:
+            shard = self.local.shard = Shard()
+            with self.lock:
+                self.retire_dead_threads()
+                self.shards.append((threading.current_thread(), shard))
+            return shard
+
+    def observe(self, stage: str, seconds: float):
+        self.shard().histogram(stage).observe(seconds)
+
+    def count_request(self, handler: str, status: str):
+        requests = self.shard().requests
+        key = (handler, status)
+        requests[key] = requests.get(key, 0) + 1
+
+    def count_connection(self, outcome: str):
+        connections = self.shard().connections
+        connections[outcome] = connections.get(outcome, 0) + 1
+
+    def gauge(self, name: str, read: Callable[[], float] | None):
+        """Registers the function reading one of the `GAUGES`, None to remove it"""
+        if read is None:
+            self.gauges.pop(name, None)
+        else:
+            self.gauges[name] = read
+
+    def count_bytes_in(self, nb_bytes: int):
+        self.shard().bytes_in += nb_bytes
+
+    def count_bytes_out(self, nb_bytes: int):
+        self.shard().bytes_out += nb_bytes
+
+    # reading #####################################################
+
+    def retire_dead_threads(self):
+        """Must be called with the lock held"""
+        alive = []
+        for thread, shard in self.shards:
+            if thread.is_alive():
+                alive.append((thread, shard))
+            else:
+                self.retired.merge(shard)
+        self.shards = alive
+
+    def snapshot(self) -> Shard:
+        """Metrics of this process"""
+        merged = Shard()
+        with self.lock:
+            self.retire_dead_threads()
+            merged.merge(self.retired)
+            for _, shard in self.shards:
+                merged.merge(shard)
+        for name, read in list(self.gauges.items()):
+            merged.gauges[name] = read()
+        return merged
+
+    def snapshot_path(self, key: str) -> str:
+        return os.path.join(self.directory, f"metrics-{key}.json")
+
+    def flush(self):
+        """Writes the snapshot of this process for the others to read"""
+        if self.directory is None:
+            return
+        data = self.snapshot().to_dict()
+        path = self.snapshot_path(self.key)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, "w") as f:
+                json.dump(data, f)
+            # readers never see a partial file
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"Could not write the metrics snapshot: {e}")
+
+    def collect(self) -> Shard:
+        """Metrics of all the processes sharing the directory, this one included"""
+        merged = self.snapshot()
+        if self.directory is None:
+            return merged
+        own_path = self.snapshot_path(self.key)
+        stale_before = time.time() - STALE_INTERVALS * self.interval
+        for path in glob.glob(self.snapshot_path("*")):
+            if path == own_path:
+                continue
+            try:
+                with open(path) as f:
+                    shard = Shard.from_dict(json.load(f))
+                if os.path.getmtime(path) < stale_before:
+                    # a process that exited, or stopped flushing
+                    shard.gauges = {}
+                merged.merge(shard)
+            except (OSError, ValueError, KeyError) as e:
+                print(f"Skipping the metrics snapshot {path}: {e}")
+        return merged
+
+    @staticmethod
+    def clear_directory(directory: str):
+        """Removes the snapshots of the processes of a previous run"""
+        for path in glob.glob(os.path.join(directory, "metrics-*")):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def render(self) -> str:
+        return render_prometheus(self.collect())
+
+
+def format_value(value: float) -> str:
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render_prometheus(shard: Shard) -> str:
+    lines = [
+        "# HELP http_stage_duration_seconds Time spent in each stage of a request",
+        "# TYPE http_stage_duration_seconds histogram",
+    ]
+    for stage in sorted(shard.stages, key=lambda s: (s not in STAGES, s)):
+        hist = shard.stages[stage]
+        cumulative = 0
+        for bound, count in zip((*BUCKETS, "+Inf"), hist.counts):
+            cumulative += count
+            lines.append(
+                f'http_stage_duration_seconds_bucket{{stage="{stage}",le="{bound}"}}'
+                f" {cumulative}"
+            )
+        lines.append(
+            f'http_stage_duration_seconds_sum{{stage="{stage}"}}'
+            f" {format_value(hist.sum)}"
+        )
+        lines.append(
+            f'http_stage_duration_seconds_count{{stage="{stage}"}} {cumulative}'
+        )
+
+    lines += [
+        "# HELP http_requests_total Requests answered, by handler and status",
+        "# TYPE http_requests_total counter",
+    ]
+    for (handler, status), count in sorted(shard.requests.items()):
+        lines.append(
+            f'http_requests_total{{handler="{handler}",status="{status}"}} {count}'
+        )
+
+    lines += [
+        "# HELP http_connections_total Connections taken by the thread pool, by"
+        " outcome",
+        "# TYPE http_connections_total counter",
+    ]
+    for outcome, count in sorted(shard.connections.items()):
+        lines.append(f'http_connections_total{{outcome="{outcome}"}} {count}')
+
+    for name, value in sorted(shard.gauges.items()):
+        lines += [
+            f"# HELP {name} {GAUGES.get(name, name)}",
+            f"# TYPE {name} gauge",
+            f"{name} {format_value(value)}",
+        ]
+
+    lines += [
+        "# HELP http_received_bytes_total Bytes read from the clients",
+        "# TYPE http_received_bytes_total counter",
+        f"http_received_bytes_total {shard.bytes_in}",
+        "# HELP http_sent_bytes_total Bytes written to the clients",
+        "# TYPE http_sent_bytes_total counter",
+        f"http_sent_bytes_total {shard.bytes_out}",
+    ]
+    return "\n".join(lines) + "\n"
+
+
+METRICS = Metrics()
+
+# a forked worker starts from empty metrics, its parent keeps counting its own
+os.register_at_fork(after_in_child=METRICS.clear)
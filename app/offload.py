@@ -0,0 +1,82 @@
+"""Blocking work of the event loop engines.
+
+Disk reads and writes and compression run in a small pool of io threads, so that
+a slow disk or a large file stalls the request that needs it rather than every
+connection of the event loop. The pool has a fixed nb of threads: beyond that,
+work waits in its queue, which bounds how much disk io and compression a single
+process does at once. With 0 threads the work is done on the loop, as before.
+
+The pool is created on first use, and again in a forked process since threads do
+not survive a fork.
+"""
+
+import asyncio
+import functools
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import AsyncIterator, Callable, Iterable, TypeVar
+
+from app.config import ServerConfig
+
+T = TypeVar("T")
+
+_lock = threading.Lock()
+_executor: ThreadPoolExecutor | None = None
+_nb_threads = ServerConfig.io_threads
+
+
+def configure(nb_threads: int):
+    global _executor, _nb_threads
+    with _lock:
+        _nb_threads = nb_threads
+        if _executor is not None:
+            _executor.shutdown(wait=False)
+            _executor = None
+
+
+def io_executor() -> ThreadPoolExecutor:
+    global _executor
+    with _lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=_nb_threads, thread_name_prefix="io"
+            )
+        return _executor
+
+
+def _forget_executor():
+    global _executor, _lock
+    _lock = threading.Lock()
+    _executor = None
+
+
+os.register_at_fork(after_in_child=_forget_executor)
+
+
+async def run_blocking(func: Callable[..., T], *args) -> T:
+    if not _nb_threads:
+        return func(*args)
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(io_executor(), functools.partial(func, *args))
+
+
+async def offload_chunks(chunks: Iterable[bytes]) -> AsyncIterator[bytes]:
+    """Async iterator over `chunks` whose items are produced in the io threads, for
+    ex the blocks of a file compressed on the fly"""
+    iterator = iter(chunks)
+    try:
+        while True:
+            chunk = await run_blocking(next, iterator, None)
+            if chunk is None:
+                return
+            yield chunk
+    finally:
+        close = getattr(iterator, "close", None)
+        if close is not None:
+            try:
+                close()
+            except ValueError:
+                # cancelled while an io thread is producing a chunk: the generator
+                # is closed once garbage collected
+                pass
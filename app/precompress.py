@@ -0,0 +1,55 @@
+"""Offline compression of the files served by the `files/` route.
+
+Writes a gzip sidecar (`name.gz`) next to every file of a directory tree, so that
+the server started with `--precompressed` can send it as is instead of compressing
+on the request path. Files are compressed in parallel, one per worker process.
+"""
+
+import gzip
+import os
+import pathlib
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+
+from app.compression import SIDECAR_SUFFIXES, fresh_sidecar
+
+SIDECAR_SUFFIX = SIDECAR_SUFFIXES["gzip"]
+
+
+def precompress_file(path: pathlib.Path) -> bool:
+    """Writes the sidecar of one file, streaming it so that large files are never
+    fully in memory. The sidecar is only kept if it is smaller than the original.
+    Returns True if a sidecar was written"""
+    sidecar = path.with_name(path.name + SIDECAR_SUFFIX)
+    tmp = path.with_name(f".{path.name}{SIDECAR_SUFFIX}.tmp")
+    with open(path, "rb") as src, gzip.open(tmp, "wb", compresslevel=9) as dst:
+        shutil.copyfileobj(src, dst, length=1024**2)
+
+    if os.stat(tmp).st_size >= os.stat(path).st_size:
+        tmp.unlink()
+        sidecar.unlink(missing_ok=True)
+        return False
+    # atomic: the server never sees a partially written sidecar
+    os.replace(tmp, sidecar)
+    return True
+
+
+def files_to_precompress(directory: pathlib.Path) -> list[pathlib.Path]:
+    """Files without an up to date sidecar. Sidecars themselves are skipped"""
+    return [
+        path
+        for path in sorted(directory.rglob("*"))
+        if path.is_file()
+        and not path.name.endswith(SIDECAR_SUFFIX)
+        and not path.name.endswith(".tmp")
+        and fresh_sidecar(path, "gzip") is None
+    ]
+
+
+def precompress_directory(directory: str, jobs: int | None = None) -> int:
+    """Returns the nb of sidecars written"""
+    paths = files_to_precompress(pathlib.Path(directory))
+    if not paths:
+        return 0
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        return sum(executor.map(precompress_file, paths, chunksize=8))
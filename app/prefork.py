@@ -0,0 +1,108 @@
+"""Pre-fork process supervision.
+
+The supervisor itself never accepts connections: each worker process binds its own
+listener with SO_REUSEPORT and the kernel load-balances new connections between
+them, so accepting scales with the nb of cores and no socket crosses a process
+boundary.
+
+The supervisor restarts workers that die and, on SIGTERM or SIGINT, forwards
+SIGTERM to all of them and waits for them to drain their in-flight connections.
+SIGUSR1 (profiling toggle) is forwarded to the workers as is.
+"""
+
+import multiprocessing
+import os
+import signal
+import time
+from multiprocessing.connection import wait
+from typing import Callable
+
+# a worker dying sooner than this after its start is restarted with a delay, so
+# that a worker crashing on startup does not make the supervisor spin
+MIN_WORKER_LIFETIME = 1.0
+
+
+class Shutdown(Exception):
+    """Raised in a worker by the SIGTERM handler to stop accepting connections"""
+
+
+def raise_shutdown(signum, frame):
+    raise Shutdown()
+
+
+def forward_to_children(signum, frame):
+    for child in multiprocessing.active_children():
+        os.kill(child.pid, signum)
+
+
+class Supervisor:
+    def __init__(
+        self,
+        nb_workers: int,
+        target: Callable,
+        args: tuple = (),
+        shutdown_timeout: float = 10.0,
+        before_spawn: Callable[[int], None] | None = None,
+    ):
+        self.nb_workers = nb_workers
+        self.target = target
+        self.args = args
+        self.shutdown_timeout = shutdown_timeout
+        # called with the slot of a worker before it is forked, to reset what the
+        # previous worker of the slot left in shared memory
+        self.before_spawn = before_spawn
+        self.workers: dict[int, multiprocessing.Process] = {}
+        self.started_at: dict[int, float] = {}
+        self.stopping = False
+
+    def spawn(self, slot: int):
+        if self.before_spawn is not None:
+            self.before_spawn(slot)
+        worker = multiprocessing.Process(
+            target=self.target, args=self.args, name=f"worker-{slot}", daemon=False
+        )
+        worker.start()
+        self.workers[slot] = worker
+        self.started_at[slot] = time.monotonic()
+
+    def stop(self, signum, frame):
+        self.stopping = True
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGUSR1, forward_to_children)
+        for slot in range(self.nb_workers):
+            self.spawn(slot)
+        print(f"Supervisor {os.getpid()} started {self.nb_workers} workers")
+
+        while not self.stopping:
+            sentinels = {w.sentinel: slot for slot, w in self.workers.items()}
+            # short timeout: signals are only handled between two waits
+            for sentinel in wait(list(sentinels), timeout=0.5):
+                if self.stopping:
+                    break
+                slot = sentinels[sentinel]
+                worker = self.workers[slot]
+                worker.join()
+                print(f"{worker.name} exited with code {worker.exitcode}, restarting")
+                if time.monotonic() - self.started_at[slot] < MIN_WORKER_LIFETIME:
+                    time.sleep(MIN_WORKER_LIFETIME)
+                self.spawn(slot)
+
+        self.shutdown()
+
+    def shutdown(self):
+        """Graceful drain: the workers stop accepting, finish their connections and
+        exit. Those still running after the timeout are killed"""
+        for worker in self.workers.values():
+            if worker.is_alive():
+                os.kill(worker.pid, signal.SIGTERM)
+        deadline = time.monotonic() + self.shutdown_timeout
+        for worker in self.workers.values():
+            worker.join(max(deadline - time.monotonic(), 0))
+            if worker.is_alive():
+                print(f"{worker.name} did not drain in time, killing it")
+                worker.kill()
+                worker.join()
+        print("All workers have exited")
@@ -0,0 +1,210 @@
+"""On-demand profiling of a live server.
+
+Profiling is off until SIGUSR1 (or `POST /admin/profile/start` when the admin
+routes are enabled) starts it; the next SIGUSR1 (or `POST /admin/profile/stop`)
+stops it and dumps what was collected in the profile directory, one file per
+process:
+
+- cprofile mode: one request in `sample_every` is run under `cProfile`, the
+  others run untouched. The profiles are aggregated in
+  `profile-<pid>-<time>.pstats`, to read with `python -m pstats`
+- sampler mode: a thread records the stack of every other thread every
+  `SAMPLER_INTERVAL` seconds, whatever they are doing (idle waits included), in
+  `stacks-<pid>-<time>.txt` with one `frame;frame;frame count` line per stack, the
+  input of flamegraph tools
+
+cProfile follows a thread, not a coroutine: the event loop engines only profile
+the synchronous handling of a request, use the sampler to see where their loop
+spends its time.
+
+In the multiprocessing and prefork modes the parent process forwards SIGUSR1 to
+its workers, which then all start or stop together. An admin route only toggles
+the worker that answered it.
+"""
+
+import collections
+import cProfile
+import itertools
+import os
+import pstats
+import signal
+import sys
+import tempfile
+import threading
+import time
+
+from app.config import ServerConfig
+
+PROFILE_MODES = ("cprofile", "sampler")
+
+# seconds between two samples of the stacks
+SAMPLER_INTERVAL = 0.005
+
+
+class ProfiledRequest:
+    """Context manager running its block under cProfile"""
+
+    def __init__(self, profiler: "Profiler"):
+        self.profiler = profiler
+        self.profile = cProfile.Profile()
+
+    def __enter__(self):
+        self.profile.enable()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.profile.disable()
+        self.profiler.add_profile(self.profile)
+
+
+class NotProfiled:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+NOT_PROFILED = NotProfiled()
+
+
+def collapse(frame) -> str:
+    """`file:function;...` from the outermost frame to the innermost"""
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{os.path.basename(code.co_filename)}:{code.co_qualname}")
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+class StackSampler:
+    def __init__(self, interval: float = SAMPLER_INTERVAL):
+        self.interval = interval
+        self.stacks: collections.Counter[str] = collections.Counter()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(
+            target=self.run, name="stack-sampler", daemon=True
+        )
+
+    def start(self):
+        self.thread.start()
+
+    def run(self):
+        own_id = threading.get_ident()
+        while not self.stopped.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id != own_id:
+                    self.stacks[collapse(frame)] += 1
+
+    def stop(self) -> collections.Counter[str]:
+        self.stopped.set()
+        self.thread.join()
+        return self.stacks
+
+
+class Profiler:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.mode = "cprofile"
+        self.sample_every = 100
+        self.directory: str | None = None
+        self.active = False
+        self.requests = itertools.count()
+        # cprofile mode: aggregate of the profiled requests
+        self.stats: pstats.Stats | None = None
+        self.nb_profiled = 0
+        self.sampler: StackSampler | None = None
+
+    def configure(self, mode: str, sample_every: int, directory: str | None):
+        if mode not in PROFILE_MODES:
+            raise ValueError(f"Unknown profile mode: {mode}")
+        self.mode = mode
+        self.sample_every = max(sample_every, 1)
+        self.directory = directory
+
+    def request(self) -> ProfiledRequest | NotProfiled:
+        """To wrap the handling of a request: `with PROFILER.request(): ...`"""
+        if (
+            not self.active
+            or self.mode != "cprofile"
+            or next(self.requests) % self.sample_every
+        ):
+            return NOT_PROFILED
+        return ProfiledRequest(self)
+
+    def add_profile(self, profile: cProfile.Profile):
+        with self.lock:
+            if not self.active:
+                # stopped while the request was running
+                return
+            if self.stats is None:
+                self.stats = pstats.Stats(profile)
+            else:
+                self.stats.add(profile)
+            self.nb_profiled += 1
+
+    def start(self) -> bool:
+        """Returns False if profiling was already running"""
+        with self.lock:
+            if self.active:
+                return False
+            self.stats = None
+            self.nb_profiled = 0
+            self.requests = itertools.count()
+            if self.mode == "sampler":
+                self.sampler = StackSampler()
+                self.sampler.start()
+            self.active = True
+        print(f"Profiling started in process {os.getpid()} ({self.mode})")
+        return True
+
+    def stop(self) -> str | None:
+        """Returns the path of the dump, None if there was nothing to dump"""
+        with self.lock:
+            if not self.active:
+                return None
+            self.active = False
+            stats, self.stats = self.stats, None
+            sampler, self.sampler = self.sampler, None
+            nb_profiled = self.nb_profiled
+
+        directory = self.directory or tempfile.gettempdir()
+        os.makedirs(directory, exist_ok=True)
+        name = f"{os.getpid()}-{time.strftime('%Y%m%d-%H%M%S')}"
+        if sampler is not None:
+            stacks = sampler.stop()
+            path = os.path.join(directory, f"stacks-{name}.txt")
+            with open(path, "w") as f:
+                for stack, count in stacks.most_common():
+                    f.write(f"{stack} {count}\n")
+        elif stats is not None:
+            path = os.path.join(directory, f"profile-{name}.pstats")
+            stats.dump_stats(path)
+            print(f"{nb_profiled} request(s) profiled")
+        else:
+            print(f"Profiling stopped in process {os.getpid()}, no request profiled")
+            return None
+        print(f"Profile of process {os.getpid()} written to {path}")
+        return path
+
+    def toggle(self):
+        if not self.start():
+            self.stop()
+
+    def on_signal(self, signum, frame):
+        # not in the handler itself: it interrupts the main thread, which may be
+        # holding the lock
+        threading.Thread(target=self.toggle, name="profiler-toggle").start()
+
+
+PROFILER = Profiler()
+
+
+def install_profiling(config: ServerConfig):
+    """Makes SIGUSR1 toggle the profiling of this process. Must be called from the
+    main thread"""
+    PROFILER.configure(
+        config.profile_mode, config.profile_sample_every, config.profile_dir
+    )
+    signal.signal(signal.SIGUSR1, PROFILER.on_signal)
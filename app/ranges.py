@@ -0,0 +1,92 @@
+"""Byte range requests (RFC 9110 section 14).
+
+`Range: bytes=0-499, -100` is parsed into inclusive (start, end) pairs within the
+size of the file. Overlapping or adjacent ranges are coalesced so that a client
+can not make the server send the same bytes many times.
+"""
+
+import email.utils
+import secrets
+
+# above this nb of ranges the header is ignored and the whole file is sent
+MAX_RANGES = 32
+
+ByteRange = tuple[int, int]
+
+
+def parse_range(header: str, size: int) -> list[ByteRange] | None:
+    """Returns the satisfiable ranges, sorted and coalesced. An empty list means that
+    none of them is satisfiable (416). None means that the header must be ignored
+    because it is invalid or not about bytes"""
+    unit, sep, specs = header.partition("=")
+    if not sep or unit.strip().lower() != "bytes":
+        return None
+
+    ranges = []
+    items = specs.split(",")
+    if len(items) > MAX_RANGES:
+        return None
+    for item in items:
+        first, sep, last = item.strip().partition("-")
+        if not sep:
+            return None
+        try:
+            if not first:
+                # suffix range: the last n bytes
+                suffix_len = int(last)
+                if suffix_len < 0:
+                    return None
+                # an empty file has no last bytes
+                if suffix_len and size:
+                    ranges.append((max(size - suffix_len, 0), size - 1))
+                continue
+            start = int(first)
+            end = int(last) if last else None
+        except ValueError:
+            return None
+        if start < 0 or (end is not None and end < start):
+            return None
+        if start < size:
+            ranges.append((start, size - 1 if end is None else min(end, size - 1)))
+
+    return coalesce(ranges)
+
+
+def coalesce(ranges: list[ByteRange]) -> list[ByteRange]:
+    merged: list[ByteRange] = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(end, merged[-1][1]))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def if_range_matches(if_range: str, mtime: float, etag: str | None = None) -> bool:
+    """The ranges only apply if the representation did not change since the client
+    got the validator it sends back. Weak entity tags never match"""
+    if_range = if_range.strip()
+    if if_range.startswith('"') or if_range.startswith("W/"):
+        return etag is not None and if_range == etag
+    try:
+        date = email.utils.parsedate_to_datetime(if_range)
+    except (TypeError, ValueError):
+        return False
+    return int(mtime) == int(date.timestamp())
+
+
+def http_date(timestamp: float) -> str:
+    """`Wed, 21 Oct 2015 07:28:00 GMT`"""
+    return email.utils.formatdate(timestamp, usegmt=True)
+
+
+def content_range(start: int, end: int, size: int) -> str:
+    return f"bytes {start}-{end}/{size}"
+
+
+def unsatisfied_range(size: int) -> str:
+    return f"bytes */{size}"
+
+
+def multipart_boundary() -> str:
+    return secrets.token_hex(16)
@@ -0,0 +1,177 @@
+"""Cache of whole serialised responses.
+
+Some routes answer the same request with the same bytes over and over: an echo of
+the same text, the same user agent. Such routes opt in with `api.cached`, and
+their 200 responses with an in-memory body are kept here, serialised, for `ttl`
+seconds: a hit skips the handler, the compression and the serialisation, and is
+written as is.
+
+The key is the method, the path, the negotiated content coding and the values of
+the request headers the route declares that its response depends on (`vary`).
+Entries are bounded by their total size, least recently used first out.
+
+The only header that depends on the connection rather than on the request is
+Connection (see `HttpResponse.set_keep_alive`): it is left out of the stored
+bytes, and inserted between the stored header lines and the body by the rare
+responses that need it.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+from typing import Hashable
+
+from app.config import ServerConfig
+from app.http import HttpResponse, HttpStatus, HttpVersion, header_line
+
+
+class SerializedResponse:
+    """Bytes of a response, `head_end` being the offset of the empty line ending
+    its header lines. Its headers are kept for HTTP/2, which frames them
+    differently"""
+
+    __slots__ = ("status", "headers", "data", "head_end", "expires_at")
+
+    def __init__(
+        self,
+        status: HttpStatus,
+        headers: dict[str, str],
+        data: bytes,
+        head_end: int,
+        ttl: float,
+    ):
+        self.status = status
+        self.headers = headers
+        self.data = data
+        self.head_end = head_end
+        self.expires_at = time.monotonic() + ttl
+
+    def __len__(self):
+        return len(self.data)
+
+    @classmethod
+    def from_response(cls, res: HttpResponse, ttl: float) -> "SerializedResponse":
+        head = res.head_bytes()
+        body = res.body.encode() if isinstance(res.body, str) else res.body
+        return cls(res.status, res.headers, head + body, len(head) - 2, ttl)
+
+
+class CachedResponse(HttpResponse):
+    """Answer to one request from a `SerializedResponse`, which is shared by all
+    the requests it answers and never modified: its headers must not be changed"""
+
+    __slots__ = ("serialized", "connection")
+
+    def __init__(self, serialized: SerializedResponse):
+        body = memoryview(serialized.data)[serialized.head_end + 2 :]
+        super().__init__(HttpVersion.V1_1, serialized.status, serialized.headers, body)
+        self.serialized = serialized
+        self.connection: bytes | None = None
+
+    def set_keep_alive(self, keep_alive: bool, req_version: HttpVersion):
+        if not keep_alive:
+            self.connection = header_line("Connection", "close")
+        elif req_version == HttpVersion.V1_0:
+            self.connection = header_line("Connection", "keep-alive")
+
+    def head_buffers(self) -> list[bytes]:
+        head = memoryview(self.serialized.data)[: self.serialized.head_end]
+        return [head, self.connection or b"", b"\r\n"]
+
+    def to_buffers(self) -> list[bytes]:
+        data = self.serialized.data
+        if self.connection is None:
+            return [data]
+        view = memoryview(data)
+        head_end = self.serialized.head_end
+        return [view[:head_end], self.connection, view[head_end:]]
+
+
+def cacheable(res: HttpResponse) -> bool:
+    return (
+        res.status == HttpStatus.Ok200
+        and isinstance(res.body, (bytes, str))
+        and "Connection" not in res.headers
+    )
+
+
+class ResponseCache:
+    """LRU of serialised responses bounded by their total size (0: no caching),
+    each served for `ttl` seconds after it was stored. Like `LRUBytesCache` its lock
+    is only held for dict operations"""
+
+    def __init__(self, max_bytes: int, ttl: float):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries: OrderedDict[Hashable, SerializedResponse] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def configure(self, max_bytes: int, ttl: float):
+        with self._lock:
+            self.max_bytes = max_bytes
+            self.ttl = ttl
+            self._evict()
+
+    def get(self, key: Hashable) -> CachedResponse | None:
+        with self._lock:
+            serialized = self._entries.get(key)
+            if serialized is not None and serialized.expires_at <= time.monotonic():
+                del self._entries[key]
+                self.size -= len(serialized)
+                serialized = None
+            if serialized is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(key)
+        return CachedResponse(serialized)
+
+    def store(self, key: Hashable, res: HttpResponse) -> HttpResponse:
+        """Returns the response to send: the stored one, already serialised, or
+        `res` itself when it can not be cached"""
+        if not self.max_bytes or not cacheable(res):
+            return res
+        serialized = SerializedResponse.from_response(res, self.ttl)
+        if len(serialized) > self.max_bytes:
+            return res
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+            self._entries[key] = serialized
+            self.size += len(serialized)
+            self._evict()
+        return CachedResponse(serialized)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def _evict(self):
+        while self.size > self.max_bytes:
+            _, serialized = self._entries.popitem(last=False)
+            self.size -= len(serialized)
+            self.evictions += 1
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "entries": len(self._entries),
+            "size": self.size,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+RESPONSE_CACHE = ResponseCache(
+    ServerConfig.response_cache_size, ServerConfig.response_cache_ttl
+)
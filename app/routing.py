@@ -0,0 +1,178 @@
+"""Route registry.
+
+Handlers are registered with a method and a path pattern:
+
+    @ROUTES.get("/echo/{text:path}")
+    def echo(req, ctx, text): ...
+
+A pattern is made of `/` separated segments, each either static or a typed
+parameter: `{name}` (one non-empty segment), `{name:int}` or `{name:path}` (all
+the remaining segments, last in the pattern only).
+
+On the first lookup the routes are compiled: paths without parameters go into a
+dict, the others into a trie of segments, so that resolving a path costs a dict
+lookup per segment whatever the nb of routes. A path that matches a route but
+not for the request method raises `MethodNotAllowed` rather than `RouteNotFound`
+so that the caller can answer 405 instead of 404.
+"""
+
+from typing import Any, Callable
+
+from app.http import HttpMethod
+
+Handler = Callable[..., Any]
+
+
+class RouteNotFound(LookupError):
+    pass
+
+
+class MethodNotAllowed(LookupError):
+    def __init__(self, allowed: list[HttpMethod]):
+        super().__init__(allowed)
+        self.allowed = allowed
+
+
+CONVERTERS: dict[str, Callable[[str], Any]] = {"str": str, "int": int, "path": str}
+
+
+class ParamSegment:
+    def __init__(self, segment: str):
+        name, _, kind = segment[1:-1].partition(":")
+        kind = kind or "str"
+        if not name.isidentifier() or kind not in CONVERTERS:
+            raise ValueError(f"Invalid route parameter: {segment}")
+        self.name = name
+        self.kind = kind
+        self.convert = CONVERTERS[kind]
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}(name={self.name}, kind={self.kind})"
+
+
+def split_pattern(pattern: str) -> list[str | ParamSegment]:
+    path = pattern.strip("/")
+    segments: list[str | ParamSegment] = [
+        ParamSegment(s) if s.startswith("{") and s.endswith("}") else s
+        for s in (path.split("/") if path else [])
+    ]
+    for segment in segments[:-1]:
+        if isinstance(segment, ParamSegment) and segment.kind == "path":
+            raise ValueError(f"A path parameter must be last: {pattern}")
+    return segments
+
+
+class RouteNode:
+    def __init__(self):
+        self.static: dict[str, RouteNode] = {}
+        # tried in registration order when no static child matches
+        self.params: list[tuple[ParamSegment, RouteNode]] = []
+        self.handlers: dict[HttpMethod, Handler] = {}
+
+    def child(self, segment: str | ParamSegment) -> "RouteNode":
+        if isinstance(segment, str):
+            return self.static.setdefault(segment, RouteNode())
+        for param, node in self.params:
+            if param.name == segment.name and param.kind == segment.kind:
+                return node
+        node = RouteNode()
+        self.params.append((segment, node))
+        return node
+
+    def match(
+        self, segments: list[str], i: int, params: dict[str, Any]
+    ) -> "RouteNode | None":
+        """Depth first: static segments are preferred over parameters"""
+        if i == len(segments):
+            return self if self.handlers else None
+
+        segment = segments[i]
+        node = self.static.get(segment)
+        if node is not None:
+            found = node.match(segments, i + 1, params)
+            if found is not None:
+                return found
+
+        for param, node in self.params:
+            if param.kind == "path":
+                # may be empty, as in `echo/`
+                if node.handlers:
+                    params[param.name] = "/".join(segments[i:])
+                    return node
+                continue
+            if not segment:
+                continue
+            try:
+                params[param.name] = param.convert(segment)
+            except ValueError:
+                continue
+            found = node.match(segments, i + 1, params)
+            if found is not None:
+                return found
+            del params[param.name]
+        return None
+
+
+class Router:
+    def __init__(self):
+        self.routes: list[tuple[HttpMethod, str, Handler]] = []
+        self.static_routes: dict[str, dict[HttpMethod, Handler]] | None = None
+        self.root: RouteNode | None = None
+
+    def add(self, method: HttpMethod, pattern: str, handler: Handler):
+        split_pattern(pattern)  # fails early on invalid patterns
+        self.routes.append((method, pattern, handler))
+        # compiled again on the next lookup
+        self.static_routes = None
+
+    def route(self, method: HttpMethod, pattern: str) -> Callable[[Handler], Handler]:
+        def register(handler: Handler) -> Handler:
+            self.add(method, pattern, handler)
+            return handler
+
+        return register
+
+    def get(self, pattern: str) -> Callable[[Handler], Handler]:
+        return self.route(HttpMethod.GET, pattern)
+
+    def post(self, pattern: str) -> Callable[[Handler], Handler]:
+        return self.route(HttpMethod.POST, pattern)
+
+    def compile(self):
+        static_routes: dict[str, dict[HttpMethod, Handler]] = {}
+        root = RouteNode()
+        for method, pattern, handler in self.routes:
+            segments = split_pattern(pattern)
+            if all(isinstance(s, str) for s in segments):
+                handlers = static_routes.setdefault("/".join(segments), {})
+            else:
+                node = root
+                for segment in segments:
+                    node = node.child(segment)
+                handlers = node.handlers
+            if method in handlers:
+                raise ValueError(f"Route registered twice: {method.value} {pattern}")
+            handlers[method] = handler
+        # root first: a lookup in another thread skips compiling once static_routes
+        # is set
+        self.root = root
+        self.static_routes = static_routes
+
+    def resolve(self, method: HttpMethod, path: str) -> tuple[Handler, dict[str, Any]]:
+        """`path` is the request path without its leading slash. Returns the handler
+        and the converted parameters"""
+        if self.static_routes is None:
+            self.compile()
+
+        params: dict[str, Any] = {}
+        handlers = self.static_routes.get(path.strip("/"))
+        if handlers is None:
+            node = self.root.match(path.split("/") if path else [], 0, params)
+            if node is None:
+                raise RouteNotFound(path)
+            handlers = node.handlers
+
+        handler = handlers.get(method)
+        if handler is None:
+            raise MethodNotAllowed(sorted(handlers, key=lambda m: m.value))
+        return handler, params
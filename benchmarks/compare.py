@@ -0,0 +1,78 @@
+"""Compares two reports of the same benchmark, for ex made on two commits.
+
+    python -m benchmarks.compare before.json after.json [--threshold 0.1]
+
+Exits with code 1 if a case regressed by more than the threshold: a lower
+throughput or a higher p99 latency for the load benchmark, a higher time per
+operation for the micro benchmarks.
+"""
+
+import argparse
+import json
+import sys
+
+# metric -> True if higher is better
+METRICS = {
+    "micro": {"ns_per_op": False},
+    "load": {"throughput": True, "latency_ms.p99": False},
+    "loop_lag": {"loop_lag_ms.p99": False, "probe_ms.p99": False},
+}
+
+
+def metric(result: dict, path: str) -> float:
+    value = result
+    for key in path.split("."):
+        value = value[key]
+    return value
+
+
+def compare(before: dict, after: dict, threshold: float) -> list[str]:
+    """Prints the change of every case and returns the regressions"""
+    benchmark = after["meta"]["benchmark"]
+    if before["meta"]["benchmark"] != benchmark:
+        raise ValueError("The reports are not of the same benchmark")
+
+    previous = {result["name"]: result for result in before["results"]}
+    regressions = []
+    for result in after["results"]:
+        old = previous.get(result["name"])
+        if old is None:
+            continue
+        for path, higher_is_better in METRICS[benchmark].items():
+            old_value, new_value = metric(old, path), metric(result, path)
+            if not old_value:
+                continue
+            change = (new_value - old_value) / old_value
+            line = f"{result['name']:<36} {path:<16} {old_value:>12} -> {new_value:>12} ({change:+.1%})"
+            print(line)
+            if (-change if higher_is_better else change) > threshold:
+                regressions.append(line)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("before")
+    parser.add_argument("after")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.1,
+        help="relative change beyond which a case is a regression",
+    )
+    args = parser.parse_args()
+
+    with open(args.before) as f:
+        before = json.load(f)
+    with open(args.after) as f:
+        after = json.load(f)
+    print(f"{before['meta']['commit']} -> {after['meta']['commit']}")
+    regressions = compare(before, after, args.threshold)
+    if regressions:
+        print(f"\n{len(regressions)} regressions above {args.threshold:.0%}:")
+        print("\n".join(regressions))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,231 @@
+"""Load generator driving the server modes over loopback.
+
+    python -m benchmarks.load --modes thread-pool asyncio --concurrency 50 \
+        --requests 5000 --payload-sizes 0 65536 --output load.json
+
+Each mode is started in its own process with `python -m app.main`, then an
+asyncio client opens `--concurrency` connections and sends GET /files/ requests
+for a file of each payload size, with persistent connections or (with
+`--no-keep-alive`) one connection per request. The first requests of each run
+are a warm-up and are not measured.
+
+The client is a single python process as well: with fast modes and high
+concurrency it can be the bottleneck, which shows as the same throughput for all
+the modes.
+"""
+
+import argparse
+import asyncio
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+from app.main import SERVER_MODES
+from benchmarks.report import metadata, percentile, write_report
+
+HOST = "localhost"
+PORT = 4221
+
+
+class Run:
+    """Shared state of the client connections of one measurement"""
+
+    def __init__(self, nb_requests: int, path: str, keep_alive: bool):
+        self.remaining = nb_requests
+        self.request = (
+            f"GET {path} HTTP/1.1\r\nHost: {HOST}:{PORT}\r\n"
+            + ("" if keep_alive else "Connection: close\r\n")
+            + "\r\n"
+        ).encode()
+        self.keep_alive = keep_alive
+        self.latencies: list[float] = []
+        self.errors = 0
+
+    def take(self) -> bool:
+        if self.remaining <= 0:
+            return False
+        self.remaining -= 1
+        return True
+
+
+async def read_response(reader: asyncio.StreamReader) -> bool:
+    """Reads one response. Returns whether the server keeps the connection open"""
+    head = await reader.readuntil(b"\r\n\r\n")
+    status_line, _, header_block = head.partition(b"\r\n")
+    if not status_line.startswith(b"HTTP/1.1 200"):
+        raise ValueError(f"Unexpected status: {status_line!r}")
+    content_length = 0
+    keep_alive = True
+    for line in header_block.split(b"\r\n"):
+        name, _, value = line.partition(b":")
+        match name.strip().lower():
+            case b"content-length":
+                content_length = int(value)
+            case b"connection":
+                keep_alive = value.strip().lower() != b"close"
+    await reader.readexactly(content_length)
+    return keep_alive
+
+
+async def client(run: Run):
+    reader = writer = None
+    while run.take():
+        start = time.perf_counter()
+        try:
+            if writer is None:
+                reader, writer = await asyncio.open_connection(HOST, PORT)
+            writer.write(run.request)
+            keep_alive = await read_response(reader)
+        except (OSError, ValueError, asyncio.IncompleteReadError):
+            run.errors += 1
+            keep_alive = False
+        else:
+            run.latencies.append(time.perf_counter() - start)
+        if not (keep_alive and run.keep_alive) and writer is not None:
+            writer.close()
+            reader = writer = None
+    if writer is not None:
+        writer.close()
+
+
+async def measure(
+    nb_requests: int, concurrency: int, path: str, keep_alive: bool
+) -> dict:
+    warmup = Run(concurrency * 4, path, keep_alive)
+    await asyncio.gather(*(client(warmup) for _ in range(concurrency)))
+
+    run = Run(nb_requests, path, keep_alive)
+    start = time.perf_counter()
+    await asyncio.gather(*(client(run) for _ in range(concurrency)))
+    duration = time.perf_counter() - start
+
+    latencies = sorted(run.latencies)
+    return {
+        "requests": len(latencies),
+        "errors": run.errors,
+        "duration": round(duration, 3),
+        "throughput": round(len(latencies) / duration, 1),
+        "latency_ms": {
+            "mean": round(sum(latencies) / max(len(latencies), 1) * 1e3, 3),
+            "p50": round(percentile(latencies, 0.50) * 1e3, 3),
+            "p99": round(percentile(latencies, 0.99) * 1e3, 3),
+            "p999": round(percentile(latencies, 0.999) * 1e3, 3),
+            "max": round(latencies[-1] * 1e3 if latencies else 0.0, 3),
+        },
+    }
+
+
+def wait_for_port(server: subprocess.Popen, timeout: float = 10.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError(f"Server exited with code {server.returncode}")
+        try:
+            socket.create_connection((HOST, PORT), timeout=0.5).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise TimeoutError(f"Server not listening after {timeout}s")
+
+
+def start_server(mode: str, directory: str, extra_args: list[str]) -> subprocess.Popen:
+    server = subprocess.Popen(
+        [sys.executable, "-m", "app.main", "--mode", mode, "--directory", directory]
+        + extra_args,
+        stdout=subprocess.DEVNULL,
+    )
+    try:
+        wait_for_port(server)
+    except BaseException:
+        stop_server(server)
+        raise
+    return server
+
+
+def stop_server(server: subprocess.Popen):
+    server.terminate()
+    try:
+        server.wait(timeout=15)
+    except subprocess.TimeoutExpired:
+        server.kill()
+        server.wait()
+
+
+def make_payloads(directory: str, sizes: list[int]) -> dict[int, str]:
+    """size -> request path of a file of that size"""
+    paths = {}
+    for size in sizes:
+        name = f"payload-{size}"
+        with open(os.path.join(directory, name), "wb") as f:
+            f.write(os.urandom(size))
+        paths[size] = f"/files/{name}"
+    return paths
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--modes",
+        nargs="+",
+        choices=SERVER_MODES.keys(),
+        default=["thread-pool", "asyncio", "asyncio-protocol", "selectors"],
+    )
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[10])
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument(
+        "--payload-sizes", type=int, nargs="+", default=[0, 1024, 64 * 1024]
+    )
+    parser.add_argument(
+        "--no-keep-alive",
+        dest="keep_alive",
+        action="store_false",
+        help="one connection per request",
+    )
+    parser.add_argument(
+        "--server-args",
+        default="",
+        help="extra arguments of the servers, for ex '--threads 8'",
+    )
+    parser.add_argument("--output", help="JSON report file (default: stdout)")
+    args = parser.parse_args()
+
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        paths = make_payloads(directory, args.payload_sizes)
+        for mode in args.modes:
+            server = start_server(mode, directory, args.server_args.split())
+            try:
+                for concurrency in args.concurrency:
+                    for size, path in paths.items():
+                        result = asyncio.run(
+                            measure(args.requests, concurrency, path, args.keep_alive)
+                        )
+                        result = {
+                            "name": f"{mode}/c{concurrency}/{size}B/"
+                            + ("keep-alive" if args.keep_alive else "close"),
+                            "mode": mode,
+                            "concurrency": concurrency,
+                            "keep_alive": args.keep_alive,
+                            "payload_size": size,
+                            **result,
+                        }
+                        results.append(result)
+                        print(
+                            f"{result['name']:<36} {result['throughput']:>9} req/s"
+                            f"  p50 {result['latency_ms']['p50']:>8} ms"
+                            f"  p99 {result['latency_ms']['p99']:>8} ms"
+                            f"  errors {result['errors']}",
+                            file=sys.stderr,
+                            flush=True,
+                        )
+            finally:
+                stop_server(server)
+
+    write_report({"meta": metadata("load"), "results": results}, args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,288 @@
+"""Event loop lag of the asyncio engines while large files are transferred.
+
+    python -m benchmarks.loop_lag --engines asyncio asyncio-protocol \
+        --io-threads 0 4 --file-size 8388608 --output loop_lag.json
+
+For each engine and nb of io threads a server is started in its own process
+(`python -m benchmarks.loop_lag serve`) with a task measuring how late
+`asyncio.sleep(interval)` wakes up on its loop: the lag, how long any connection
+may wait before being served. The client downloads large files over a few
+connections, as is and gzip compressed (in memory: no streaming, no compression
+cache, every request compresses the whole file), while a probe connection sends
+`GET /echo/` requests, whose latency is the lag as seen by a client. Only the lag
+measured while the downloads run is reported.
+
+With `--io-threads 0` the disk io and compression run on the loop, as they did
+before the io threads.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+from app import offload
+from app.compression import COMPRESSION_CACHE
+from app.config import ServerConfig
+from app.main import (
+    handle_connection_with_asyncio,
+    handle_connection_with_asyncio_protocol,
+)
+from benchmarks.load import HOST, PORT, read_response, stop_server, wait_for_port
+from benchmarks.report import metadata, percentile, write_report
+
+ENGINES = {
+    "asyncio": handle_connection_with_asyncio,
+    "asyncio-protocol": handle_connection_with_asyncio_protocol,
+}
+
+ENCODINGS = ("identity", "gzip")
+
+# seconds between two wake ups of the lag monitor, and two probe requests
+LAG_INTERVAL = 0.005
+PROBE_INTERVAL = 0.01
+
+
+# server process ##################################################
+
+
+async def monitor_lag(samples: list[tuple[float, float]]):
+    """Appends (time, lag) samples, `time.monotonic` being the same clock for all
+    the processes"""
+    while True:
+        start = time.monotonic()
+        await asyncio.sleep(LAG_INTERVAL)
+        now = time.monotonic()
+        samples.append((now, now - start - LAG_INTERVAL))
+
+
+async def serve(engine: str, directory: str, config: ServerConfig, samples_file: str):
+    loop = asyncio.get_running_loop()
+    stop = asyncio.Event()
+    loop.add_signal_handler(signal.SIGTERM, stop.set)
+    samples: list[tuple[float, float]] = []
+    monitor = asyncio.create_task(monitor_lag(samples))
+    sock = socket.create_server((HOST, PORT), reuse_port=True)
+    await ENGINES[engine](directory, config, sock=sock, stop=stop)
+    monitor.cancel()
+    with open(samples_file, "w") as f:
+        json.dump(samples, f)
+
+
+def run_server(args: argparse.Namespace):
+    config = ServerConfig(
+        io_threads=args.io_threads,
+        compression_cache_size=0,
+        stream_compression_threshold=0,
+    )
+    COMPRESSION_CACHE.resize(config.compression_cache_size)
+    offload.configure(config.io_threads)
+    asyncio.run(serve(args.engine, args.directory, config, args.samples_file))
+
+
+# client ##########################################################
+
+
+class Transfers:
+    def __init__(self, nb_downloads: int, request: bytes):
+        self.remaining = nb_downloads
+        self.request = request
+        self.errors = 0
+        self.done = False
+
+
+async def download(transfers: Transfers):
+    reader, writer = await asyncio.open_connection(HOST, PORT)
+    try:
+        while transfers.remaining > 0:
+            transfers.remaining -= 1
+            writer.write(transfers.request)
+            try:
+                await read_response(reader)
+            except (OSError, ValueError, asyncio.IncompleteReadError):
+                transfers.errors += 1
+                return
+    finally:
+        writer.close()
+
+
+async def probe(transfers: Transfers, latencies: list[float]):
+    request = f"GET /echo/probe HTTP/1.1\r\nHost: {HOST}:{PORT}\r\n\r\n".encode()
+    reader = writer = None
+    while not transfers.done:
+        start = time.perf_counter()
+        if writer is None:
+            reader, writer = await asyncio.open_connection(HOST, PORT)
+        writer.write(request)
+        if not await read_response(reader):
+            # max nb of requests per connection reached
+            writer.close()
+            reader = writer = None
+        latencies.append(time.perf_counter() - start)
+        await asyncio.sleep(PROBE_INTERVAL)
+    if writer is not None:
+        writer.close()
+
+
+async def measure(
+    path: str, encoding: str, nb_downloads: int, concurrency: int
+) -> tuple[float, float, dict]:
+    request = (
+        f"GET {path} HTTP/1.1\r\nHost: {HOST}:{PORT}\r\n"
+        f"Accept-Encoding: {encoding}\r\n\r\n"
+    ).encode()
+    transfers = Transfers(nb_downloads, request)
+    latencies: list[float] = []
+    probe_task = asyncio.create_task(probe(transfers, latencies))
+    start = time.monotonic()
+    await asyncio.gather(*(download(transfers) for _ in range(concurrency)))
+    end = time.monotonic()
+    transfers.done = True
+    await probe_task
+
+    latencies.sort()
+    return (
+        start,
+        end,
+        {
+            "downloads": nb_downloads,
+            "errors": transfers.errors,
+            "duration": round(end - start, 3),
+            "downloads_per_s": round(nb_downloads / (end - start), 2),
+            "probe_ms": summary(latencies),
+        },
+    )
+
+
+def summary(seconds: list[float]) -> dict:
+    """Of sorted durations, in ms"""
+    return {
+        "count": len(seconds),
+        "p50": round(percentile(seconds, 0.50) * 1e3, 3),
+        "p99": round(percentile(seconds, 0.99) * 1e3, 3),
+        "max": round(seconds[-1] * 1e3 if seconds else 0.0, 3),
+    }
+
+
+def make_file(directory: str, size: int) -> str:
+    """Request path of a file that compresses about 2:1"""
+    name = f"large-{size}"
+    with open(os.path.join(directory, name), "wb") as f:
+        f.write(os.urandom(size // 2).hex().encode())
+    return f"/files/{name}"
+
+
+def run_case(
+    engine: str, io_threads: int, directory: str, path: str, args
+) -> list[dict]:
+    samples_file = os.path.join(directory, "lag.json")
+    server = subprocess.Popen(
+        [
+            sys.executable,
+            "-m",
+            "benchmarks.loop_lag",
+            "serve",
+            "--engine",
+            engine,
+            "--io-threads",
+            str(io_threads),
+            "--directory",
+            directory,
+            "--samples-file",
+            samples_file,
+        ],
+        stdout=subprocess.DEVNULL,
+    )
+    try:
+        wait_for_port(server)
+        windows = {}
+        results = {}
+        for encoding in ENCODINGS:
+            start, end, result = asyncio.run(
+                measure(path, encoding, args.downloads, args.concurrency)
+            )
+            windows[encoding] = (start, end)
+            results[encoding] = result
+    finally:
+        stop_server(server)
+
+    with open(samples_file) as f:
+        samples = json.load(f)
+    os.remove(samples_file)
+    reports = []
+    for encoding in ENCODINGS:
+        start, end = windows[encoding]
+        lags = sorted(lag for t, lag in samples if start <= t <= end)
+        reports.append(
+            {
+                "name": f"{engine}/io{io_threads}/{encoding}",
+                "engine": engine,
+                "io_threads": io_threads,
+                "encoding": encoding,
+                "file_size": args.file_size,
+                "concurrency": args.concurrency,
+                **results[encoding],
+                "loop_lag_ms": summary(lags),
+            }
+        )
+    return reports
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    subparsers = parser.add_subparsers(dest="command")
+    serve_parser = subparsers.add_parser("serve", help="server process of a case")
+    serve_parser.add_argument("--engine", choices=ENGINES.keys(), required=True)
+    serve_parser.add_argument("--io-threads", type=int, required=True)
+    serve_parser.add_argument("--directory", required=True)
+    serve_parser.add_argument("--samples-file", required=True)
+
+    parser.add_argument(
+        "--engines", nargs="+", choices=ENGINES.keys(), default=list(ENGINES)
+    )
+    parser.add_argument(
+        "--io-threads",
+        type=int,
+        nargs="+",
+        default=[0, ServerConfig.io_threads],
+        help="nb of io threads of the servers, 0: io and compression on the loop",
+    )
+    parser.add_argument("--file-size", type=int, default=8 * 1024**2)
+    parser.add_argument("--downloads", type=int, default=16)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--output", help="JSON report file (default: stdout)")
+    args = parser.parse_args()
+
+    if args.command == "serve":
+        run_server(args)
+        return
+
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        path = make_file(directory, args.file_size)
+        for engine in args.engines:
+            for io_threads in args.io_threads:
+                for result in run_case(engine, io_threads, directory, path, args):
+                    results.append(result)
+                    print(
+                        f"{result['name']:<32}"
+                        f" lag p99 {result['loop_lag_ms']['p99']:>8} ms"
+                        f" max {result['loop_lag_ms']['max']:>8} ms"
+                        f"  probe p99 {result['probe_ms']['p99']:>8} ms"
+                        f"  {result['downloads_per_s']:>7} downloads/s"
+                        f"  errors {result['errors']}",
+                        file=sys.stderr,
+                        flush=True,
+                    )
+
+    write_report({"meta": metadata("loop_lag"), "results": results}, args.output)
+
+
+if __name__ == "__main__":
+    main()
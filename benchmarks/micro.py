@@ -0,0 +1,135 @@
+"""Micro benchmarks of the request parser and the response serializer.
+
+    python -m benchmarks.micro [--output micro.json]
+
+Each case reports the best time per operation over a few repeats, in
+nanoseconds.
+"""
+
+import argparse
+import timeit
+from typing import Callable
+
+from app.api import handle_req
+from app.compression import COMPRESSION_CACHE
+from app.framing import RequestFramer
+from app.http import HttpRequest, HttpResponse, HttpStatus, HttpVersion, ParserEngine
+from app.response_cache import RESPONSE_CACHE
+from benchmarks.report import metadata, write_report
+
+REQUEST = (
+    b"GET /echo/abc HTTP/1.1\r\n"
+    b"Host: localhost:4221\r\n"
+    b"User-Agent: Mozilla/5.0 (X11; Linux x86_64; rv:130.0) Gecko/20100101\r\n"
+    b"Accept: text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8\r\n"
+    b"Accept-Language: en-US,en;q=0.5\r\n"
+    b"Accept-Encoding: gzip, deflate\r\n"
+    b"Connection: keep-alive\r\n"
+    b"\r\n"
+)
+
+
+def text(size: int) -> bytes:
+    line = b"The quick brown fox jumps over the lazy dog\n"
+    return (line * (size // len(line) + 1))[:size]
+
+
+def parse_and_read_headers(engine: ParserEngine) -> Callable[[], None]:
+    def run():
+        req = HttpRequest.from_bytes(REQUEST, engine)
+        req.headers.get("Accept-Encoding")
+        req.wants_keep_alive()
+
+    return run
+
+
+def serialize(size: int) -> Callable[[], bytes]:
+    res = HttpResponse.encoded_content(status=HttpStatus.Ok200, content=text(size))
+    return res.to_bytes
+
+
+def frame_body(size: int, chunk_size: int = 64 * 1024) -> Callable[[], None]:
+    """Framing of a POST whose body arrives in `chunk_size` recvs, until the
+    request is built with its body"""
+    head = b"POST /echo/a HTTP/1.1\r\nContent-Length: %d\r\n\r\n" % size
+    body = text(size)
+    chunks = [body[i : i + chunk_size] for i in range(0, size, chunk_size)]
+
+    def run():
+        framer = RequestFramer()
+        framer.feed(head)
+        req = HttpRequest.from_bytes(framer.pop_head())
+        for chunk in chunks:
+            framer.feed(chunk)
+        req.body = framer.pop_body()
+
+    return run
+
+
+def gzip_text(size: int, cached: bool) -> Callable[[], None]:
+    content = text(size)
+
+    def run():
+        if not cached:
+            COMPRESSION_CACHE.clear()
+        HttpResponse.text_content(content=content, content_encoding="gzip")
+
+    return run
+
+
+def answer_echo(cached: bool) -> Callable[[], None]:
+    """Handling and serialisation of a parsed `GET /echo/abc` asking for gzip"""
+    req = HttpRequest.from_bytes(REQUEST)
+
+    def run():
+        if not cached:
+            RESPONSE_CACHE.clear()
+        res = handle_req(req, None)
+        res.set_keep_alive(True, HttpVersion.V1_1)
+        res.to_buffers()
+
+    return run
+
+
+CASES: dict[str, Callable[[], object]] = {
+    "from_bytes/fast": parse_and_read_headers(ParserEngine.FAST),
+    "from_bytes/pyparsing": parse_and_read_headers(ParserEngine.PYPARSING),
+    "frame_body/1MiB": frame_body(1024**2),
+    "to_bytes/empty": serialize(0),
+    "to_bytes/1KiB": serialize(1024),
+    "to_bytes/1MiB": serialize(1024**2),
+    "text_content_gzip/1KiB": gzip_text(1024, cached=False),
+    "text_content_gzip/100KiB": gzip_text(100 * 1024, cached=False),
+    "text_content_gzip/100KiB/cached": gzip_text(100 * 1024, cached=True),
+    "answer_echo": answer_echo(cached=False),
+    "answer_echo/cached": answer_echo(cached=True),
+}
+
+
+def measure(run: Callable[[], object], min_time: float = 0.2, repeat: int = 5) -> float:
+    """Best time of one call, in ns"""
+    timer = timeit.Timer(run)
+    number, _ = timer.autorange()
+    number = max(number, int(number * min_time / 0.2))
+    return min(timer.repeat(repeat=repeat, number=number)) / number * 1e9
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--output", help="JSON report file (default: stdout)")
+    parser.add_argument("--filter", default="", help="only run the matching cases")
+    args = parser.parse_args()
+
+    results = []
+    for name, run in CASES.items():
+        if args.filter not in name:
+            continue
+        ns = measure(run)
+        results.append({"name": name, "ns_per_op": round(ns, 1)})
+        print(f"{name:<36} {ns:>12.0f} ns", flush=True)
+
+    write_report({"meta": metadata("micro"), "results": results}, args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,49 @@
+"""JSON reports shared by the benchmarks, so that runs on different commits can be
+compared with `python -m benchmarks.compare`"""
+
+import json
+import platform
+import subprocess
+import sys
+import time
+
+
+def git_commit() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def metadata(benchmark: str) -> dict:
+    return {
+        "benchmark": benchmark,
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+    }
+
+
+def percentile(sorted_values: list[float], p: float) -> float:
+    """Nearest-rank percentile of already sorted values"""
+    if not sorted_values:
+        return 0.0
+    rank = min(int(p * len(sorted_values)), len(sorted_values) - 1)
+    return sorted_values[rank]
+
+
+def write_report(report: dict, output: str | None):
+    """To the file if given, stdout otherwise"""
+    content = json.dumps(report, indent=2)
+    if output:
+        with open(output, "w") as f:
+            f.write(content + "\n")
+        print(f"Report written to {output}", file=sys.stderr)
+    else:
+        print(content)
@@ -0,0 +1,64 @@
+"""Dispatch cost of the route registry against the former linear chain of
+`startswith` checks, with a growing nb of registered routes.
+
+    python -m benchmarks.routing
+"""
+
+import timeit
+
+from app.http import HttpMethod
+from app.routing import Router
+
+ROUTE_COUNTS = (5, 50, 500)
+
+
+def make_router(nb_routes: int) -> Router:
+    router = Router()
+    for i in range(nb_routes):
+        router.get(f"/static{i}")(lambda: None)
+        router.get(f"/prefix{i}/{{item}}/details/{{item_id:int}}")(lambda: None)
+    router.compile()
+    return router
+
+
+def make_linear(nb_routes: int):
+    """Same routes as `make_router`, tested one after the other"""
+    static = [f"static{i}" for i in range(nb_routes)]
+    prefixes = [f"prefix{i}/" for i in range(nb_routes)]
+
+    def dispatch(path: str):
+        for route in static:
+            if path == route:
+                return route
+        for prefix in prefixes:
+            if path.startswith(prefix):
+                return prefix
+        return None
+
+    return dispatch
+
+
+def main():
+    print(f"{'routes':>8} {'path':>10} {'router':>12} {'linear':>12}")
+    for nb_routes in ROUTE_COUNTS:
+        router = make_router(nb_routes)
+        linear = make_linear(nb_routes)
+        last = nb_routes - 1
+        paths = {
+            "static": f"static{last}",
+            "params": f"prefix{last}/abc/details/123",
+        }
+        for kind, path in paths.items():
+            number = 20000
+            router_time = timeit.timeit(
+                lambda: router.resolve(HttpMethod.GET, path), number=number
+            )
+            linear_time = timeit.timeit(lambda: linear(path), number=number)
+            print(
+                f"{nb_routes * 2:>8} {kind:>10} "
+                f"{router_time / number * 1e6:>10.2f}us {linear_time / number * 1e6:>10.2f}us"
+            )
+
+
+if __name__ == "__main__":
+    main()
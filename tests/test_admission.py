@@ -0,0 +1,135 @@
+import multiprocessing
+import socket
+import threading
+import time
+from app.admission import (
+    BoundedThreadPool,
+    ConnectionLimiter,
+    SharedConnectionLimiter,
+)
+from app.metrics import METRICS
+
+
+def test_connections_beyond_the_queue_get_a_503():
+    release = threading.Event()
+    handled = []
+
+    def handler(conn: socket.socket):
+        release.wait()
+        with conn:
+            handled.append(conn.recv(1024))
+
+    pool = BoundedThreadPool(handler, nb_threads=1, max_pending=1, retry_after=7)
+    pairs = [socket.socketpair() for _ in range(3)]
+    for client, _ in pairs:
+        client.sendall(b"GET / HTTP/1.1\r\n\r\n")
+
+    assert pool.submit(pairs[0][1])
+    # wait for the only thread to pick the first connection
+    while pool.queue_depth:
+        time.sleep(0.001)
+    assert pool.submit(pairs[1][1])
+    assert not pool.submit(pairs[2][1])
+
+    rejected = pairs[2][0].recv(1024)
+    assert rejected.startswith(b"HTTP/1.1 503 Service Unavailable\r\n")
+    assert b"Retry-After: 7\r\n" in rejected
+    assert b"Connection: close\r\n" in rejected
+
+    release.set()
+    pool.shutdown()
+    assert len(handled) == 2
+    stats = pool.stats.snapshot()
+    assert (stats["admitted"], stats["rejected"]) == (2, 1)
+    assert stats["max_queue_depth"] == 1
+    assert stats["max_wait"] >= stats["p50_wait"] >= 0
+    for client, _ in pairs:
+        client.close()
+
+
+def test_connections_per_ip():
+    limiter = ConnectionLimiter(max_per_ip=2)
+    assert limiter.acquire("10.0.0.1")
+    assert limiter.acquire("10.0.0.1")
+    assert not limiter.acquire("10.0.0.1")
+    assert limiter.acquire("10.0.0.2")
+    limiter.release("10.0.0.1")
+    assert limiter.acquire("10.0.0.1")
+    for _ in range(2):
+        limiter.release("10.0.0.1")
+    limiter.release("10.0.0.2")
+    assert limiter.counts == {}
+
+
+def acquire_in_worker(limiter: SharedConnectionLimiter, ip: str, results):
+    results.put(limiter.acquire(ip))
+
+
+def test_shared_limit_across_workers():
+    ctx = multiprocessing.get_context("fork")
+    limiter = SharedConnectionLimiter(max_per_ip=2, nb_workers=2)
+    results = ctx.Queue()
+    # a connection in worker 0, then two in worker 1
+    for row in (0, 1, 1):
+        limiter.row = row
+        worker = ctx.Process(target=acquire_in_worker, args=(limiter, "a", results))
+        worker.start()
+        worker.join()
+    assert [results.get() for _ in range(3)] == [True, True, False]
+
+    # the replacement of worker 1 starts from a clean row
+    limiter.use_row(1)
+    assert limiter.acquire("a")
+    assert not limiter.acquire("a")
+
+
+def test_pool_limits_connections_per_ip():
+    release = threading.Event()
+
+    def handler(conn: socket.socket):
+        release.wait()
+        conn.close()
+
+    pool = BoundedThreadPool(
+        handler, nb_threads=2, max_pending=0, limiter=ConnectionLimiter(1)
+    )
+    pairs = [socket.socketpair() for _ in range(3)]
+    assert pool.submit(pairs[0][1], "10.0.0.1")
+    assert not pool.submit(pairs[1][1], "10.0.0.1")
+    assert pool.submit(pairs[2][1], "10.0.0.2")
+    assert pairs[1][0].recv(1024).startswith(b"HTTP/1.1 503 Service Unavailable")
+
+    release.set()
+    pool.shutdown()
+    # released once handled
+    assert pool.limiter.counts == {}
+    for client, _ in pairs:
+        client.close()
+
+
+def test_pool_stats_are_in_the_metrics():
+    release = threading.Event()
+    pool = BoundedThreadPool(lambda conn: release.wait(), nb_threads=1, max_pending=1)
+    before = METRICS.snapshot()
+    pairs = [socket.socketpair() for _ in range(3)]
+    assert pool.submit(pairs[0][1])
+    while pool.queue_depth:
+        time.sleep(0.001)
+    assert pool.submit(pairs[1][1])
+    assert not pool.submit(pairs[2][1])
+
+    # observable while the pool runs
+    snapshot = METRICS.snapshot()
+    assert snapshot.gauges["http_pool_queue_depth"] == 1
+    for outcome, nb in (("admitted", 2), ("rejected", 1)):
+        assert snapshot.connections[outcome] == before.connections.get(outcome, 0) + nb
+    assert sum(snapshot.stages["queue"].counts) >= 1
+    assert 'http_connections_total{outcome="rejected"}' in METRICS.render()
+    assert "http_pool_queue_depth 1" in METRICS.render()
+
+    release.set()
+    pool.shutdown()
+    assert "http_pool_queue_depth" not in METRICS.snapshot().gauges
+    for client, server in pairs:
+        client.close()
+        server.close()
@@ -0,0 +1,22 @@
+from app.cache import LRUBytesCache
+
+
+def test_lru_evicts_by_size():
+    cache = LRUBytesCache(max_bytes=10)
+    cache.put("a", b"1234")
+    cache.put("b", b"5678")
+    assert cache.get("a") == b"1234"
+    # "b" is the least recently used
+    cache.put("c", b"90ab")
+    assert cache.get("b") is None
+    assert cache.get("a") == b"1234"
+    assert cache.get("c") == b"90ab"
+    assert cache.size == 8
+    assert cache.stats()["evictions"] == 1
+    assert cache.stats()["hits"] == 3
+    assert cache.stats()["misses"] == 1
+
+    cache.put("big", b"x" * 11)
+    assert cache.get("big") is None
+    cache.resize(4)
+    assert len(cache) == 1
@@ -0,0 +1,101 @@
+import gzip
+import os
+import zlib
+from app.api import handle_req
+from app.compression import (
+    COMPRESSION_CACHE,
+    compress_bytes,
+    compress_file,
+    compress_file_stream,
+    negotiate_encoding,
+)
+from app.config import ServerConfig
+from app.file_cache import FILE_CACHE
+from app.http import FileBody, HttpRequest, HttpStatus
+from app.metrics import METRICS
+from app.precompress import precompress_directory
+
+
+def test_negotiate_encoding():
+    for header, expected in [
+        (None, "identity"),
+        ("", "identity"),
+        ("gzip", "gzip"),
+        ("GZIP , deflate", "gzip"),
+        ("gzip;q=0.5,deflate", "deflate"),
+        ("gzip; q=0.5, deflate ;q=0.8, identity;q=0.9", "identity"),
+        ("br", "identity"),
+        ("*", "gzip"),
+        ("gzip;q=0, *;q=0.1", "deflate"),
+        ("br, identity;q=0", None),
+        ("*;q=0", None),
+        ("gzip;q=abc", "identity"),
+    ]:
+        assert negotiate_encoding(header) == expected, header
+
+
+def test_deflate():
+    body = b"hello " * 100
+    assert zlib.decompress(compress_bytes(body, "deflate")) == body
+
+
+def test_compressed_bodies_are_cached(tmp_path):
+    COMPRESSION_CACHE.clear()
+    hits = COMPRESSION_CACHE.hits
+
+    body = b"hello " * 100
+    assert gzip.decompress(compress_bytes(body, "gzip")) == body
+    assert compress_bytes(body, "gzip") == compress_bytes(body, "gzip")
+    assert COMPRESSION_CACHE.hits == hits + 2
+
+    path = tmp_path / "file"
+    path.write_bytes(body)
+    compressed = compress_file(path, "gzip")
+    assert compress_file(path, "gzip") is compressed
+
+    # a modified file is compressed again
+    path.write_bytes(body + b"!")
+    os.utime(path, ns=(0, 0))
+    assert gzip.decompress(compress_file(path, "gzip")) == body + b"!"
+
+
+def test_streamed_compression_is_timed(tmp_path):
+    path = tmp_path / "file"
+    path.write_bytes(os.urandom(1000) * 10)
+    count = sum(METRICS.snapshot().histogram("compress").counts)
+    stream = compress_file_stream(path, "gzip", block_size=1000)
+    assert gzip.decompress(b"".join(stream)) == path.read_bytes()
+    assert sum(METRICS.snapshot().histogram("compress").counts) == count + 1
+    # a stream closed early too, once
+    stream = compress_file_stream(path, "gzip", block_size=1000)
+    next(stream)
+    stream.close()
+    assert sum(METRICS.snapshot().histogram("compress").counts) == count + 2
+
+
+def test_precompressed_sidecars(tmp_path):
+    content = b"hello " * 1000
+    (tmp_path / "file").write_bytes(content)
+    assert precompress_directory(str(tmp_path), jobs=1) == 1
+    assert gzip.decompress((tmp_path / "file.gz").read_bytes()) == content
+
+    req = HttpRequest.from_bytes(
+        b"GET /files/file HTTP/1.1\r\nAccept-Encoding: gzip\r\n\r\n"
+    )
+    config = ServerConfig(precompressed_sidecars=True)
+    res = handle_req(req, str(tmp_path), config)
+    assert isinstance(res.body, FileBody)
+    assert res.body.path == tmp_path / "file.gz"
+    assert res.headers["Content-Encoding"] == "gzip"
+
+    # the sidecar is older than the file: it is not used anymore once the cached
+    # metadata expires
+    os.utime(tmp_path / "file.gz", ns=(0, 0))
+    FILE_CACHE.clear()
+    res = handle_req(req, str(tmp_path), config)
+    assert gzip.decompress(res.body) == content
+
+    req = HttpRequest.from_bytes(
+        b"GET /files/file HTTP/1.1\r\nAccept-Encoding: identity;q=0\r\n\r\n"
+    )
+    assert handle_req(req, str(tmp_path), config).status == HttpStatus.NotAcceptable406
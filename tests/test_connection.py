@@ -0,0 +1,409 @@
+import asyncio
+import errno
+import gzip
+import socket
+import threading
+import time
+import pytest
+import app.api
+import app.connection_selectors
+import app.http
+from app.api import handle_req
+from app.config import ServerConfig
+from app.connection_async import handle_connection_async
+from app.connection_protocol import HttpProtocol
+from app.connection_selectors import SelectorServer, handle_connection_selectors
+from app.connection_sync import handle_connection
+from app.http import HttpRequest
+
+
+def handle_connection_protocol(
+    conn: socket.socket, directory: str | None, config: ServerConfig
+):
+    """Runs an `HttpProtocol` on the connection until it is closed"""
+
+    async def run():
+        loop = asyncio.get_running_loop()
+        lost = loop.create_future()
+
+        class Protocol(HttpProtocol):
+            def connection_lost(self, exc):
+                super().connection_lost(exc)
+                lost.set_result(None)
+
+        await loop.connect_accepted_socket(
+            lambda: Protocol(directory, config), sock=conn
+        )
+        await lost
+
+    asyncio.run(run())
+
+
+def handle_connection_streams(
+    conn: socket.socket, directory: str | None, config: ServerConfig
+):
+    """Runs `handle_connection_async` on the connection"""
+
+    async def run():
+        reader, writer = await asyncio.open_connection(sock=conn)
+        await handle_connection_async(reader, writer, directory, config)
+
+    asyncio.run(run())
+
+
+ENGINES = {
+    "sync": handle_connection,
+    "streams": handle_connection_streams,
+    "protocol": handle_connection_protocol,
+    "selectors": handle_connection_selectors,
+}
+
+
+def serve(
+    requests: bytes,
+    config: ServerConfig = ServerConfig(),
+    directory: str | None = None,
+    engine: str = "sync",
+) -> bytes:
+    """Sends the raw requests to a connection handler through a socket pair and
+    returns everything received until the server closes the connection"""
+    client, server = socket.socketpair()
+    thread = threading.Thread(target=ENGINES[engine], args=(server, directory, config))
+    thread.start()
+    client.sendall(requests)
+    chunks = []
+    with client:
+        while chunk := client.recv(65536):
+            chunks.append(chunk)
+    thread.join()
+    return b"".join(chunks)
+
+
+@pytest.mark.parametrize("engine", ENGINES)
+def test_pipelined_requests(engine):
+    res = serve(
+        b"GET /echo/a HTTP/1.1\r\n\r\n"
+        b"GET /echo/bb HTTP/1.1\r\n\r\n"
+        b"GET /echo/ccc HTTP/1.1\r\nConnection: close\r\n\r\n",
+        engine=engine,
+    )
+    assert res.count(b"HTTP/1.1 200 OK") == 3
+    assert res.index(b"\r\n\r\na") < res.index(b"\r\n\r\nbb") < res.index(b"ccc")
+    assert res.count(b"Connection: close") == 1
+
+
+def test_selectors_failing_connection_does_not_stop_the_loop(monkeypatch):
+    def failing(req, directory, config):
+        if req.urlpath.path == "echo/boom":
+            raise RuntimeError("boom")
+        return handle_req(req, directory, config)
+
+    monkeypatch.setattr(app.connection_selectors, "handle_req", failing)
+    server = SelectorServer(None, ServerConfig())
+    failed, failed_server = socket.socketpair()
+    other, other_server = socket.socketpair()
+    server.add_connection(failed_server)
+    server.add_connection(other_server)
+    failed.sendall(b"GET /echo/boom HTTP/1.1\r\n\r\n")
+    other.sendall(b"GET /echo/a HTTP/1.1\r\nConnection: close\r\n\r\n")
+    while server.connections:
+        server.poll(1.0)
+    server.selector.close()
+    with failed, other:
+        assert failed.recv(65536) == b""
+        assert other.recv(65536).endswith(b"\r\n\r\na")
+
+
+@pytest.mark.parametrize("engine", ENGINES)
+def test_pyparsing_parser(monkeypatch, engine):
+    def fast_parser(msg_bytes):
+        raise AssertionError("the fast parser is not configured")
+
+    monkeypatch.setattr(app.http, "parse_request", fast_parser)
+    res = serve(
+        b"GET /echo/a HTTP/1.1\r\n\r\n"
+        b"GET /user-agent HTTP/1.1\r\nUser-Agent: test\r\n"
+        b"Connection: close\r\n\r\n",
+        ServerConfig(parser="pyparsing"),
+        engine=engine,
+    )
+    assert res.count(b"HTTP/1.1 200 OK") == 2
+    assert res.endswith(b"\r\n\r\ntest")
+
+
+@pytest.mark.parametrize("engine", ENGINES)
+def test_binary_body(engine):
+    body = bytes(range(256))
+    res = serve(
+        b"POST /echo/a HTTP/1.1\r\nContent-Length: 256\r\n\r\n"
+        + body
+        + b"GET /echo/b HTTP/1.1\r\nConnection: close\r\n\r\n",
+        engine=engine,
+    )
+    assert res.startswith(b"HTTP/1.1 405 Method Not Allowed\r\n")
+    assert res.endswith(b"\r\n\r\nb")
+
+
+@pytest.mark.parametrize("engine", ENGINES)
+def test_max_requests_per_connection(engine):
+    config = ServerConfig(max_requests_per_connection=2)
+    res = serve(b"GET / HTTP/1.1\r\n\r\n" * 3, config, engine=engine)
+    assert res.count(b"HTTP/1.1 200 OK") == 2
+    assert res.endswith(b"Connection: close\r\n\r\n")
+
+
+@pytest.mark.parametrize("engine", ENGINES)
+def test_http_1_0_closes_by_default(engine):
+    res = serve(b"GET / HTTP/1.0\r\n\r\nGET / HTTP/1.0\r\n\r\n", engine=engine)
+    assert res.count(b"HTTP/1.1 200 OK") == 1
+    assert b"Connection: close" in res
+
+
+@pytest.mark.parametrize("engine", ENGINES)
+def test_idle_timeout(engine):
+    config = ServerConfig(keep_alive_timeout=0.1)
+    res = serve(b"GET / HTTP/1.1\r\n\r\n", config, engine=engine)
+    assert res.count(b"HTTP/1.1 200 OK") == 1
+
+
+@pytest.mark.parametrize("engine", ENGINES)
+def test_get_file(tmp_path, engine):
+    content = bytes(range(256)) * 1000
+    (tmp_path / "data.bin").write_bytes(content)
+    (tmp_path / "empty").write_bytes(b"")
+    res = serve(
+        b"GET /files/empty HTTP/1.1\r\n\r\n"
+        b"GET /files/data.bin HTTP/1.1\r\nConnection: close\r\n\r\n",
+        directory=str(tmp_path),
+        engine=engine,
+    )
+    assert res.count(b"Content-Length: 0\r\n") == 1
+    assert f"Content-Length: {len(content)}\r\n".encode() in res
+    assert res.endswith(b"\r\n\r\n" + content)
+
+
+@pytest.mark.parametrize("engine", ENGINES)
+def test_post_file_streamed(tmp_path, engine):
+    content = bytes(range(256)) * 1000
+    res = serve(
+        f"POST /files/upload HTTP/1.1\r\nContent-Length: {len(content)}\r\n\r\n".encode()
+        + content
+        + b"GET /files/upload HTTP/1.1\r\nConnection: close\r\n\r\n",
+        directory=str(tmp_path),
+        engine=engine,
+    )
+    assert res.startswith(b"HTTP/1.1 201 Created\r\n")
+    assert (tmp_path / "upload").read_bytes() == content
+    assert res.endswith(b"\r\n\r\n" + content)
+
+
+@pytest.mark.parametrize("engine", ENGINES)
+def test_post_file_that_can_not_be_created(tmp_path, engine):
+    (tmp_path / "file").write_bytes(b"")
+    (tmp_path / "dir").mkdir()
+    for filename, status in (
+        ("missing-dir/upload", b"404 Not Found"),
+        ("file/upload", b"409 Conflict"),
+        ("dir", b"409 Conflict"),
+    ):
+        res = serve(
+            f"POST /files/{filename} HTTP/1.1\r\nContent-Length: 3\r\n"
+            "Connection: close\r\n\r\nabc".encode(),
+            directory=str(tmp_path),
+            engine=engine,
+        )
+        assert res.startswith(b"HTTP/1.1 " + status + b"\r\n"), filename
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["dir", "file"]
+
+
+@pytest.mark.parametrize(
+    "error, status",
+    [
+        (PermissionError(errno.EACCES, "denied"), b"403 Forbidden"),
+        (OSError(errno.ENOSPC, "full"), b"500 Internal Server Error"),
+    ],
+)
+def test_post_file_open_errors(tmp_path, monkeypatch, error, status):
+    def fail(*args):
+        raise error
+
+    monkeypatch.setattr(app.api, "open", fail, raising=False)
+    res = serve(
+        b"POST /files/upload HTTP/1.1\r\nContent-Length: 3\r\n"
+        b"Connection: close\r\n\r\nabc",
+        directory=str(tmp_path),
+    )
+    assert res.startswith(b"HTTP/1.1 " + status + b"\r\n")
+    # when the upload is not streamed
+    req = HttpRequest.from_bytes(b"POST /files/upload HTTP/1.1\r\n\r\n")
+    req.body = b"abc"
+    assert handle_req(req, str(tmp_path)).status.value == status.decode()
+
+
+@pytest.mark.parametrize("engine", ENGINES)
+def test_post_file_too_large(tmp_path, engine):
+    config = ServerConfig(max_body_size=10)
+    res = serve(
+        b"POST /files/upload HTTP/1.1\r\nContent-Length: 11\r\n"
+        b"Expect: 100-continue\r\n\r\n",
+        config,
+        directory=str(tmp_path),
+        engine=engine,
+    )
+    assert res.startswith(b"HTTP/1.1 413 Payload Too Large\r\n")
+    assert b"Connection: close" in res
+    assert not (tmp_path / "upload").exists()
+
+
+@pytest.mark.parametrize("engine", ENGINES)
+def test_post_file_interrupted(tmp_path, engine):
+    res = serve(
+        b"POST /files/upload HTTP/1.1\r\nContent-Length: 100\r\n"
+        b"Expect: 100-continue\r\n\r\nonly part of the body",
+        ServerConfig(body_timeout=0.1),
+        directory=str(tmp_path),
+        engine=engine,
+    )
+    assert res.startswith(b"HTTP/1.1 100 Continue\r\n\r\n")
+    assert b"HTTP/1.1 408 Request Timeout\r\n" in res
+    assert not (tmp_path / "upload").exists()
+
+
+@pytest.mark.parametrize("engine", ENGINES)
+def test_head_size_limits(engine):
+    config = ServerConfig(max_request_line=32, max_header_size=256)
+    res = serve(b"GET /echo/" + b"a" * 40 + b" HTTP/1.1\r\n\r\n", config, engine=engine)
+    assert res.startswith(b"HTTP/1.1 414 URI Too Long\r\n")
+    assert b"Connection: close" in res
+
+    res = serve(
+        b"GET / HTTP/1.1\r\n\r\n"
+        b"GET / HTTP/1.1\r\nX-Padding: " + b"x" * 300 + b"\r\n\r\n",
+        config,
+        engine=engine,
+    )
+    # the requests before are answered
+    assert res.startswith(b"HTTP/1.1 200 OK\r\n")
+    assert res.count(b"HTTP/1.1 431 Request Header Fields Too Large\r\n") == 1
+
+
+@pytest.mark.parametrize("engine", ENGINES)
+def test_slow_head_times_out(engine):
+    """A client sending its head a few bytes at a time gets `header_timeout` in
+    total, not per read"""
+    config = ServerConfig(header_timeout=0.3)
+    client, server = socket.socketpair()
+    thread = threading.Thread(target=ENGINES[engine], args=(server, None, config))
+    start = time.monotonic()
+    thread.start()
+    with client:
+        for byte in b"GET / HTTP/1.1\r\nHost: localhost\r\n":
+            try:
+                client.send(bytes([byte]))
+            except OSError:
+                break
+            time.sleep(0.02)
+        res = client.recv(1024)
+    thread.join()
+    assert res.startswith(b"HTTP/1.1 408 Request Timeout\r\n")
+    assert time.monotonic() - start < 1.0
+
+
+@pytest.mark.parametrize("engine", ENGINES)
+def test_client_not_reading_is_dropped(tmp_path, engine):
+    (tmp_path / "large").write_bytes(b"x" * 32 * 1024**2)
+    config = ServerConfig(write_timeout=0.2)
+    client, server = socket.socketpair()
+    thread = threading.Thread(
+        target=ENGINES[engine], args=(server, str(tmp_path), config)
+    )
+    thread.start()
+    with client:
+        client.sendall(b"GET /files/large HTTP/1.1\r\n\r\n")
+        thread.join(timeout=5)
+    assert not thread.is_alive()
+
+
+def decode_chunked(data: bytes) -> bytes:
+    chunks = []
+    while True:
+        size, _, data = data.partition(b"\r\n")
+        size = int(size, 16)
+        if not size:
+            assert data == b"\r\n"
+            return b"".join(chunks)
+        chunks.append(data[:size])
+        assert data[size : size + 2] == b"\r\n"
+        data = data[size + 2 :]
+
+
+@pytest.mark.parametrize("engine", ENGINES)
+def test_get_file_streamed_gzip(tmp_path, engine):
+    content = b"".join(b"line %d\n" % i for i in range(100000))
+    (tmp_path / "big").write_bytes(content)
+    config = ServerConfig(stream_compression_threshold=len(content))
+    res = serve(
+        b"GET /files/big HTTP/1.1\r\nAccept-Encoding: gzip\r\n"
+        b"Connection: close\r\n\r\n",
+        config,
+        directory=str(tmp_path),
+        engine=engine,
+    )
+    head, _, body = res.partition(b"\r\n\r\n")
+    assert b"Transfer-Encoding: chunked" in head
+    assert b"Content-Length" not in head
+    assert gzip.decompress(decode_chunked(body)) == content
+
+
+@pytest.mark.parametrize("engine", ENGINES)
+def test_files_stay_within_the_directory(tmp_path, engine):
+    (tmp_path / "secret").write_bytes(b"secret")
+    directory = tmp_path / "files"
+    directory.mkdir()
+    res = serve(
+        b"GET /files/../secret HTTP/1.1\r\n\r\n"
+        b"GET /files//"
+        + str(tmp_path / "secret").lstrip("/").encode()
+        + b" HTTP/1.1\r\n\r\n"
+        b"POST /files/../created HTTP/1.1\r\nContent-Length: 1\r\n\r\nx"
+        b"POST /files/./created HTTP/1.1\r\nContent-Length: 1\r\n"
+        b"Connection: close\r\n\r\nx",
+        directory=str(directory),
+        engine=engine,
+    )
+    assert res.count(b"HTTP/1.1 404 Not Found\r\n") == 4
+    assert b"secret" not in res
+    assert not (tmp_path / "created").exists()
+    assert list(directory.iterdir()) == []
+
+
+@pytest.mark.parametrize("engine", ENGINES)
+@pytest.mark.parametrize(
+    "invalid",
+    [
+        b"BREW / HTTP/1.1\r\n\r\n",
+        b"GET /\xff HTTP/1.1\r\n\r\n",
+        b"PRI * HTTP/2.0\r\n\r\n",
+    ],
+)
+def test_invalid_request_gets_a_400(engine, invalid):
+    res = serve(
+        b"GET / HTTP/1.1\r\n\r\n" + invalid + b"GET / HTTP/1.1\r\n\r\n",
+        ServerConfig(http2=False),
+        engine=engine,
+    )
+    first, second = res.split(b"HTTP/1.1 ")[1:]
+    assert first.startswith(b"200 OK\r\n")
+    assert second.startswith(b"400 Bad Request\r\n")
+    assert b"Connection: close\r\n" in second
+
+
+@pytest.mark.parametrize("engine", ENGINES)
+def test_ambiguous_body_length_gets_a_400(engine):
+    res = serve(
+        b"POST /echo/a HTTP/1.1\r\nContent-Length: 5\r\nContent-Length: 30\r\n\r\n"
+        b"12345GET /echo/smuggled HTTP/1.1\r\n\r\n",
+        engine=engine,
+    )
+    assert res.startswith(b"HTTP/1.1 400 Bad Request\r\n")
+    assert res.count(b"HTTP/1.1 ") == 1
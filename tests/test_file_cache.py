@@ -0,0 +1,155 @@
+import gzip
+import os
+import pytest
+from app.api import handle_req
+from app.conditional import none_match, not_modified_since
+from app.file_cache import FILE_CACHE, FileCache
+from app.http import HttpRequest, HttpStatus
+from app.ranges import http_date
+from tests.test_connection import ENGINES, serve
+
+
+def test_lookup_is_cached_until_the_ttl_expires(tmp_path):
+    path = tmp_path / "file"
+    path.write_bytes(b"v1")
+    cache = FileCache(max_entries=8, ttl=60)
+    info = cache.lookup(path)
+    assert info.size == 2
+    path.write_bytes(b"v2!")
+    assert cache.lookup(path) is info
+
+    cache.ttl = 0
+    new_info = cache.lookup(path)
+    assert new_info.size == 3
+    assert new_info.etag != info.etag
+    # the descriptor of the previous version is closed
+    assert info.fd == -1
+
+    path.unlink()
+    assert cache.lookup(path) is None
+    assert len(cache) == 0
+
+
+def test_open_sends_the_cached_version(tmp_path):
+    path = tmp_path / "file"
+    path.write_bytes(b"old")
+    cache = FileCache(max_entries=8, ttl=60)
+    info = cache.lookup(path)
+    replacement = tmp_path / "new"
+    replacement.write_bytes(b"new content")
+    os.replace(replacement, path)
+    with info.open() as f:
+        assert f.read() == b"old"
+
+
+def test_readers_have_their_own_position(tmp_path):
+    path = tmp_path / "file"
+    path.write_bytes(b"0123456789")
+    info = FileCache(max_entries=8, ttl=60).lookup(path)
+    with info.open() as first, info.open() as second:
+        first.seek(4)
+        assert first.read(3) == b"456"
+        assert second.read() == b"0123456789"
+        assert first.tell() == 7
+        # the shared descriptor moved by someone else, sendfile does not move it
+        os.lseek(info.fd, 0, os.SEEK_END)
+        assert first.read() == b"789"
+
+
+@pytest.mark.parametrize("engine", ENGINES)
+def test_compressed_after_sent_as_is(tmp_path, engine):
+    FILE_CACHE.clear()
+    (tmp_path / "a.txt").write_bytes(b"abc" * 1000)
+    res = serve(
+        b"GET /files/a.txt HTTP/1.1\r\n\r\n"
+        b"GET /files/a.txt HTTP/1.1\r\nAccept-Encoding: gzip\r\n"
+        b"Connection: close\r\n\r\n",
+        directory=str(tmp_path),
+        engine=engine,
+    )
+    gzipped = res[res.index(b"Content-Encoding: gzip") :]
+    body = gzipped[gzipped.index(b"\r\n\r\n") + 4 :]
+    assert gzip.decompress(body) == b"abc" * 1000
+
+
+def test_eviction(tmp_path):
+    cache = FileCache(max_entries=1, ttl=60)
+    (tmp_path / "a").write_bytes(b"a")
+    (tmp_path / "b").write_bytes(b"b")
+    a = cache.lookup(tmp_path / "a")
+    cache.lookup(tmp_path / "b")
+    assert len(cache) == 1
+    assert a.fd == -1
+    # still readable from its path
+    with a.open() as f:
+        assert f.read() == b"a"
+
+    assert FileCache(max_entries=0, ttl=60).lookup(tmp_path / "a").fd == -1
+
+
+def test_validators():
+    assert none_match('"a", W/"b"', '"b"')
+    assert none_match("*", '"b"')
+    assert not none_match('"a"', '"b"')
+    assert not_modified_since(http_date(1_700_000_000), 1_700_000_000.9)
+    assert not not_modified_since(http_date(1_700_000_000), 1_700_000_001)
+    assert not not_modified_since("yesterday", 0)
+
+
+def get(tmp_path, headers: str = ""):
+    req = HttpRequest.from_bytes(f"GET /files/file HTTP/1.1\r\n{headers}\r\n".encode())
+    return handle_req(req, str(tmp_path))
+
+
+def test_conditional_get(tmp_path):
+    (tmp_path / "file").write_bytes(b"x" * 100)
+    res = get(tmp_path)
+    etag, last_modified = res.headers["ETag"], res.headers["Last-Modified"]
+    assert etag.startswith('"')
+
+    res = get(tmp_path, f"If-None-Match: {etag}\r\n")
+    assert res.status == HttpStatus.NotModified304
+    assert res.headers["ETag"] == etag
+    assert "Content-Length" not in res.headers
+
+    assert get(tmp_path, 'If-None-Match: "other"\r\n').status == HttpStatus.Ok200
+    res = get(tmp_path, f"If-Modified-Since: {last_modified}\r\n")
+    assert res.status == HttpStatus.NotModified304
+    # If-None-Match wins over If-Modified-Since
+    res = get(
+        tmp_path, f'If-None-Match: "other"\r\nIf-Modified-Since: {last_modified}\r\n'
+    )
+    assert res.status == HttpStatus.Ok200
+
+    # the compressed version has its own, weak, tag
+    res = get(tmp_path, "Accept-Encoding: gzip\r\n")
+    assert res.headers["ETag"].startswith("W/") and res.headers["ETag"] != etag
+    res = get(tmp_path, f"Accept-Encoding: gzip\r\nIf-None-Match: {etag}\r\n")
+    assert res.status == HttpStatus.Ok200
+
+
+def test_if_range_with_etag(tmp_path):
+    (tmp_path / "file").write_bytes(bytes(range(100)))
+    etag = get(tmp_path).headers["ETag"]
+    res = get(tmp_path, f"Range: bytes=0-9\r\nIf-Range: {etag}\r\n")
+    assert res.status == HttpStatus.PartialContent206
+    assert res.headers["ETag"] == etag
+    res = get(tmp_path, 'Range: bytes=0-9\r\nIf-Range: "stale"\r\n')
+    assert res.status == HttpStatus.Ok200
+
+
+@pytest.mark.parametrize("engine", ENGINES)
+def test_not_modified_response(tmp_path, engine):
+    (tmp_path / "file").write_bytes(b"content")
+    etag = FILE_CACHE.lookup(tmp_path / "file").etag
+    res = serve(
+        f"GET /files/file HTTP/1.1\r\nIf-None-Match: {etag}\r\n\r\n"
+        "GET /files/file HTTP/1.1\r\nConnection: close\r\n\r\n".encode(),
+        directory=str(tmp_path),
+        engine=engine,
+    )
+    not_modified, ok = res.split(b"HTTP/1.1 ")[1:]
+    assert not_modified.startswith(b"304 Not Modified\r\n")
+    assert not_modified.endswith(b"\r\n\r\n")
+    assert ok.startswith(b"200 OK\r\n")
+    assert ok.endswith(b"\r\n\r\ncontent")
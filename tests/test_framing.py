@@ -0,0 +1,148 @@
+import pytest
+from app.framing import (
+    FramerState,
+    FramingError,
+    HeadersTooLarge,
+    InvalidRequest,
+    RequestFramer,
+    RequestLineTooLong,
+)
+
+
+def test_framer_without_body():
+    framer = RequestFramer()
+    msg = b"GET / HTTP/1.1\r\nHost: localhost:4221\r\n\r\n"
+    assert framer.feed(msg) == FramerState.DONE
+    assert framer.pop_message() == msg
+    assert framer.state == FramerState.HEADERS
+    assert framer.buffer == b""
+
+
+def test_framer_fragmented_body():
+    framer = RequestFramer()
+    body = b"x" * 5000
+    msg = b"POST /files/a HTTP/1.1\r\ncontent-length: 5000\r\n\r\n" + body
+
+    # split the message byte by byte around the empty line, then in chunks
+    for i in range(60):
+        framer.feed(msg[i : i + 1])
+    assert framer.state == FramerState.BODY
+    assert framer.body_remaining == len(msg) - 60
+    for i in range(60, len(msg), 1000):
+        assert not framer.message_complete()
+        framer.feed(msg[i : i + 1000])
+
+    assert framer.message_complete()
+    assert framer.pop_message() == msg
+
+
+def test_framer_keeps_next_request():
+    framer = RequestFramer()
+    first = b"POST / HTTP/1.1\r\nContent-Length: 3\r\n\r\nabc"
+    second = b"GET / HTTP/1.1\r\n\r\n"
+    framer.feed(first + second[:5])
+    assert framer.pop_message() == first
+    assert framer.state == FramerState.HEADERS
+    framer.feed(second[5:])
+    assert framer.pop_message() == second
+
+
+def test_framer_incomplete():
+    framer = RequestFramer()
+    framer.feed(b"GET / HTTP/1.1\r\n")
+    with pytest.raises(FramingError):
+        framer.pop_message()
+
+
+def test_framer_streamed_body():
+    framer = RequestFramer()
+    head = b"POST /files/a HTTP/1.1\r\nContent-Length: 10\r\n\r\n"
+    following = b"GET / HTTP/1.1\r\n\r\n"
+    framer.feed(head + b"0123")
+    assert framer.head_complete()
+    assert framer.pop_head() == head
+    assert framer.pop_body_chunk() == b"0123"
+    assert framer.content_length == 6
+    assert framer.pop_body_chunk() == b""
+    framer.feed(b"456789" + following)
+    assert framer.pop_body_chunk() == b"456789"
+    # the body is exhausted: the framer moved on to the following request
+    assert framer.message_complete()
+    assert framer.pop_message() == following
+
+
+def test_framer_body_is_a_view_of_the_buffer():
+    framer = RequestFramer()
+    body = bytes(range(256)) * 4
+    following = b"GET / HTTP/1.1\r\n\r\n"
+    framer.feed(b"POST /files/a HTTP/1.1\r\nContent-Length: 1024\r\n\r\n" + body[:10])
+    framer.pop_head()
+    buffer = framer.buffer
+    framer.feed(body[10:] + following)
+    with pytest.raises(FramingError):
+        RequestFramer().pop_body()
+    popped = framer.pop_body()
+    assert popped == body
+    assert popped.obj is buffer
+    # the following request is in a buffer of its own, which can still grow
+    assert framer.message_complete()
+    framer.feed(b"GET")
+    assert framer.pop_message() == following
+
+
+def test_request_line_limit():
+    line = b"GET /" + b"a" * 10 + b" HTTP/1.1"
+    framer = RequestFramer(max_request_line=len(line))
+    framer.feed(line + b"\r\n\r\n")
+    assert framer.pop_head() == line + b"\r\n\r\n"
+
+    framer = RequestFramer(max_request_line=len(line) - 1)
+    framer.feed(line[:-2])
+    # detected without waiting for the end of the head
+    with pytest.raises(RequestLineTooLong):
+        framer.feed(line[-2:] + b"\r\nHost: a")
+
+
+def test_header_size_limit():
+    head = b"GET / HTTP/1.1\r\nX-Padding: " + b"x" * 100 + b"\r\n\r\n"
+    framer = RequestFramer(max_header_size=len(head))
+    framer.feed(head + b"GET / HTTP/1.1\r\n")
+    framer.pop_message()
+
+    framer = RequestFramer(max_header_size=64)
+    with pytest.raises(HeadersTooLarge):
+        framer.feed(head[:80])
+
+
+def test_pipelined_head_is_checked_when_popped():
+    small = b"POST / HTTP/1.1\r\nContent-Length: 2\r\n\r\nok"
+    large = b"GET / HTTP/1.1\r\nX-Padding: " + b"x" * 100 + b"\r\n\r\n"
+    framer = RequestFramer(max_header_size=64)
+    framer.feed(small + large[:40])
+    framer.pop_head()
+    # the rest of the large head arrives with the body of the small request,
+    # and is complete once the body is popped
+    framer.buffer += large[40:]
+    assert framer.pop_body_chunk() == b"ok"
+    with pytest.raises(HeadersTooLarge):
+        framer.pop_head()
+
+
+def test_framer_refuses_ambiguous_lengths():
+    for head in [
+        b"Content-Length: 5\r\nContent-Length: 6\r\n",
+        b"Content-Length: 5, 6\r\n",
+        b"Content-Length: five\r\n",
+        b"Content-Length: 5\r\nTransfer-Encoding: chunked\r\n",
+        b"Transfer-Encoding: chunked\r\n",
+    ]:
+        framer = RequestFramer()
+        framer.feed(b"POST /a HTTP/1.1\r\n" + head + b"\r\n12345")
+        with pytest.raises(InvalidRequest):
+            framer.pop_head()
+
+    # the same length repeated is not ambiguous
+    framer = RequestFramer()
+    framer.feed(b"POST /a HTTP/1.1\r\nContent-Length: 5\r\ncontent-length: 5\r\n\r\n")
+    framer.pop_head()
+    assert framer.content_length == 5
@@ -0,0 +1,106 @@
+import pytest
+from app.hpack import (
+    Decoder,
+    Encoder,
+    HeaderListTooLarge,
+    HpackError,
+    decode_int,
+    encode_int,
+    huffman_decode,
+    huffman_encode,
+)
+
+
+def test_integers():
+    # RFC 7541 C.1
+    assert encode_int(10, 5) == b"\x0a"
+    assert encode_int(1337, 5) == b"\x1f\x9a\x0a"
+    assert decode_int(b"\x1f\x9a\x0a", 0, 5) == (1337, 3)
+    with pytest.raises(HpackError):
+        decode_int(b"\x1f\x9a", 0, 5)
+
+
+def test_huffman_round_trip():
+    assert huffman_encode(b"www.example.com") == bytes.fromhex(
+        "f1e3c2e5f23a6ba0ab90f4ff"
+    )
+    data = bytes(range(256)) * 2
+    assert huffman_decode(huffman_encode(data)) == data
+    # padding longer than 7 bits, or not made of ones
+    with pytest.raises(HpackError):
+        huffman_decode(bytes.fromhex("f1e3c2e5f23a6ba0ab90f4ffff"))
+    with pytest.raises(HpackError):
+        huffman_decode(b"\x00")
+
+
+def test_decode_requests_with_huffman():
+    """RFC 7541 C.4: the dynamic table carries over from one block to the next"""
+    decoder = Decoder()
+    assert decoder.decode(bytes.fromhex("828684418cf1e3c2e5f23a6ba0ab90f4ff")) == [
+        (b":method", b"GET"),
+        (b":scheme", b"http"),
+        (b":path", b"/"),
+        (b":authority", b"www.example.com"),
+    ]
+    assert decoder.decode(bytes.fromhex("828684be5886a8eb10649cbf"))[-1] == (
+        b"cache-control",
+        b"no-cache",
+    )
+    assert decoder.decode(
+        bytes.fromhex("828785bf408825a849e95ba97d7f8925a849e95bb8e8b4bf")
+    ) == [
+        (b":method", b"GET"),
+        (b":scheme", b"https"),
+        (b":path", b"/index.html"),
+        (b":authority", b"www.example.com"),
+        (b"custom-key", b"custom-value"),
+    ]
+    assert decoder.table.size == 164
+
+
+def test_encoder_and_decoder_agree():
+    encoder = Encoder(max_table_size=256, not_indexed=frozenset((b"etag",)))
+    decoder = Decoder()
+    blocks = []
+    for i in range(20):
+        fields = [
+            (b":status", b"200"),
+            (b"content-type", b"text/plain"),
+            (b"etag", b'"%d"' % i),
+            (b"x-custom", b"value %d" % (i % 3)),
+        ]
+        blocks.append(encoder.encode(fields))
+        assert decoder.decode(blocks[-1]) == fields
+    # repeated fields come from the table
+    assert len(blocks[-1]) < len(blocks[0])
+    assert all(b"etag" not in name for name, _ in decoder.table.entries)
+    assert encoder.table.size <= 256
+
+    encoder.resize(0)
+    encoder.resize(128)
+    block = encoder.encode([(b"x-custom", b"value 0")])
+    assert block.startswith(b"\x20\x3f\x61")
+    assert decoder.decode(block) == [(b"x-custom", b"value 0")]
+    assert decoder.table.max_size == 128
+
+
+def test_invalid_blocks():
+    with pytest.raises(HpackError):
+        Decoder().decode(b"\xbe")
+    with pytest.raises(HpackError):
+        Decoder().decode(b"\x82\x20")
+    with pytest.raises(HpackError):
+        Decoder(max_table_size=100).decode(encode_int(4096, 5, 0x20))
+
+
+def test_header_list_size_is_checked_while_decoding():
+    encoder = Encoder()
+    decoder = Decoder()
+    big = (b"x-big", b"a" * 3000)
+    # one byte for each copy of the entry once in the table
+    block = encoder.encode([big]) + b"\xbe" * 100_000
+    with pytest.raises(HeaderListTooLarge):
+        decoder.decode(block, max_list_size=8192)
+    # the block was decoded whole: the table is still in sync
+    block = encoder.encode([big, (b"x-small", b"b")])
+    assert decoder.decode(block, max_list_size=8192) == [big, (b"x-small", b"b")]
@@ -0,0 +1,40 @@
+from app.http import (
+    HttpResponse,
+    HttpStatus,
+    HttpVersion,
+    cached_header_line,
+    header_line,
+)
+
+
+def test_response_buffers():
+    body = b"x" * 100000
+    res = HttpResponse.encoded_content(status=HttpStatus.Ok200, content=body)
+    res.set_keep_alive(True, HttpVersion.V1_0)
+    buffers = res.to_buffers()
+    # the body is passed as is, never copied
+    assert buffers[-1] is body
+    assert b"".join(buffers) == (
+        b"HTTP/1.1 200 OK\r\n"
+        b"Content-Type: text/plain\r\n"
+        b"Content-Length: 100000\r\n"
+        b"Connection: keep-alive\r\n"
+        b"\r\n" + body
+    )
+    assert res.head_bytes() == b"".join(buffers[:-1])
+
+
+def test_empty_response_buffers():
+    res = HttpResponse.empty(status=HttpStatus.NotFound404)
+    assert res.to_bytes() == b"HTTP/1.1 404 Not Found\r\nContent-Length: 0\r\n\r\n"
+
+
+def test_only_repeated_header_lines_are_cached():
+    cached_header_line.cache_clear()
+    for length in range(100):
+        assert (
+            header_line("Content-Length", str(length))
+            == b"Content-Length: %d\r\n" % length
+        )
+        header_line("Content-Type", "text/plain")
+    assert cached_header_line.cache_info().currsize == 1
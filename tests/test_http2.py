@@ -0,0 +1,278 @@
+import base64
+import socket
+import threading
+import app.http2
+from app.config import ServerConfig
+from app.hpack import Decoder, Encoder
+from app.http2 import (
+    PREFACE,
+    ErrorCode,
+    Flag,
+    FrameType,
+    Setting,
+    encode_settings,
+    frame,
+)
+from tests.test_connection import handle_connection_streams
+
+
+class Client:
+    """Minimal HTTP/2 client over a socket pair with the asyncio engine"""
+
+    def __init__(
+        self,
+        config: ServerConfig = ServerConfig(),
+        directory: str | None = None,
+        settings: dict[int, int] | None = None,
+        preface: bool = True,
+    ):
+        self.sock, server = socket.socketpair()
+        # a test waiting for a frame that never comes fails rather than hangs
+        self.sock.settimeout(5)
+        self.thread = threading.Thread(
+            target=handle_connection_streams, args=(server, directory, config)
+        )
+        self.thread.start()
+        self.encoder = Encoder()
+        self.decoder = Decoder()
+        self.settings = settings or {}
+        if preface:
+            self.send_preface()
+
+    def send_preface(self):
+        self.sock.sendall(
+            PREFACE + frame(FrameType.SETTINGS, 0, 0, encode_settings(self.settings))
+        )
+
+    def request(
+        self, stream_id: int, path: str, method: str = "GET", end_stream: bool = True
+    ):
+        fields = [
+            (b":method", method.encode()),
+            (b":scheme", b"http"),
+            (b":path", path.encode()),
+            (b":authority", b"localhost"),
+            (b"user-agent", b"test-client"),
+        ]
+        flags = Flag.END_HEADERS | (Flag.END_STREAM if end_stream else 0)
+        self.send(FrameType.HEADERS, flags, stream_id, self.encoder.encode(fields))
+
+    def send(self, type: FrameType, flags: int, stream_id: int, payload: bytes = b""):
+        self.sock.sendall(frame(type, flags, stream_id, payload))
+
+    def recv_exactly(self, n: int) -> bytes:
+        data = b""
+        while len(data) < n:
+            chunk = self.sock.recv(n - len(data))
+            if not chunk:
+                raise ConnectionError("Closed by the server")
+            data += chunk
+        return data
+
+    def recv_frame(self) -> tuple[int, int, int, bytes]:
+        header = self.recv_exactly(9)
+        payload = self.recv_exactly(int.from_bytes(header[:3], "big"))
+        return header[3], header[4], int.from_bytes(header[5:], "big"), payload
+
+    def responses(self, nb: int) -> dict[int, tuple[dict[bytes, bytes], bytes]]:
+        """Headers and body of the next `nb` responses, by stream. The headers or
+        part of the body may have been received already"""
+        headers: dict[int, dict[bytes, bytes]] = {}
+        bodies: dict[int, bytearray] = {}
+        done: dict[int, tuple[dict[bytes, bytes], bytes]] = {}
+        while len(done) < nb:
+            type, flags, stream_id, payload = self.recv_frame()
+            if type == FrameType.HEADERS:
+                headers[stream_id] = dict(self.decoder.decode(payload))
+                bodies[stream_id] = bytearray()
+            elif type == FrameType.DATA:
+                bodies.setdefault(stream_id, bytearray()).extend(payload)
+            elif type == FrameType.RST_STREAM:
+                done[stream_id] = ({}, payload)
+                continue
+            else:
+                continue
+            if flags & Flag.END_STREAM:
+                done[stream_id] = (headers.get(stream_id, {}), bytes(bodies[stream_id]))
+        return done
+
+    def close(self):
+        self.send(FrameType.GOAWAY, 0, 0, bytes(8))
+        self.sock.close()
+        self.thread.join()
+
+
+def test_multiplexed_streams():
+    client = Client()
+    for stream_id, path in ((1, "/echo/a"), (3, "/user-agent"), (5, "/echo/ccc")):
+        client.request(stream_id, path)
+    res = client.responses(3)
+    assert {stream_id: body for stream_id, (_, body) in res.items()} == {
+        1: b"a",
+        3: b"test-client",
+        5: b"ccc",
+    }
+    headers = res[1][0]
+    assert headers[b":status"] == b"200"
+    assert headers[b"content-length"] == b"1"
+    assert b"connection" not in headers
+    # the second time, the headers come from the table of the decoder
+    client.request(7, "/echo/a")
+    assert client.responses(1)[7] == res[1]
+    client.close()
+
+
+def test_upgrade_from_http_1_1():
+    client = Client(preface=False)
+    settings = base64.urlsafe_b64encode(
+        encode_settings({Setting.INITIAL_WINDOW_SIZE: 1000})
+    ).rstrip(b"=")
+    client.sock.sendall(
+        b"GET /echo/upgraded HTTP/1.1\r\nHost: localhost\r\n"
+        b"Connection: Upgrade, HTTP2-Settings\r\nUpgrade: h2c\r\n"
+        b"HTTP2-Settings: " + settings + b"\r\n\r\n"
+    )
+    head = b""
+    while not head.endswith(b"\r\n\r\n"):
+        head += client.recv_exactly(1)
+    assert head.startswith(b"HTTP/1.1 101 Switching Protocols\r\n")
+    assert b"Upgrade: h2c\r\n" in head
+    client.send_preface()
+    headers, body = client.responses(1)[1]
+    assert headers[b":status"] == b"200"
+    assert body == b"upgraded"
+    client.close()
+
+
+def test_invalid_upgrade_settings_get_a_400():
+    for settings in (
+        b"A",
+        base64.urlsafe_b64encode(bytes(5)),
+        base64.urlsafe_b64encode(encode_settings({Setting.MAX_FRAME_SIZE: 100})),
+    ):
+        client = Client(preface=False)
+        client.sock.sendall(
+            b"GET /echo/upgraded HTTP/1.1\r\nHost: localhost\r\n"
+            b"Connection: Upgrade, HTTP2-Settings\r\nUpgrade: h2c\r\n"
+            b"HTTP2-Settings: " + settings + b"\r\n\r\n"
+        )
+        res = b""
+        while chunk := client.sock.recv(4096):
+            res += chunk
+        assert res.startswith(b"HTTP/1.1 400 Bad Request\r\n"), settings
+        client.sock.close()
+        client.thread.join()
+
+
+def test_flow_control(tmp_path):
+    content = bytes(range(256)) * 4
+    (tmp_path / "data.bin").write_bytes(content)
+    client = Client(
+        directory=str(tmp_path), settings={Setting.INITIAL_WINDOW_SIZE: 100}
+    )
+    client.request(1, "/files/data.bin")
+    received = b""
+    while len(received) < 100:
+        type, _, _, payload = client.recv_frame()
+        if type == FrameType.DATA:
+            received += payload
+    assert received == content[:100]
+    # nothing more until the window grows
+    client.sock.settimeout(0.2)
+    try:
+        assert client.recv_frame()[0] != FrameType.DATA
+    except TimeoutError:
+        pass
+    client.sock.settimeout(5)
+    client.send(FrameType.WINDOW_UPDATE, 0, 1, (2000).to_bytes(4, "big"))
+    _, body = client.responses(1)[1]
+    assert received + body == content
+    client.close()
+
+
+def test_request_body_and_stream_limit(tmp_path):
+    content = bytes(range(256)) * 200
+    client = Client(ServerConfig(http2_max_streams=1), directory=str(tmp_path))
+    client.request(1, "/files/upload", method="POST", end_stream=False)
+    # beyond the limit while the first is in progress
+    client.request(3, "/echo/a")
+    for i in range(0, len(content), 16384):
+        flags = Flag.END_STREAM if i + 16384 >= len(content) else 0
+        client.send(FrameType.DATA, flags, 1, content[i : i + 16384])
+    res = client.responses(2)
+    assert res[3] == ({}, ErrorCode.REFUSED_STREAM.to_bytes(4, "big"))
+    assert res[1][0][b":status"] == b"201"
+    assert (tmp_path / "upload").read_bytes() == content
+    client.close()
+
+
+def test_malformed_requests():
+    client = Client()
+    # no :path
+    fields = [(b":method", b"GET"), (b":scheme", b"http")]
+    flags = Flag.END_HEADERS | Flag.END_STREAM
+    client.send(FrameType.HEADERS, flags, 1, client.encoder.encode(fields))
+    assert client.responses(1)[1] == ({}, ErrorCode.PROTOCOL_ERROR.to_bytes(4, "big"))
+    # the connection goes on
+    client.request(3, "/echo/a")
+    assert client.responses(1)[3][1] == b"a"
+
+    # a block that can not be decoded ends the connection
+    client.send(FrameType.HEADERS, flags, 5, b"\xff")
+    while (received := client.recv_frame())[0] != FrameType.GOAWAY:
+        pass
+    assert received[3][4:] == ErrorCode.COMPRESSION_ERROR.to_bytes(4, "big")
+    client.close()
+
+
+def test_body_too_large_is_answered_early(tmp_path):
+    client = Client(ServerConfig(max_body_size=10), directory=str(tmp_path))
+    client.request(1, "/files/upload", method="POST", end_stream=False)
+    client.send(FrameType.DATA, 0, 1, b"x" * 20)
+    assert client.responses(1)[1][0][b":status"] == b"413"
+    # the stream is then reset, the rest of its body ignored
+    client.send(FrameType.DATA, Flag.END_STREAM, 1, b"x" * 20)
+    client.request(3, "/echo/a")
+    res = client.responses(2)
+    assert res[1] == ({}, ErrorCode.NO_ERROR.to_bytes(4, "big"))
+    assert res[3][1] == b"a"
+    assert not (tmp_path / "upload").exists()
+    client.close()
+
+
+def test_failing_handler_ends_its_stream(monkeypatch):
+    handle_req_async = app.http2.handle_req_async
+
+    async def failing(req, directory, config):
+        if req.urlpath.path == "echo/boom":
+            raise RuntimeError("boom")
+        return await handle_req_async(req, directory, config)
+
+    monkeypatch.setattr(app.http2, "handle_req_async", failing)
+    client = Client(ServerConfig(http2_max_streams=1, keep_alive_timeout=0.2))
+    client.request(1, "/echo/boom")
+    assert client.responses(1)[1][0][b":status"] == b"500"
+    # the stream does not count against the limit anymore
+    client.request(3, "/echo/a")
+    assert client.responses(1)[3][1] == b"a"
+    # and the idle connection is closed
+    while (received := client.recv_frame())[0] != FrameType.GOAWAY:
+        pass
+    assert received[3][4:] == ErrorCode.NO_ERROR.to_bytes(4, "big")
+    client.sock.close()
+    client.thread.join()
+
+
+def test_header_list_size_is_checked_while_decoding():
+    client = Client(ServerConfig(max_header_size=8192))
+    # a large entry in the table, then one byte for each copy of it
+    block = client.encoder.encode([(b"x-big", b"a" * 3000)]) + b"\xbe" * 4000
+    flags = Flag.END_HEADERS | Flag.END_STREAM
+    client.send(FrameType.HEADERS, flags, 1, block)
+    assert client.responses(1)[1][0][b":status"] == b"431"
+    # the connection goes on, its table in sync
+    client.request(3, "/echo/a")
+    res = client.responses(2)
+    assert res[1] == ({}, ErrorCode.NO_ERROR.to_bytes(4, "big"))
+    assert res[3][1] == b"a"
+    client.close()
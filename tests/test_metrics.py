@@ -0,0 +1,118 @@
+import multiprocessing
+import os
+import threading
+from app.metrics import BUCKETS, Metrics, Shard, render_prometheus
+from tests.test_connection import serve
+
+
+def test_histogram_buckets_are_cumulative():
+    metrics = Metrics()
+    for seconds in (0.00001, BUCKETS[0], 0.003, 60.0):
+        metrics.observe("parse", seconds)
+    text = render_prometheus(metrics.snapshot())
+    assert (
+        f'http_stage_duration_seconds_bucket{{stage="parse",le="{BUCKETS[0]}"}} 2'
+        in text
+    )
+    assert 'http_stage_duration_seconds_bucket{stage="parse",le="0.0025"} 2' in text
+    assert 'http_stage_duration_seconds_bucket{stage="parse",le="0.005"} 3' in text
+    assert 'http_stage_duration_seconds_bucket{stage="parse",le="10.0"} 3' in text
+    assert 'http_stage_duration_seconds_bucket{stage="parse",le="+Inf"} 4' in text
+    assert 'http_stage_duration_seconds_count{stage="parse"} 4' in text
+
+
+def test_threads_are_merged_on_read():
+    metrics = Metrics()
+
+    def record():
+        for _ in range(1000):
+            metrics.count_request("echo", "200")
+            metrics.count_bytes_in(10)
+
+    threads = [threading.Thread(target=record) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    metrics.count_request("echo", "200")
+
+    snapshot = metrics.snapshot()
+    assert snapshot.requests == {("echo", "200"): 4001}
+    assert snapshot.bytes_in == 40000
+    # the shards of the threads that exited were folded into one
+    assert len(metrics.shards) == 1
+
+
+def record_in_child(metrics: Metrics):
+    # done at fork for the global registry
+    metrics.clear()
+    metrics.count_request("get_file", "200")
+    metrics.observe("send", 0.002)
+    metrics.count_bytes_out(1000)
+    metrics.flush()
+
+
+def test_processes_are_merged_on_read(tmp_path):
+    metrics = Metrics()
+    metrics.share(str(tmp_path))
+    metrics.count_request("get_file", "200")
+    ctx = multiprocessing.get_context("fork")
+    for _ in range(2):
+        child = ctx.Process(target=record_in_child, args=(metrics,))
+        child.start()
+        child.join()
+
+    collected = metrics.collect()
+    assert collected.requests == {("get_file", "200"): 3}
+    assert collected.bytes_out == 2000
+    assert collected.stages["send"].counts[BUCKETS.index(0.0025)] == 2
+    assert metrics.snapshot().requests == {("get_file", "200"): 1}
+
+
+def test_exited_processes_are_kept_apart(tmp_path):
+    reader = Metrics()
+    reader.share(str(tmp_path))
+    # two processes of the same pid, one after the other
+    for _ in range(2):
+        exited = Metrics()
+        exited.directory = str(tmp_path)
+        exited.count_request("echo", "200")
+        exited.gauge("http_pool_queue_depth", lambda: 4)
+        exited.flush()
+    assert reader.collect().requests == {("echo", "200"): 2}
+    assert reader.collect().gauges == {"http_pool_queue_depth": 8}
+
+    # the gauges of the snapshots not written for a while are not current
+    for path in tmp_path.glob("metrics-*.json"):
+        os.utime(path, (0, 0))
+    assert reader.collect().requests == {("echo", "200"): 2}
+    assert reader.collect().gauges == {}
+
+    # and the next run starts from scratch
+    (tmp_path / "metrics-1.json.2.tmp").touch()
+    Metrics.clear_directory(str(tmp_path))
+    assert not list(tmp_path.iterdir())
+    assert reader.collect().requests == {}
+
+
+def test_snapshot_round_trip():
+    shard = Shard()
+    shard.histogram("handle").observe(0.2)
+    shard.requests[("index", "200")] = 3
+    shard.bytes_in = 5
+    assert Shard.from_dict(shard.to_dict()).to_dict() == shard.to_dict()
+
+
+def test_metrics_route():
+    res = serve(
+        b"GET /echo/abc HTTP/1.1\r\n\r\n"
+        b"GET /nowhere HTTP/1.1\r\n\r\n"
+        b"GET /metrics HTTP/1.1\r\nConnection: close\r\n\r\n"
+    )
+    metrics_res = res[res.rindex(b"HTTP/1.1 200 OK") :]
+    assert b"Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n" in metrics_res
+    assert b'http_requests_total{handler="echo",status="200"}' in metrics_res
+    assert b'http_requests_total{handler="unmatched",status="404"}' in metrics_res
+    for stage in (b"receive", b"parse", b"handle", b"send"):
+        assert b'http_stage_duration_seconds_count{stage="%s"}' % stage in metrics_res
+    assert b"http_received_bytes_total " in metrics_res
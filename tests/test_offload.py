@@ -0,0 +1,52 @@
+import asyncio
+import threading
+from app import offload
+from app.api import handle_req_async
+from app.config import ServerConfig
+from app.file_cache import FILE_CACHE
+from app.http import HttpRequest
+
+
+def test_chunks_are_produced_in_io_threads():
+    def chunks():
+        for i in range(3):
+            yield threading.current_thread().name.encode()
+
+    async def run():
+        return [chunk async for chunk in offload.offload_chunks(chunks())]
+
+    names = asyncio.run(run())
+    assert len(names) == 3
+    assert all(name.startswith(b"io") for name in names)
+
+
+def test_no_io_threads_runs_on_the_loop():
+    offload.configure(0)
+    try:
+        name = asyncio.run(
+            offload.run_blocking(lambda: threading.current_thread().name)
+        )
+    finally:
+        offload.configure(ServerConfig.io_threads)
+    assert name == threading.current_thread().name
+
+
+def test_file_handler_runs_in_an_io_thread(tmp_path, monkeypatch):
+    (tmp_path / "a.txt").write_bytes(b"x" * 10_000)
+    looked_up_in = []
+    lookup = FILE_CACHE.lookup
+
+    def spy_lookup(path):
+        looked_up_in.append(threading.current_thread().name)
+        return lookup(path)
+
+    async def run():
+        req = HttpRequest.from_bytes(
+            b"GET /files/a.txt HTTP/1.1\r\nAccept-Encoding: gzip\r\n\r\n"
+        )
+        return await handle_req_async(req, str(tmp_path), ServerConfig())
+
+    monkeypatch.setattr(FILE_CACHE, "lookup", spy_lookup)
+    res = asyncio.run(run())
+    assert res.status.code == "200"
+    assert looked_up_in and looked_up_in[0].startswith("io")
@@ -1,6 +1,7 @@
 from pyparsing import Optional, ParseException, Word, alphas
 import pytest
-from app.http import HttpMethod, HttpUrlPath, HttpVersion
+from app.fast_parser import HttpParseError
+from app.http import HttpMethod, HttpRequest, HttpUrlPath, HttpVersion, ParserEngine
 from app.parser import (
     body_parser,
     headers_parser,
@@ -107,3 +108,98 @@ This is my body
     result = comb_parser.parse_string(msg).as_dict()
     print(result)
     print()
+
+
+@pytest.mark.parametrize("engine", list(ParserEngine))
+def test_request_from_bytes(engine):
+    for method in ["GET", "POST", "DELETE", "PUT"]:
+        req = HttpRequest.from_bytes(f"{method} / HTTP/1.1\r\n\r\n".encode(), engine)
+        assert req.method == HttpMethod(method)
+
+    for version in ["HTTP/1.1", "HTTP/1.0", "HTTP/2.0"]:
+        req = HttpRequest.from_bytes(f"GET / {version}\r\n\r\n".encode(), engine)
+        assert req.version == HttpVersion(version)
+
+    for target, host, path, query_params in [
+        ("https://example.com?a=bddf&c=w", "example.com", "", {"a": "bddf", "c": "w"}),
+        ("https://example.com:80/", "example.com:80", "", {}),
+        (
+            "https://example.com/a/b?qq=gg&ff=yy",
+            "example.com",
+            "a/b",
+            {"qq": "gg", "ff": "yy"},
+        ),
+        ("https://www.example.com:80/a/b/", "www.example.com:80", "a/b", {}),
+        ("/", None, "", {}),
+        ("/app/", None, "app", {}),
+        ("/echo/abc", None, "echo/abc", {}),
+        ("/?a=b", None, "", {"a": "b"}),
+        ("/a/b?a=b", None, "a/b", {"a": "b"}),
+        ("*", "*", "", {}),
+    ]:
+        req = HttpRequest.from_bytes(f"GET {target} HTTP/1.1\r\n\r\n".encode(), engine)
+        assert (req.urlpath.host or None) == host
+        assert req.urlpath.path == path
+        assert req.urlpath.query_params == query_params
+
+    msg = (
+        b"POST /files/abc HTTP/1.1\r\nHost: localhost:4221\r\nUser-Agent: curl/8.9.1\r\n"
+        b"Accept: */*\r\nAccept-Encoding: gzip, other\r\n\r\nThis is my body"
+    )
+    req = HttpRequest.from_bytes(msg, engine)
+    assert req.headers == {
+        "Host": "localhost:4221",
+        "User-Agent": "curl/8.9.1",
+        "Accept": "*/*",
+        "Accept-Encoding": "gzip, other",
+    }
+    assert req.body == b"This is my body"
+
+    # bodies are never decoded
+    body = bytes(range(256))
+    req = HttpRequest.from_bytes(b"POST /files/a HTTP/1.1\r\n\r\n" + body, engine)
+    assert req.body == body
+
+
+def test_fast_parser_invalid_requests():
+    for msg in [
+        b"get / HTTP/1.1\r\n\r\n",
+        b"GET / HTTP/3\r\n\r\n",
+        b"GET1 / HTTP/1.1",
+        b"GET boom HTTP/1.1\r\n\r\n",
+    ]:
+        with pytest.raises(HttpParseError):
+            HttpRequest.from_bytes(msg, ParserEngine.FAST)
+
+
+def test_headers_lookup():
+    req = HttpRequest.from_bytes(
+        b"GET / HTTP/1.1\r\naccept-encoding: gzip\r\nX-Tag: a\r\nHost: h\r\n"
+        b"x-tag:  b \r\n\r\n"
+    )
+    # nothing is decoded before a lookup
+    assert not req.headers.cache
+    assert req.headers.get("Accept-Encoding") == "gzip"
+    assert req.headers["ACCEPT-ENCODING"] == "gzip"
+    assert "host" in req.headers
+    assert req.headers.get("Range") is None
+    assert req.headers.get_all("X-Tag") == ["a", "b"]
+    assert req.headers["x-tag"] == "a, b"
+    assert list(req.headers) == ["accept-encoding", "X-Tag", "Host"]
+
+
+def test_fast_parser_invalid_headers():
+    for msg in [
+        b"GET / HTTP/1.1\r\nno colon\r\n\r\n",
+        b"GET / HTTP/1.1\r\n: no name\r\n\r\n",
+        b"GET / HTTP/1.1\r\nName : value\r\n\r\n",
+        b"GET / HTTP/1.1\r\n folded: value\r\n\r\n",
+    ]:
+        with pytest.raises(HttpParseError):
+            HttpRequest.from_bytes(msg, ParserEngine.FAST)
+
+
+def test_headers_are_decoded_as_latin_1():
+    req = HttpRequest.from_bytes(b"GET / HTTP/1.1\r\nUser-Agent: \xff\xfe\r\n\r\n")
+    assert req.headers["user-agent"] == "\xff\xfe"
+    assert "naïve" not in req.headers
@@ -0,0 +1,66 @@
+import multiprocessing
+import os
+import pathlib
+import signal
+import time
+from app.prefork import Shutdown, Supervisor, raise_shutdown
+
+SHUTDOWN_TIMEOUT = 2.0
+
+
+def worker(directory: str):
+    """Records its start, the SIGUSR1 it gets and its drain in `directory`"""
+    path = pathlib.Path(directory)
+    signal.signal(signal.SIGTERM, raise_shutdown)
+    signal.signal(signal.SIGUSR1, lambda *_: (path / f"usr1-{os.getpid()}").touch())
+    (path / f"started-{os.getpid()}").touch()
+    try:
+        while True:
+            time.sleep(0.05)
+    except Shutdown:
+        (path / f"drained-{os.getpid()}").touch()
+
+
+def run_supervisor(directory: str):
+    Supervisor(
+        2, target=worker, args=(directory,), shutdown_timeout=SHUTDOWN_TIMEOUT
+    ).run()
+
+
+def pids(directory: pathlib.Path, prefix: str, nb: int) -> set[int]:
+    """Pids of the `nb` workers that created a `prefix-pid` file"""
+    deadline = time.monotonic() + 5
+    while time.monotonic() < deadline:
+        found = {int(p.name.split("-")[1]) for p in directory.glob(f"{prefix}-*")}
+        if len(found) >= nb:
+            return found
+        time.sleep(0.05)
+    raise TimeoutError(f"{nb} {prefix} files expected, got {found}")
+
+
+def test_supervisor_restarts_forwards_and_drains(tmp_path):
+    supervisor = multiprocessing.Process(target=run_supervisor, args=(str(tmp_path),))
+    supervisor.start()
+    try:
+        first = pids(tmp_path, "started", 2)
+
+        # a dead worker is replaced
+        killed = first.pop()
+        os.kill(killed, signal.SIGKILL)
+        alive = pids(tmp_path, "started", 3) - {killed}
+        assert len(alive) == 2
+
+        os.kill(supervisor.pid, signal.SIGUSR1)
+        assert pids(tmp_path, "usr1", 2) == alive
+
+        start = time.monotonic()
+        os.kill(supervisor.pid, signal.SIGTERM)
+        supervisor.join(SHUTDOWN_TIMEOUT + 1)
+        assert supervisor.exitcode == 0
+        assert time.monotonic() - start < SHUTDOWN_TIMEOUT
+        # the workers were asked to drain rather than killed
+        assert pids(tmp_path, "drained", 2) == alive
+    finally:
+        if supervisor.is_alive():
+            supervisor.kill()
+            supervisor.join()
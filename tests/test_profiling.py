@@ -0,0 +1,60 @@
+import pstats
+import time
+from app.config import ServerConfig
+from app.profiling import NOT_PROFILED, PROFILER, Profiler
+from app.response_cache import RESPONSE_CACHE
+from tests.test_connection import serve
+
+
+def test_one_request_in_n_is_profiled():
+    profiler = Profiler()
+    profiler.configure("cprofile", sample_every=3, directory=None)
+    assert profiler.request() is NOT_PROFILED
+
+    profiler.start()
+    for _ in range(7):
+        with profiler.request():
+            sum(range(10))
+    assert profiler.nb_profiled == 3
+
+
+def test_sampler_dumps_collapsed_stacks(tmp_path):
+    profiler = Profiler()
+    profiler.configure("sampler", sample_every=1, directory=str(tmp_path))
+    profiler.start()
+    deadline = time.monotonic() + 0.05
+    while time.monotonic() < deadline:
+        pass
+    path = profiler.stop()
+
+    with open(path) as f:
+        stacks = f.read().splitlines()
+    assert any(
+        "test_profiling.py:test_sampler_dumps_collapsed_stacks" in s for s in stacks
+    )
+    stack, _, count = stacks[0].rpartition(" ")
+    assert int(count) > 0
+
+
+def test_admin_routes(tmp_path):
+    config = ServerConfig(admin_routes=True)
+    PROFILER.configure("cprofile", sample_every=1, directory=str(tmp_path))
+    # the echo must run rather than be answered from the cache
+    RESPONSE_CACHE.clear()
+    res = serve(
+        b"POST /admin/profile/start HTTP/1.1\r\n\r\n"
+        b"GET /echo/abc HTTP/1.1\r\n\r\n"
+        b"POST /admin/profile/stop HTTP/1.1\r\nConnection: close\r\n\r\n",
+        config=config,
+    )
+    assert b"Profiling started (cprofile)" in res
+    (dump,) = tmp_path.glob("profile-*.pstats")
+    assert str(dump).encode() in res
+    functions = {func for _, _, func in pstats.Stats(str(dump)).stats}
+    assert "echo" in functions
+
+
+def test_admin_routes_are_disabled_by_default():
+    res = serve(b"POST /admin/profile/start HTTP/1.1\r\nConnection: close\r\n\r\n")
+    assert res.startswith(b"HTTP/1.1 404 Not Found\r\n")
+    assert not PROFILER.active
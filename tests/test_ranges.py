@@ -0,0 +1,77 @@
+from app.ranges import http_date, if_range_matches, parse_range
+from tests.test_connection import serve
+
+
+def test_parse_range():
+    size = 1000
+    for header, expected in [
+        ("bytes=0-499", [(0, 499)]),
+        ("bytes=500-", [(500, 999)]),
+        ("bytes=-100", [(900, 999)]),
+        ("bytes=-2000", [(0, 999)]),
+        ("bytes=900-2000", [(900, 999)]),
+        ("bytes=0-0, -1", [(0, 0), (999, 999)]),
+        # overlapping and adjacent ranges are coalesced
+        ("bytes=0-10, 5-20, 21-30, 500-600", [(0, 30), (500, 600)]),
+        ("bytes=1000-", []),
+        ("bytes=-0", []),
+        ("items=0-10", None),
+        ("bytes=10-5", None),
+        ("bytes=a-b", None),
+        ("bytes=5", None),
+    ]:
+        assert parse_range(header, size) == expected, header
+    # nothing of an empty file is satisfiable
+    for header in ("bytes=-100", "bytes=0-", "bytes=0-0"):
+        assert parse_range(header, 0) == [], header
+
+
+def test_if_range():
+    mtime = 1_700_000_000.5
+    assert if_range_matches(http_date(mtime), mtime)
+    assert not if_range_matches(http_date(mtime - 10), mtime)
+    assert not if_range_matches("not a date", mtime)
+    assert if_range_matches('"abc"', mtime, etag='"abc"')
+    assert not if_range_matches('W/"abc"', mtime, etag='W/"abc"'[2:])
+
+
+def test_get_file_ranges(tmp_path):
+    content = bytes(range(256)) * 100
+    (tmp_path / "data").write_bytes(content)
+    res = serve(
+        b"GET /files/data HTTP/1.1\r\nRange: bytes=10-19\r\n\r\n"
+        b"GET /files/data HTTP/1.1\r\nRange: bytes=30000-\r\n\r\n"
+        b"GET /files/data HTTP/1.1\r\nRange: bytes=0-1,-2\r\n"
+        b"Connection: close\r\n\r\n",
+        directory=str(tmp_path),
+    )
+    single, unsatisfiable, multi = res.split(b"HTTP/1.1 ")[1:]
+
+    assert single.startswith(b"206 Partial Content\r\n")
+    assert b"Content-Range: bytes 10-19/25600\r\n" in single
+    assert single.endswith(b"\r\n\r\n" + content[10:20])
+
+    assert unsatisfiable.startswith(b"416 Range Not Satisfiable\r\n")
+    assert b"Content-Range: bytes */25600\r\n" in unsatisfiable
+
+    head, _, body = multi.partition(b"\r\n\r\n")
+    boundary = head.split(b"boundary=")[1].split(b"\r\n")[0]
+    assert int(head.split(b"Content-Length: ")[1].split(b"\r\n")[0]) == len(body)
+    parts = body.split(b"--" + boundary)
+    assert parts[0] == b""
+    assert parts[1].endswith(b"Content-Range: bytes 0-1/25600\r\n\r\n\x00\x01\r\n")
+    assert parts[2].endswith(
+        b"Content-Range: bytes 25598-25599/25600\r\n\r\n\xfe\xff\r\n"
+    )
+    assert parts[3] == b"--\r\n"
+
+
+def test_get_empty_file_range(tmp_path):
+    (tmp_path / "empty").write_bytes(b"")
+    res = serve(
+        b"GET /files/empty HTTP/1.1\r\nRange: bytes=-100\r\n"
+        b"Connection: close\r\n\r\n",
+        directory=str(tmp_path),
+    )
+    assert res.startswith(b"HTTP/1.1 416 Range Not Satisfiable\r\n")
+    assert b"Content-Range: bytes */0\r\n" in res
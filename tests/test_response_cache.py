@@ -0,0 +1,71 @@
+import gzip
+import pytest
+from app.http import HttpResponse, HttpStatus, HttpVersion
+from app.response_cache import RESPONSE_CACHE, ResponseCache
+from tests.test_connection import ENGINES, serve
+
+
+def test_responses_expire_and_are_evicted_by_size(monkeypatch):
+    cache = ResponseCache(max_bytes=250, ttl=1.0)
+    res = cache.store("a", HttpResponse.text_content(content="a" * 50))
+    assert res.to_bytes() == HttpResponse.text_content(content="a" * 50).to_bytes()
+    cache.store("b", HttpResponse.text_content(content="b" * 50))
+    assert cache.get("a") is not None
+    # "b" is the least recently used
+    cache.store("c", HttpResponse.text_content(content="c" * 50))
+    assert cache.get("b") is None
+    assert cache.stats()["evictions"] == 1
+
+    # only complete 200s
+    not_found = HttpResponse.empty(status=HttpStatus.NotFound404)
+    assert cache.store("d", not_found) is not_found
+
+    expires_at = cache.get("a").serialized.expires_at
+    monkeypatch.setattr("time.monotonic", lambda: expires_at)
+    assert cache.get("a") is None
+    assert len(cache) == 1
+
+
+def test_connection_header_is_added_per_response():
+    cache = ResponseCache(max_bytes=1024, ttl=1.0)
+    cache.store("a", HttpResponse.text_content(content="abc"))
+    res = cache.get("a")
+    res.set_keep_alive(True, HttpVersion.V1_0)
+    expected = HttpResponse.text_content(content="abc")
+    expected.set_keep_alive(True, HttpVersion.V1_0)
+    assert res.to_bytes() == expected.to_bytes()
+    # the stored response is not modified
+    assert b"Connection" not in cache.get("a").to_bytes()
+
+
+@pytest.mark.parametrize("engine", ENGINES)
+def test_hits_are_the_same_response(engine):
+    RESPONSE_CACHE.clear()
+    hits = RESPONSE_CACHE.hits
+    request = b"GET /echo/cached HTTP/1.1\r\nAccept-Encoding: gzip\r\n\r\n"
+    res = serve(
+        request * 2 + request.replace(b"\r\n\r\n", b"\r\nConnection: close\r\n\r\n"),
+        engine=engine,
+    )
+    first, second, last = res.split(b"HTTP/1.1 ")[1:]
+    assert first == second
+    assert last.replace(b"Connection: close\r\n", b"") == first
+    assert gzip.decompress(first.partition(b"\r\n\r\n")[2]) == b"cached"
+    assert RESPONSE_CACHE.hits == hits + 2
+
+
+def test_key_holds_the_vary_headers():
+    RESPONSE_CACHE.clear()
+    hits = RESPONSE_CACHE.hits
+    res = serve(
+        b"GET /user-agent HTTP/1.1\r\nUser-Agent: a\r\n\r\n"
+        b"GET /user-agent HTTP/1.1\r\nUser-Agent: b\r\n\r\n"
+        b"GET /user-agent HTTP/1.1\r\nUser-Agent: a\r\nAccept-Encoding: gzip\r\n\r\n"
+        b"GET /user-agent HTTP/1.1\r\nUser-Agent: a\r\nConnection: close\r\n\r\n"
+    )
+    responses = res.split(b"HTTP/1.1 ")[1:]
+    assert [r.rpartition(b"\r\n\r\n")[2] for r in responses[:2]] == [b"a", b"b"]
+    assert b"Content-Encoding: gzip\r\n" in responses[2]
+    assert b"Vary: Accept-Encoding, User-Agent\r\n" in responses[0]
+    assert responses[3].endswith(b"\r\n\r\na")
+    assert RESPONSE_CACHE.hits == hits + 1
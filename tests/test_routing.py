@@ -0,0 +1,58 @@
+import pytest
+from app.api import handle_req
+from app.http import HttpMethod, HttpRequest
+from app.routing import MethodNotAllowed, RouteNotFound, Router
+
+
+def make_router() -> Router:
+    router = Router()
+    router.get("/")(lambda: "index")
+    router.get("/users/me")(lambda: "me")
+    router.get("/users/{user_id:int}")(lambda: "user")
+    router.get("/users/{name}/posts")(lambda: "posts")
+    router.post("/files/{filename:path}")(lambda: "post file")
+    router.get("/files/{filename:path}")(lambda: "get file")
+    return router
+
+
+@pytest.mark.parametrize(
+    "method, path, expected, params",
+    [
+        (HttpMethod.GET, "", "index", {}),
+        (HttpMethod.GET, "users/me", "me", {}),
+        (HttpMethod.GET, "users/42", "user", {"user_id": 42}),
+        (HttpMethod.GET, "users/bob/posts", "posts", {"name": "bob"}),
+        (HttpMethod.GET, "users/42/posts", "posts", {"name": "42"}),
+        (HttpMethod.GET, "files/a/b.txt", "get file", {"filename": "a/b.txt"}),
+        (HttpMethod.POST, "files/", "post file", {"filename": ""}),
+    ],
+)
+def test_resolve(method, path, expected, params):
+    handler, found_params = make_router().resolve(method, path)
+    assert handler() == expected
+    assert found_params == params
+
+
+@pytest.mark.parametrize("path", ["users", "users/bob", "users//posts", "files"])
+def test_route_not_found(path):
+    with pytest.raises(RouteNotFound):
+        make_router().resolve(HttpMethod.GET, path)
+
+
+def test_method_not_allowed():
+    with pytest.raises(MethodNotAllowed) as e:
+        make_router().resolve(HttpMethod.DELETE, "files/a")
+    assert e.value.allowed == [HttpMethod.GET, HttpMethod.POST]
+
+
+@pytest.mark.parametrize("pattern", ["/{a:float}", "/{not valid}", "/{rest:path}/end"])
+def test_invalid_patterns(pattern):
+    with pytest.raises(ValueError):
+        Router().get(pattern)(lambda: None)
+
+
+def test_handle_req_405():
+    req = HttpRequest.from_bytes(b"DELETE /echo/abc HTTP/1.1\r\n\r\n")
+    res = handle_req(req, directory=None)
+    assert res.to_bytes().startswith(b"HTTP/1.1 405 Method Not Allowed\r\n")
+    assert res.headers["Allow"] == "GET"